@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+# Benchmark suite.
+# Runs a set of microbenchmarks on each datastore, and reports for each one the throughput (operations per second) and
+# the latency percentiles of the operations. Each benchmark is run a few times to warm up, then several times to
+# measure; the reported values are the medians over the measured repetitions. Use --json to save the results, e.g. to
+# compare backends or commits.
+# Example: ./ndb-bench.py --datastores memory,lmdb --count 20000 --size 500 --json bench.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+parser = argparse.ArgumentParser(description="Benchmarks the ndb datastores.")
+parser.add_argument("--datastores", default="memory,leveldb,lmdb", help="Comma-separated list of the datastore types to benchmark")
+parser.add_argument("--benchmarks", default=None, help="Comma-separated list of the benchmarks to run (default: all)")
+parser.add_argument("--count", type=int, default=10000, help="Number of instances stored in the datastore")
+parser.add_argument("--size", type=int, default=200, help="Size in bytes of the string property of each instance")
+parser.add_argument("--threads", type=int, default=4, help="Number of threads of the concurrent benchmark")
+parser.add_argument("--batch_size", type=int, default=100, help="Number of instances per batch of the batch_put benchmark")
+parser.add_argument("--compression", choices=["none", "zlib", "snappy", "lz4"], default="none", help="Compress the stored values with this codec (see ndb_compression)")
+parser.add_argument("--compression_dictionaries", action="store_true", help="Compress the values with a dictionary built from the first ones")
+parser.add_argument("--warmup", type=int, default=1, help="Number of unmeasured repetitions of each benchmark")
+parser.add_argument("--repetitions", type=int, default=5, help="Number of measured repetitions of each benchmark")
+parser.add_argument("--path", default="/tmp", help="Directory where the datastores are created")
+parser.add_argument("--seed", type=int, default=1, help="Seed of the random generator, for reproducible runs")
+parser.add_argument("--json", default=None, help="Write the results to this file as JSON")
+args = parser.parse_args()
+
+sys.argv = [sys.argv[0], "--datastore_type", "memory"]
+import ndb
+import ndb_compression
+import ndb_datastore
+# Each datastore is opened in turn below, instead of the one opened by the import.
+ndb.closeDatastore()
+
+class BenchEntity(ndb.Model):
+  n = ndb.IntegerProperty()
+  x = ndb.FloatProperty()
+  s = ndb.StringProperty()
+  flag = ndb.BooleanProperty()
+  when = ndb.DateTimeProperty()
+
+# Returns the key of the i-th instance.
+def getKey(i):
+  return "bench-%08d" % i
+
+# Returns the i-th instance, with a string property of args.size bytes.
+def getEntity(i):
+  return BenchEntity(getKey(i),
+                     n=i,
+                     x=random.random(),
+                     s=("%08d" % i) * (args.size / 8) + "x" * (args.size % 8),
+                     flag=(i % 2 == 0),
+                     when=datetime.datetime.utcfromtimestamp(1000000000 + i))
+
+# Benchmarks.
+# Each benchmark function runs one repetition and returns the list of the latencies of its operations, in seconds.
+# items is the number of instances each operation handles, used to report instances per second as well.
+
+def benchEncode(ctx):
+  latencies = []
+  for entity in ctx["entities"]:
+    t0 = time.time()
+    entity._encode()
+    latencies.append(time.time() - t0)
+  return latencies
+
+def benchDecode(ctx):
+  latencies = []
+  for key, encoded in ctx["encoded"]:
+    t0 = time.time()
+    BenchEntity._from_encoded(key, encoded)
+    latencies.append(time.time() - t0)
+  return latencies
+
+# Decodes the instances lazily (see Model.lazy_decoding) and reads 2 of their properties.
+def benchLazyDecode(ctx):
+  latencies = []
+  BenchEntity.lazy_decoding = True
+  try:
+    for key, encoded in ctx["encoded"]:
+      t0 = time.time()
+      entity = BenchEntity._from_encoded(key, encoded)
+      entity.n, entity.when
+      latencies.append(time.time() - t0)
+  finally:
+    BenchEntity.lazy_decoding = False
+  return latencies
+
+def benchPut(ctx):
+  latencies = []
+  for entity in ctx["entities"]:
+    t0 = time.time()
+    entity.put()
+    latencies.append(time.time() - t0)
+  return latencies
+
+def benchBatchPut(ctx):
+  latencies = []
+  entities = ctx["entities"]
+  for i in range(0, len(entities), args.batch_size):
+    t0 = time.time()
+    ndb.put_multi(entities[i:i + args.batch_size])
+    latencies.append(time.time() - t0)
+  return latencies
+
+def benchGet(ctx):
+  latencies = []
+  for key in ctx["randomKeys"]:
+    t0 = time.time()
+    BenchEntity.get_by_id(key)
+    latencies.append(time.time() - t0)
+  return latencies
+
+def benchScan(ctx):
+  t0 = time.time()
+  results = BenchEntity.query().fetch()
+  assert len(results) == args.count
+  return [time.time() - t0]
+
+def benchFilteredQuery(ctx):
+  t0 = time.time()
+  BenchEntity.query(BenchEntity.n < args.count / 10, BenchEntity.flag == True).fetch()
+  return [time.time() - t0]
+
+def benchOrderedQuery(ctx):
+  t0 = time.time()
+  BenchEntity.query().order(-BenchEntity.x).fetch()
+  return [time.time() - t0]
+
+# Runs args.threads threads, each doing args.count / args.threads operations: 80% gets and 20% puts of random
+# instances.
+def benchConcurrent(ctx):
+  latencies = []
+  errors = []
+  def run(seed):
+    rng = random.Random(seed)
+    threadLatencies = []
+    try:
+      for j in range(args.count / args.threads):
+        i = rng.randrange(args.count)
+        t0 = time.time()
+        if rng.random() < 0.8:
+          BenchEntity.get_by_id(getKey(i))
+        else:
+          ctx["entities"][i].put()
+        threadLatencies.append(time.time() - t0)
+    except Exception, e:
+      errors.append(e)
+    latencies.extend(threadLatencies)
+  threads = [threading.Thread(target=run, args=[args.seed + t]) for t in range(args.threads)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if errors:
+    raise errors[0]
+  return latencies
+
+# (name, function, number of instances handled by each operation, whether the benchmark needs the datastore).
+benchmarks = [
+  ("encode", benchEncode, 1, False),
+  ("decode", benchDecode, 1, False),
+  ("lazy_decode", benchLazyDecode, 1, False),
+  ("put", benchPut, 1, True),
+  ("batch_put", benchBatchPut, args.batch_size, True),
+  ("get", benchGet, 1, True),
+  ("scan", benchScan, args.count, True),
+  ("filtered_query", benchFilteredQuery, args.count, True),
+  ("ordered_query", benchOrderedQuery, args.count, True),
+  ("concurrent", benchConcurrent, 1, True),
+]
+
+# Returns the q quantile (0 <= q <= 1) of the sorted list values, by nearest rank.
+def percentile(values, q):
+  if not values:
+    return None
+  return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def median(values):
+  return percentile(sorted(values), 0.5)
+
+# Runs a benchmark with warmup and repetitions, and returns its results.
+def runBenchmark(name, function, items, ctx):
+  for i in range(args.warmup):
+    function(ctx)
+  reps = []
+  for i in range(args.repetitions):
+    t0 = time.time()
+    latencies = function(ctx)
+    elapsed = time.time() - t0
+    latencies.sort()
+    reps.append({"ops": len(latencies),
+                 "seconds": elapsed,
+                 "ops_per_sec": len(latencies) / elapsed if elapsed > 0 else None,
+                 "p50": percentile(latencies, 0.5),
+                 "p99": percentile(latencies, 0.99)})
+  result = {"benchmark": name,
+            "items_per_op": items,
+            "ops_per_sec": median([r["ops_per_sec"] for r in reps]),
+            "p50": median([r["p50"] for r in reps]),
+            "p99": median([r["p99"] for r in reps]),
+            "repetitions": reps}
+  if result["ops_per_sec"] is not None:
+    result["items_per_sec"] = result["ops_per_sec"] * items
+  return result
+
+# Returns the disk space used by the files in path. Counts the allocated blocks, since the LMDB map file is sparse.
+def dirSize(path):
+  total = 0
+  for dirpath, dirnames, filenames in os.walk(path):
+    for f in filenames:
+      total += os.stat(os.path.join(dirpath, f)).st_blocks * 512
+  return total
+
+def gitCommit():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=open(os.devnull, "w")).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def formatLatency(seconds):
+  if seconds is None:
+    return "-"
+  return "{0:,.1f} us".format(seconds * 1e6)
+
+# Prints a result line and adds the result to results.
+def report(result):
+  results.append(result)
+  print "%-16s %14s ops/s %14s p50 %14s p99" % (result["benchmark"], "{0:,.0f}".format(result["ops_per_sec"] or 0),
+                                              formatLatency(result["p50"]), formatLatency(result["p99"]))
+
+selected = [b for b in benchmarks if args.benchmarks is None or b[0] in args.benchmarks.split(",")]
+results = []
+random.seed(args.seed)
+ctx = {}
+ctx["entities"] = [getEntity(i) for i in range(args.count)]
+# The instances are encoded once, in the format of a fresh datastore: the first version of the schema (see ndb.Schema)
+# is the same in every datastore.
+ndb.setDatastore(ndb_datastore.MemDatastore())
+ctx["encoded"] = [(e.key, e._encode()[0]) for e in ctx["entities"]]
+ctx["randomKeys"] = [getKey(random.randrange(args.count)) for i in range(args.count)]
+
+encodingBenchmarks = [b for b in selected if not b[3]]
+if encodingBenchmarks:
+  print "================================================"
+  print "Benchmarking encoding"
+for name, function, items, usesDatastore in encodingBenchmarks:
+  report(dict(runBenchmark(name, function, items, ctx), datastore=None))
+ndb.closeDatastore()
+
+for datastoreType in args.datastores.split(","):
+  print "================================================"
+  print "Benchmarking datastore", datastoreType
+  path = os.path.join(args.path, "ndb-bench-" + os.urandom(8).encode("hex"))
+  d = ndb.createDatastore(datastoreType, path)
+  if args.compression != "none":
+    d = ndb_compression.CompressingDatastore(d, args.compression, dictionaries=args.compression_dictionaries)
+  ndb.setDatastore(d)
+  BenchEntity._get_schema().get_current()
+  # The read benchmarks need the instances, whichever benchmarks are selected.
+  ndb.getDatastore().write_batch([("set", BenchEntity.kind(), key, encoded) for key, encoded in ctx["encoded"]])
+  try:
+    for name, function, items, usesDatastore in selected:
+      if usesDatastore:
+        report(dict(runBenchmark(name, function, items, ctx), datastore=datastoreType))
+    print "Disk usage:", "{:,}".format(dirSize(path)), "bytes."
+  finally:
+    ndb.closeDatastore()
+    shutil.rmtree(path, ignore_errors=True)
+
+if args.json is not None:
+  config = dict(vars(args))
+  config["python"] = platform.python_version()
+  config["platform"] = platform.platform()
+  config["commit"] = gitCommit()
+  with open(args.json, "w") as f:
+    json.dump({"config": config, "results": results}, f, indent=2, sort_keys=True)
+  print "Results written to", args.json
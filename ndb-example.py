@@ -18,6 +18,8 @@ class User(ndb.Model):
   isAdmin = ndb.BooleanProperty(required=True, default=False)
   created = ndb.DateTimeProperty(auto_now_add=True)
   updated = ndb.DateTimeProperty(auto_now=True)
+  # Serves the queries on admins below from the index, sorted, instead of scanning and sorting all the users.
+  indexes = [("isAdmin", "-numClicks", "email")]
 
 # Create user john@example.com, who is an admin and plays in beer commercials.
 john = User.get_or_insert("john@example.com", email="john@example.com")
@@ -105,6 +107,11 @@ q = q.order(User.email)
 print "\nUsers, sorted by activity and e-mail:"
 for u in q.iter():
   print u.to_dict()
+# The query is a range scan of the index: no other user is read, and no sorting is done in memory.
+plan = q.explain(analyze=True)
+assert(plan["access"] == "index" and plan["sort"] == "index")
+assert(plan["rowsScanned"] == plan["rowsReturned"])
+print plan
 
 # List all the models in the datastore (i.e. ["Message", "User"])
 print ndb.getDatastore().get_kinds()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+# Datastore export.
+# Writes the objects of the datastore to a file with ndb_export.export_datastore, while the datastore stays usable by
+# other processes (for LevelDB, which allows only one process, run the export from the process using the datastore).
+# The other arguments are passed to ndb to open the datastore.
+# Example: ./ndb-export.py --output backup.ndb --datastore_type lmdb --datastore_path users.db
+
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Exports the objects of an ndb datastore to a file.")
+parser.add_argument("--output", default="-", help="File to write; - for stdout")
+parser.add_argument("--kinds", default=None, help="Comma-separated list of the kinds to export (default: all)")
+parser.add_argument("--processes", type=int, default=None, help="Number of compressing processes (default: number of CPUs)")
+parser.add_argument("--level", type=int, default=6, help="zlib compression level")
+args, ndbArgs = parser.parse_known_args()
+
+sys.argv = [sys.argv[0]] + ndbArgs
+import ndb
+import ndb_export
+
+out = sys.stdout if args.output == "-" else open(args.output, "wb")
+kinds = None if args.kinds is None else args.kinds.split(",")
+counts = ndb_export.export_datastore(ndb.getDatastore(), out, kinds=kinds, level=args.level, processes=args.processes,
+                                     progress=ndb_export.print_progress)
+out.close()
+for kind in sorted(counts):
+  sys.stderr.write("%s: %d objects\n" % (kind, counts[kind]))
+ndb.closeDatastore()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+# Datastore import.
+# Loads a file written by ndb-export.py into the datastore with ndb_export.import_datastore. The other arguments are
+# passed to ndb to open the datastore.
+# Example: ./ndb-import.py --input backup.ndb --datastore_type lmdb --datastore_path restored.db
+
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description="Imports a file written by ndb-export.py into an ndb datastore.")
+parser.add_argument("--input", default="-", help="File to read; - for stdin")
+parser.add_argument("--processes", type=int, default=None, help="Number of decompressing processes (default: number of CPUs)")
+args, ndbArgs = parser.parse_known_args()
+
+sys.argv = [sys.argv[0]] + ndbArgs
+import ndb
+import ndb_export
+
+input = sys.stdin if args.input == "-" else open(args.input, "rb")
+counts = ndb_export.import_datastore(ndb.getDatastore(), input, processes=args.processes,
+                                     progress=ndb_export.print_progress)
+for kind in sorted(counts):
+  sys.stderr.write("%s: %d objects\n" % (kind, counts[kind]))
+ndb.closeDatastore()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+# Bulk loader.
+# Loads instances of a model from a JSON lines file (one object per line with the property values, and the key under
+# "key"), using ndb_bulk.bulk_load. The other arguments are passed to ndb to open the datastore.
+# Example: ./ndb-load.py --model models:User --input users.json --checkpoint users.checkpoint \
+#            --datastore_type lmdb --datastore_path users.db
+
+import argparse
+import gzip
+import importlib
+import json
+import sys
+
+parser = argparse.ArgumentParser(description="Loads instances of a model into an ndb datastore.")
+parser.add_argument("--model", required=True, help="Model to load, as module:class (the module is imported)")
+parser.add_argument("--input", default="-", help="JSON lines file to load, possibly gzipped (.gz); - for stdin")
+parser.add_argument("--processes", type=int, default=None, help="Number of encoding processes (default: number of CPUs)")
+parser.add_argument("--batch_size", type=int, default=10000, help="Number of instances per write")
+parser.add_argument("--checkpoint", default=None, help="Checkpoint file, to resume an interrupted load")
+args, ndbArgs = parser.parse_known_args()
+
+sys.argv = [sys.argv[0]] + ndbArgs
+import ndb
+import ndb_bulk
+
+moduleName, className = args.model.split(":")
+model = getattr(importlib.import_module(moduleName), className)
+
+if args.input == "-":
+  f = sys.stdin
+elif args.input.endswith(".gz"):
+  f = gzip.open(args.input)
+else:
+  f = open(args.input)
+records = (json.loads(line) for line in f if line.strip())
+result = ndb_bulk.bulk_load(model, records, processes=args.processes, batchSize=args.batch_size,
+                            checkpoint=args.checkpoint)
+print "%d records loaded in %.1f seconds." % (result["records"], result["seconds"])
+ndb.closeDatastore()
@@ -5,13 +5,25 @@
 # License: GPLv2
 
 import datetime
+import json
 import math
+import multiprocessing
+import ndb_compression
+import ndb_datastore
+import ndb_datastore_sharded
+import ndb_metrics
 import os
-import profile
 import random
 import shutil
+import StringIO
 import sys
 import threading
+import time
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 def runTest():
   class User(ndb.Model):
@@ -25,6 +37,9 @@ def runTest():
     born = ndb.DateTimeProperty()
     becomesSmart = ndb.DateTimeProperty()
     weight = ndb.FloatProperty(default=75.72)
+    # The persistent datastores are tested with lazily decoded users, and some of them with compact users.
+    lazy_decoding = datastore != "memory"
+    compact = datastore in ["lmdb", "bdb"]
 
 
   class Message(ndb.Model):
@@ -35,6 +50,7 @@ def runTest():
     created = ndb.DateTimeProperty(auto_now_add=True)
     updated = ndb.DateTimeProperty(auto_now=True)
     seed = ndb.IntegerProperty()
+    indexes = [("importance", "-seed")]
 
 
   def getEmail(i):
@@ -184,6 +200,24 @@ def runTest():
     assert checkWeight(i, user.weight)
   print ""
 
+  print "Reading and changing datastore asynchronously"
+  futures = ndb.get_multi_async(User, [getEmail(i) for i in range(n)])
+  futures.append(User.get_by_id_async(getEmail(0)))
+  ndb.wait_all(futures)
+  users = [f.get_result() for f in futures[:n]]
+  for i in range(n):
+    assert users[i].seed == i + 10
+  assert futures[n].get_result().seed == 10
+  assert ndb.get_multi(User, ["nobody@example.com"]) == [None]
+  gotError = False
+  try:
+    User.get_by_id_async("nobody@example.com").get_result()
+  except KeyError:
+    gotError = True
+  assert gotError
+  assert ndb.put_multi(users) == [getEmail(i) for i in range(n)]
+  assert len(User.query().fetch_async(limit=10).get_result()) == 10
+
   print "Querying datastore"
   q = User.query()
   all = [u for u in q.iter()]
@@ -217,6 +251,12 @@ def runTest():
   all = [u for u in q.iter()]
   numFiltered = len(all)
   print "numFiltered =", numFiltered
+  allParallel = [u for u in q.iter_parallel(2, ordered=False, chunkSize=100)]
+  assert sorted([u.seed for u in allParallel]) == sorted([u.seed for u in all])
+  if numpy is not None:
+    columns = q.to_columns([User.seed, User.born])
+    assert sorted(columns["seed"].tolist()) == sorted([u.seed for u in all])
+    assert columns["born"].dtype == numpy.dtype("datetime64[us]")
   all.sort(key=lambda u: u.seed)
   for i in range(n):
     if i % 1000 == 0:
@@ -395,6 +435,44 @@ def runTest():
       assert msg.importance == "urgent"
   print ""
 
+  print "Querying datastore with an index"
+  q = Message.query(Message.importance != "normal", Message.seed >= n / 2).order(-Message.seed)
+  plan = q.explain()
+  assert plan["access"] == "index" and plan["sort"] == "index" and plan["otherFilters"] == []
+  seeds = [msg.seed for msg in q.iter()]
+  assert seeds == sorted([i for i in range(n / 2, n) if i % 7 in (4, 6)], reverse=True)
+  ndb.reset_query_stats()
+  plan = q.explain(analyze=True)
+  assert plan["rowsScanned"] == plan["rowsReturned"] == len(seeds)
+  assert ndb.get_query_stats()[0]["rowsScanned"] == len(seeds)
+  # fetch() stops reading at the limit.
+  batchSize = ndb.IndexQueryIterator.batchSize
+  ndb.IndexQueryIterator.batchSize = 5
+  ndb.reset_query_stats()
+  assert [msg.seed for msg in q.fetch(limit=5)] == seeds[:5]
+  assert ndb.get_query_stats()[0]["rowsScanned"] == 5
+  ndb.IndexQueryIterator.batchSize = batchSize
+  # The indexes sort the values as Python compares them: the same queries return the same results without them.
+  class Scored(ndb.Model):
+    indexes = [("score",), ("flag", "score")]
+    score = ndb.IntegerProperty()
+    flag = ndb.BooleanProperty()
+  class UnindexedScored(ndb.Model):
+    score = ndb.IntegerProperty()
+    flag = ndb.BooleanProperty()
+  def runScored(model, filters, access):
+    q = model.query(*[f(model) for f in filters]).order(model.score)
+    assert q.explain()["access"] == access
+    return [(obj.key, obj.score) for obj in q.fetch()]
+  with ndb.datastore_context({None: ndb_datastore.MemDatastore()}):
+    scores = [None, False, True, -1, 0, 1, 2, 3L]
+    for i in range(len(scores)):
+      Scored("s%d" % i, score=scores[i], flag=[None, False, True][i % 3]).put()
+      UnindexedScored("s%d" % i, score=scores[i], flag=[None, False, True][i % 3]).put()
+    for filters in [[lambda m: m.score >= 1], [lambda m: m.score < True], [lambda m: m.score != False],
+                    [lambda m: m.flag == True, lambda m: m.score > 0], [lambda m: m.flag != False]]:
+      assert sorted(runScored(Scored, filters, "index")) == sorted(runScored(UnindexedScored, filters, "scan"))
+
   print "Changing datastore"
   for j in range(len(messages)):
     if j % 1000 == 0:
@@ -561,6 +639,184 @@ def runTest():
   for t in threads:
     t.join()
 
+  if datastore != "bdb":
+    print "Reading a snapshot while changing datastore"
+    with ndb.snapshot():
+      t = threading.Thread(target=threadFunc2, args=[False, 30])
+      t.start()
+      threadFunc4(20)
+      t.join()
+      threadFunc1(False, 20)
+      gotError = False
+      try:
+        User.get_by_id(getEmail(0)).put()
+      except ValueError:
+        gotError = True
+      assert gotError
+      assert User._get_schema() is ndb.schemaCache[ndb.datastore.get_origin()][User]
+    # The snapshots share the schemas of their datastore.
+    assert [d for d in ndb.schemaCache.keys() if d.get_origin() is not d] == []
+    threadFunc1(False, 30)
+    threadFunc2(False, 20)
+
+  print "Incrementing in transactions, with %d threads" % (nThreads)
+  def increment():
+    user = User.get_by_id(getEmail(1))
+    user.numClicks += 1
+    user.put()
+  def threadFunc5():
+    for i in range(25):
+      ndb.transaction(increment, retries=100)
+  numClicks = User.get_by_id(getEmail(1)).numClicks
+  threads = []
+  for i in range(nThreads):
+    t = threading.Thread(target=threadFunc5)
+    threads.append(t)
+    t.start()
+  for t in threads:
+    t.join()
+  assert User.get_by_id(getEmail(1)).numClicks == numClicks + 25 * nThreads
+  def resetClicks(fail):
+    user = User.get_by_id(getEmail(1))
+    user.numClicks = numClicks
+    user.put()
+    if fail:
+      raise KeyError()
+  gotError = False
+  try:
+    ndb.transaction(lambda: resetClicks(True))
+  except KeyError:
+    gotError = True
+  assert gotError and User.get_by_id(getEmail(1)).numClicks == numClicks + 25 * nThreads
+  ndb.transaction(lambda: resetClicks(False))
+  assert User.get_by_id(getEmail(1)).numClicks == numClicks
+
+  print "Inserting concurrently, with %d threads" % (nThreads)
+  inserted = []
+  def threadFunc6(i):
+    inserted.append(Message.get_or_insert("race", fromEmail=getEmail(i), seed=i).fromEmail)
+  threads = []
+  for i in range(nThreads):
+    t = threading.Thread(target=threadFunc6, args=[i])
+    threads.append(t)
+    t.start()
+  for t in threads:
+    t.join()
+  assert len(set(inserted)) == 1 and Message.get_by_id("race").fromEmail == inserted[0]
+  assert len(Message.query(Message.importance == "normal", Message.seed < nThreads).fetch()) == 1
+  Message.get_by_id("race").delete()
+
+  print "Incrementing counters, with %d threads" % (nThreads)
+  Message("counted", fromEmail=getEmail(1), seed=1000000).put()
+  clicks = ndb.ShardedCounter("clicks", shards=4)
+  def threadFunc7():
+    for i in range(25):
+      User.increment(getEmail(1), User.numClicks)
+      Message.increment("counted", "seed")
+      clicks.increment()
+  threads = []
+  for i in range(nThreads):
+    t = threading.Thread(target=threadFunc7)
+    threads.append(t)
+    t.start()
+  for t in threads:
+    t.join()
+  assert User.get_by_id(getEmail(1)).numClicks == numClicks + 25 * nThreads
+  assert User.increment(getEmail(1), User.numClicks, -25 * nThreads) == numClicks
+  assert [m.key for m in Message.query(Message.importance == "normal", Message.seed == 1000000 + 25 * nThreads).fetch()] == ["counted"]
+  assert clicks.value() == 25 * nThreads
+  clicks.delete()
+  assert clicks.value() == 0
+  Message.get_by_id("counted").delete()
+  gotError = False
+  try:
+    User.increment("missing@example.com", User.numClicks)
+  except KeyError:
+    gotError = True
+  assert gotError
+
+  print "Updating changed properties"
+  user1 = User.get_by_id(getEmail(2))
+  user2 = User.get_by_id(getEmail(2))
+  user1.isAdmin = True
+  user2.weight = 99.5
+  user1.update()
+  user2.update()
+  user = User.get_by_id(getEmail(2))
+  assert user.isAdmin and user.weight == 99.5 and user.description == user1.description
+  assert user.numClicks == user1.numClicks and user.updated > user1.updated
+  user.isAdmin = False
+  user.weight = user1.weight
+  user.update()
+  user = User.get_by_id(getEmail(2))
+  assert not user.isAdmin and user.weight == user1.weight and user.born == user1.born
+  Message("updated", fromEmail=getEmail(1), seed=2000000).update()
+  message = Message.get_by_id("updated")
+  message.seed += 1
+  message.update()
+  assert [m.key for m in Message.query(Message.importance == "normal", Message.seed == 2000001).fetch()] == ["updated"]
+  assert Message.query(Message.importance == "normal", Message.seed == 2000000).fetch() == []
+  message.delete()
+
+  print "Decoding lazily"
+  user = User.get_by_id(getEmail(4))
+  if User.lazy_decoding:
+    assert "born" not in user._get_state() and "born" in user._lazy
+  born = user.born
+  assert "born" in user._get_state() and "born" not in user._get_state().get("_lazy", {})
+  assert hasattr(user, "__dict__") != User.compact
+  user.numClicks += 1
+  user.put()
+  user = User.get_by_id(getEmail(4))
+  assert user.born == born and user.numClicks == user.to_dict()["numClicks"]
+  assert [u.key for u in User.query(User.born == born, User.email == getEmail(4)).fetch()] == [getEmail(4)]
+  user.numClicks -= 1
+  user.put()
+
+  print "Evolving schemas"
+  class Evolving(ndb.Model):
+    name = ndb.StringProperty()
+    size = ndb.IntegerProperty()
+  Evolving("e1", name="first", size=1).put()
+  d = Evolving.get_datastore()
+  # Value stored before the schemas.
+  d.set("Evolving", "e0", json.dumps({"name": json.dumps("legacy"), "size": json.dumps(0)}))
+  class Evolving(ndb.Model):
+    name = ndb.StringProperty()
+    weight = ndb.FloatProperty(default=1.5)
+  Evolving("e2", name="second", weight=2.5).put()
+  assert sorted([(e.key, e.name, e.weight) for e in Evolving.query().fetch()]) == \
+         [("e0", "legacy", 1.5), ("e1", "first", 1.5), ("e2", "second", 2.5)]
+  assert sorted(d.iter(ndb_datastore.schema_kind("Evolving"))) == ["1", "2"]
+  Evolving.get_by_id("e0").put()
+  assert json.loads(d.get("Evolving", "e0")) == [2, "legacy", 1.5]
+  for key in ["e0", "e1", "e2"]:
+    Evolving.get_by_id(key).delete()
+
+  print "Storing large values out of line"
+  class Document(ndb.Model):
+    title = ndb.StringProperty()
+    body = ndb.TextProperty(out_of_line=100, compressed=True)
+    summary = ndb.TextProperty(out_of_line=100)
+  body = getDescription(1000)
+  Document("d1", title="first", body=body, summary="short").put()
+  ndb.put_multi([Document("d2", title="second", body=body), Document("d3", title="third", body="short")])
+  assert Document.get_datastore().get_kind_stats()["__blob__Document"]["count"] == 1
+  document = Document.get_by_id("d1")
+  assert "body" not in document.__dict__ and document.summary == "short"
+  document.title = "first again"
+  document.update()
+  assert document.body == body and Document.get_by_id("d1").title == "first again"
+  assert sorted([d.key for d in Document.query(Document.body == body).fetch()]) == ["d1", "d2"]
+  if numpy is not None:
+    assert sorted(Document.query().to_columns([Document.body])["body"].tolist()) == [body, body, "short"]
+  Document.get_by_id("d2").put()
+  Document.get_by_id("d1").delete()
+  assert Document.collect_blobs() == 0 and Document.get_by_id("d2").body == body
+  Document.get_by_id("d2").delete()
+  assert Document.collect_blobs() == 1
+  Document.get_by_id("d3").delete()
+
   print "Deleting from datastore"
   for i in range(n):
     if i % 1000 == 0:
@@ -595,10 +851,227 @@ def runTest():
     assert checkWeight(i, user.weight)
   print ""
 
+  print "Using several datastores"
+  class ArchivedMessage(ndb.Model):
+    datastore_name = "archive"
+    content = ndb.TextProperty()
+
+  ndb.setDatastore(ndb_datastore.MemDatastore(), "archive")
+  ArchivedMessage(messages[0], content="archived").put()
+  assert ArchivedMessage.get_by_id(messages[0]).content == "archived"
+  assert ndb.getDatastore("archive").get_kinds() == ["ArchivedMessage"]
+  numThreads = threading.active_count()
+  with ndb.datastore_context({"archive": ndb_datastore.MemDatastore()}):
+    assert ndb.get_multi(ArchivedMessage, [messages[0]]) == [None]
+    assert ArchivedMessage.query().fetch_async().get_result() == []
+  # The executor started within the context is stopped on exit.
+  assert threading.active_count() == numThreads
+  assert len(ArchivedMessage.query().fetch()) == 1
+  ndb.closeDatastore("archive")
+
+  print "Batching concurrent operations, with %d threads" % (nThreads)
+  batching = ndb_datastore.AutoBatchingDatastore(ndb_datastore.MemDatastore(), maxBatchSize=8)
+  def threadFunc8(t):
+    for i in range(200):
+      batching.set("Batched", "%d/%d" % (t, i), str(i))
+      assert batching.get("Batched", "%d/%d" % (t, i)) == str(i)
+  threads = [threading.Thread(target=threadFunc8, args=[t]) for t in range(nThreads)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join(30)
+    assert not t.is_alive()
+  assert batching.get_kind_stats()["Batched"]["count"] == 200 * nThreads
+  # Each call sends at most the batch holding its own item, even when batches fail.
+  senders = []
+  def send(items):
+    senders.append(threading.current_thread())
+    time.sleep(0.001)
+    if "fail" in items:
+      raise ValueError("Batch failed")
+    return items
+  batcher = ndb_datastore.AutoBatcher(send, maxBatchSize=4)
+  def threadFunc9(t):
+    for i in range(100):
+      before = senders.count(threading.current_thread())
+      item = "fail" if i % 10 == t else i
+      try:
+        assert batcher.submit(item) == i
+      except ValueError:
+        pass
+      assert senders.count(threading.current_thread()) - before <= 1
+  threads = [threading.Thread(target=threadFunc9, args=[t]) for t in range(nThreads)]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join(30)
+    assert not t.is_alive()
+
+  print "Sharding a datastore"
+  class ShardedMessage(ndb.Model):
+    datastore_name = "archive"
+    seed = ndb.IntegerProperty()
+
+  numThreads = threading.active_count()
+  sharded = ndb_datastore_sharded.ShardedDatastore([ndb_datastore.MemDatastore() for i in range(3)])
+  ndb.setDatastore(sharded, "archive")
+  for i in range(3000):
+    ShardedMessage("s%04d" % i, seed=i).put()
+  assert [s.seed for s in ShardedMessage.query(ShardedMessage.seed < 3).order(ShardedMessage.seed).fetch()] == [0, 1, 2]
+  assert len(ShardedMessage.query().fetch(limit=5)) == 5
+  items = sharded.iter_items("ShardedMessage")
+  items.next()
+  del items
+  values = sharded.get_multi("ShardedMessage", ["s0001", "s2999", "s3000"])
+  assert [v is not None for v in values] == [True, True, False]
+  assert sharded.get_multi("ShardedMessage", []) == []
+  assert sharded.commit([], [])
+  checks = [("ShardedMessage", key, value) for key, value in zip(["s0001", "s2999", "s3000"], values)]
+  assert sharded.commit(checks, [])
+  assert not sharded.commit([("ShardedMessage", "s3000", "changed")], [])
+  ndb.closeDatastore("archive")
+  # The threads reading the shards stop once the iterators are closed or abandoned, and the pool once it is closed.
+  for i in range(50):
+    if threading.active_count() <= numThreads:
+      break
+    time.sleep(0.1)
+  assert threading.active_count() == numThreads
+
+  print "Compressing values"
+  compressing = ndb_compression.CompressingDatastore(ndb_datastore.MemDatastore(), threshold=16, dictionaries=True,
+                                                     samples=10)
+  users = [User.get_by_id(getEmail(i)) for i in range(1, 60) if i % 3 != 0]
+  with ndb.datastore_context({None: compressing}):
+    ndb.put_multi(users)
+    assert [(u.email, u.seed, u.description) for u in users] == \
+           [(u.email, u.seed, u.description) for u in ndb.get_multi(User, [u.key for u in users])]
+    assert User.increment(users[0].key, User.numClicks) == users[0].numClicks + 1
+    snapshot = compressing.snapshot()
+    assert snapshot.get("User", users[-1].key) == compressing.get("User", users[-1].key)
+    snapshot.close()
+  stored = compressing.datastore.get_kind_stats()
+  assert stored["__compression__"]["count"] == 2
+  assert stored["User"]["bytes"] * 2 < sum([len(value) for _, value in compressing.iter_items("User")])
+
+  print "Bulk loading"
+  class LoadedMessage(ndb.Model):
+    datastore_name = "archive"
+    indexes = [("seed",)]
+    seed = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty()
+
+  ndb.setDatastore(ndb_datastore.MemDatastore(), "archive")
+  records = [{"key": "m%04d" % (i % 500), "seed": i, "created": 1000000000 + i} for i in range(600)]
+  result = ndb_bulk.bulk_load(LoadedMessage, records, processes=2, batchSize=200, chunkSize=50, progress=None)
+  assert result["records"] == 600
+  assert LoadedMessage.get_by_id("m0007").seed == 507
+  assert LoadedMessage.get_by_id("m0007").created == datetime.datetime.utcfromtimestamp(1000000507)
+  assert [m.seed for m in LoadedMessage.query(LoadedMessage.seed < 102).order(LoadedMessage.seed).fetch()] == [100, 101]
+  assert len(LoadedMessage.query().fetch()) == 500
+  ndb.closeDatastore("archive")
+
+  print "Recording datastore metrics"
+  registry = ndb_metrics.Metrics()
+  ndb.setDatastore(ndb_metrics.MetricsDatastore(ndb_datastore.MemDatastore(), registry), "archive")
+  ArchivedMessage(messages[0], content="archived").put()
+  assert ArchivedMessage.get_by_id(messages[0]).content == "archived"
+  assert ndb.get_multi(ArchivedMessage, [messages[0], "missing"])[1] is None
+  assert len(ArchivedMessage.query().fetch()) == 1
+  counters = registry.snapshot()["counters"]
+  labels = (("backend", "MemDatastore"), ("kind", "ArchivedMessage"), ("op", "get_multi"))
+  assert counters[("ndb_datastore_hits_total", labels)] == 1
+  assert counters[("ndb_datastore_misses_total", labels)] == 1
+  assert "ndb_datastore_latency_seconds_count" in registry.to_prometheus()
+  registry.enabled = False
+  ArchivedMessage.get_by_id(messages[0])
+  assert registry.snapshot()["counters"] == counters
+  ndb.closeDatastore("archive")
+  # The iterators abandoned by the caller are closed.
+  closed = []
+  def closingItems():
+    try:
+      for i in range(10):
+        yield str(i), "value"
+    finally:
+      closed.append(True)
+  measured = ndb_metrics.MetricsDatastore(ndb_datastore.MemDatastore())._measure_iter("iter_items", "Kind",
+                                                                                       closingItems(), True)
+  measured.next()
+  measured.close()
+  assert closed == [True]
+
+  if not useProfiler:
+    print "Profiling"
+    ndb.profiler.reset()
+    ndb.profiler.enable()
+    user = User.get_by_id(getEmail(1))
+    user.put()
+    assert len(User.query().order(User.weight).fetch(limit=1)) == 1
+    ndb.profiler.disable()
+    profile = ndb.profiler.stats()["User"]
+    for phase in ["key", "validate", "serialize", "decode", "io", "sort"]:
+      assert profile[phase]["calls"] > 0
+    assert "User" in ndb.profiler.report()
+    # update() reports the same phases as put().
+    ndb.profiler.reset()
+    ndb.profiler.enable()
+    user.description = user.description
+    user.update()
+    ndb.profiler.disable()
+    profile = ndb.profiler.stats()["User"]
+    for phase in ["validate", "serialize", "io"]:
+      assert profile[phase]["calls"] > 0
+
   print "Inspecting datastore"
   kinds = ndb.getDatastore().get_kinds()
   kindsRef = ["Message", "User"]
   assert kinds == kindsRef
+  kindStats = ndb.getDatastore().get_kind_stats()
+  assert sorted([kind for kind in kindStats if not ndb_datastore.is_internal_kind(kind)]) == kindsRef
+  assert kindStats["__index__Message__importance,-seed"]["count"] == len(messages)
+  assert kindStats["User"]["count"] == n - len(range(0, n, 3))
+  assert kindStats["Message"]["count"] == len(messages)
+  assert kindStats["User"]["bytes"] > 0
+
+  if datastore != "bdb":
+    print "Exporting datastore"
+    snapshot = ndb.getDatastore().snapshot()
+    Message("snapshot", fromEmail=getEmail(0)).put()
+    assert snapshot.get("Message", "snapshot") is None
+    assert snapshot.get_kind_stats() == kindStats
+    out = StringIO.StringIO()
+    counts = ndb_export.export_datastore(ndb.getDatastore(), out, processes=2, blockSize=10000)
+    snapshot.close()
+    assert counts["Message"] == len(messages) + 1
+    imported = ndb_datastore.MemDatastore()
+    assert ndb_export.import_datastore(imported, StringIO.StringIO(out.getvalue()), processes=1) == counts
+    assert imported.get_kind_stats()["User"]["count"] == kindStats["User"]["count"]
+    gotError = False
+    try:
+      ndb_export.import_datastore(ndb_datastore.MemDatastore(), StringIO.StringIO(out.getvalue()[:-1]), processes=1)
+    except ValueError:
+      gotError = True
+    assert gotError
+    Message.get_by_id("snapshot").delete()
+
+  if datastore == "lmdb":
+    print "Sharing datastore with another process"
+    import ndb_datastore_lmdb
+    def writeShared():
+      other = ndb_datastore_lmdb.LMDBDatastore(path)
+      other.write_batch([("set", "Shared", str(i), i) for i in range(50)])
+      other.close()
+    p = multiprocessing.Process(target=writeShared)
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+    # The counts of the kind catalog are added to the ones stored, so the writes of the other process are kept.
+    ndb.getDatastore().set("Shared", "50", 50)
+    assert ndb.getDatastore().get_kind_stats()["Shared"]["count"] == 51
+    ndb.getDatastore().write_batch([("delete", "Shared", str(i)) for i in range(51)])
+    assert "Shared" not in ndb.getDatastore().get_kind_stats()
 
   print "Test completed."
 
@@ -632,17 +1105,25 @@ for datastore in ["memory", "leveldb", "lmdb", "bdb"]:
   sys.argv = [oldArgv[0],
               "--datastore_type", datastore,
               "--datastore_path", path]
+  # The LevelDB datastore is tested with compressed values.
+  if datastore == "leveldb":
+    sys.argv += ["--datastore_compression", "zlib", "--datastore_compression_dictionaries"]
 
   time1 = (datetime.datetime.now() - datetime.datetime.utcfromtimestamp(0)).total_seconds()
 
   import ndb
+  import ndb_bulk
+  import ndb_export
   if ndb.getDatastore() is None:
     ndb.initDatastoreFromParams()
 
   if useProfiler:
-    profile.run("runTest()")
-  else:
-    runTest()
+    ndb.profiler.reset()
+    ndb.profiler.enable()
+  runTest()
+  if useProfiler:
+    ndb.profiler.disable()
+    ndb.profiler.dump(sys.stdout)
 
   ndb.closeDatastore()
 
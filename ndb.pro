@@ -1,9 +1,18 @@
 OTHER_FILES += \
     ndb-test.py \
     ndb-example.py \
+    ndb-bench.py \
+    ndb-load.py \
+    ndb-export.py \
+    ndb-import.py \
     ndb_datastore_lmdb.py \
     ndb_datastore_leveldb.py \
     ndb_datastore.py \
     ndb.py \
     leveldb.py \
-    ndb_datastore_bdb.py
+    ndb_datastore_bdb.py \
+    ndb_datastore_sharded.py \
+    ndb_metrics.py \
+    ndb_bulk.py \
+    ndb_export.py \
+    ndb_compression.py
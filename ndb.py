@@ -5,11 +5,28 @@
 # License: GPLv2
 
 import argparse
+import base64
+import collections
+import contextlib
 import datetime
+import hashlib
+import heapq
 import inspect
+import itertools
 import json
+import multiprocessing
 import ndb_datastore
+import operator
 import os
+import Queue
+import random
+import signal
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
 
 verbose = False
 
@@ -27,31 +44,160 @@ def log(*args):
     msg += " "
   print msg
 
-# Global value holding the datastore.
+# Global value holding the default datastore.
 datastore = None
 
-# Initializes and opens the datastore.
-# Only one datastore can be open at a time.
-def setDatastore(d):
+# Open datastores, by name. The default datastore is registered with the name None.
+datastores = {}
+
+# Datastores registered for the current thread with datastore_context(), as a stack of dictionaries.
+context = threading.local()
+
+# Initializes and opens a datastore, registering it with the given name.
+# Models use the default datastore (name None) unless they set datastore_name. Only one datastore can be open with a
+# given name at a time.
+def setDatastore(d, name=None):
   global datastore
-  if datastore is not None:
+  if name in datastores:
     raise ValueError("The datastore can be opened only once")
     return
-  log("Opening specified datastore")
-  datastore = d
+  log("Opening specified datastore", name)
+  datastores[name] = d
+  if name is None:
+    datastore = d
 
-# Closes the datastore.
-def closeDatastore():
+# Closes the datastore with the given name.
+def closeDatastore(name=None):
   global datastore
-  if datastore is not None:
-    log("Closing datastore")
-    datastore.close()
-  datastore = None
-
-# Returns the datastore.
-def getDatastore():
-  global datastore
-  return datastore
+  d = datastores.pop(name, None)
+  if d is not None:
+    log("Closing datastore", name)
+    d.stop_executor()
+    d.close()
+  if name is None:
+    datastore = None
+
+# Closes all the open datastores.
+def closeDatastores():
+  for name in datastores.keys():
+    closeDatastore(name)
+
+# Returns the datastore with the given name, or None if there is none.
+# Datastores registered with datastore_context() in the current thread take precedence over the global ones.
+def getDatastore(name=None):
+  for registry in reversed(getattr(context, "stack", [])):
+    if name in registry:
+      return registry[name]
+  return datastores.get(name)
+
+# Context manager registering the datastores in the dictionary registry (name -> datastore) for the current thread
+# only, e.g. to run tests in parallel in one process:
+# with ndb.datastore_context({None: ndb_datastore.MemDatastore()}):
+#   ...
+# The datastores are not closed on exit, but the executors started for them within the context (by the asynchronous
+# API) are stopped, once their pending operations have completed.
+@contextlib.contextmanager
+def datastore_context(registry):
+  if not hasattr(context, "stack"):
+    context.stack = []
+  idle = [d for d in registry.values() if getattr(d, "executor", None) is None]
+  context.stack.append(registry)
+  try:
+    yield
+  finally:
+    context.stack.pop()
+    for d in idle:
+      d.stop_executor()
+
+# Returns a function calling function with the datastore context of the current thread. Used to run functions on other
+# threads.
+def _bind_context(function):
+  stack = list(getattr(context, "stack", []))
+  def bound(*args):
+    oldStack = getattr(context, "stack", [])
+    context.stack = stack
+    try:
+      return function(*args)
+    finally:
+      context.stack = oldStack
+  return bound
+
+# Context manager running the reads of the current thread on snapshots of the datastores with the given names (by
+# default, the default datastore), so that they all see the datastores as they were when the context was entered, e.g.
+# with ndb.snapshot():
+#   users = User.query(User.isAdmin == True).fetch()
+#   messages = ndb.get_multi(Message, [user.lastMessage for user in users])
+# The writes of the other threads are not blocked, and are not seen. Writing to these datastores within the context
+# raises a ValueError. The snapshots are closed on exit. See also the snapshot option of Query.
+@contextlib.contextmanager
+def snapshot(*names):
+  if not names:
+    names = [None]
+  registry = {}
+  try:
+    for name in names:
+      d = getDatastore(name)
+      if d is None:
+        raise ValueError("No datastore open with name %r" % name)
+      registry[name] = d.snapshot()
+    with datastore_context(registry):
+      yield
+  finally:
+    for d in registry.values():
+      d.stop_executor()
+      d.close()
+
+# Raised by transaction() when a transaction still conflicts with other writes after all its retries.
+class TransactionFailedError(Exception):
+  pass
+
+# Runs function() in a transaction on the datastore with the given name (by default, the default datastore), and
+# returns its result. E.g. to increment a counter without losing the concurrent increments:
+# def increment():
+#   user = User.get_by_id(email)
+#   user.numClicks += 1
+#   user.put()
+# ndb.transaction(increment)
+# The transaction is optimistic (see ndb_datastore.TransactionDatastore): the instances read are not locked, the writes
+# are applied at the end, atomically and only if none of the instances read has been changed meanwhile by another
+# thread or process. Otherwise the writes are discarded and function is run again, up to retries times, after a
+# random delay; then TransactionFailedError is raised. function must therefore not have other side effects. If it
+# raises an exception, the writes are discarded and the exception is passed on.
+# Only the instances read by key (get_by_id, get_multi...) are part of the transaction: the queries read the datastore
+# without the writes of the transaction, and the changes of their results are not detected. A transaction started
+# within another one joins it.
+def transaction(function, retries=3, name=None):
+  d = getDatastore(name)
+  if d is None:
+    raise ValueError("No datastore open with name %r" % name)
+  if isinstance(d, ndb_datastore.TransactionDatastore):
+    return function()
+  for attempt in range(retries + 1):
+    t = ndb_datastore.TransactionDatastore(d)
+    with datastore_context({name: t}):
+      result = function()
+    # The index locks keep the plain writes of the instances from interleaving with the commit (see Model._write).
+    with _index_locks(t.written_keys()):
+      if t.commit_transaction():
+        return result
+    if attempt < retries:
+      time.sleep(random.uniform(0, min(0.1, 0.001 * 2 ** attempt)))
+  raise TransactionFailedError("The transaction still conflicts after %d retries" % retries)
+
+# Returns a new datastore of the given type ("leveldb", "lmdb", "bdb" or "memory") stored in path.
+def createDatastore(datastoreType, path):
+  if datastoreType == "leveldb":
+    import ndb_datastore_leveldb
+    return ndb_datastore_leveldb.LevelDBDatastore(path)
+  elif datastoreType == "lmdb":
+    import ndb_datastore_lmdb
+    return ndb_datastore_lmdb.LMDBDatastore(path)
+  elif datastoreType == "bdb":
+    import ndb_datastore_bdb
+    return ndb_datastore_bdb.BDBDatastore(path)
+  elif datastoreType == "memory":
+    return ndb_datastore.MemDatastore()
+  raise ValueError("Bad datastore type in CLI args")
 
 def initDatastoreFromParams():
   global verbose
@@ -59,21 +205,62 @@ def initDatastoreFromParams():
   parser.add_argument("--datastore_type", choices=["leveldb", "lmdb", "bdb", "memory"], default="leveldb", help="Which datastore implementation to use")
   parser.add_argument("--datastore_path", default="datastore.db", help="Path to a directory used to store the datastore files")
   parser.add_argument("--datastore_verbose", default=False, help="Log datastore actions and errors to standard output")
+  parser.add_argument("--datastore_shards", type=int, default=1, help="Spread the data over this many datastores, stored in subdirectories of the datastore path")
+  parser.add_argument("--datastore_compression", choices=["none", "zlib", "snappy", "lz4"], default="none", help="Compress the stored values with this codec (see ndb_compression)")
+  parser.add_argument("--datastore_compression_threshold", type=int, default=128, help="Size in bytes below which the values are not compressed")
+  parser.add_argument("--datastore_compression_dictionaries", action="store_true", help="Compress the values of each kind with a dictionary built from its first values")
+  parser.add_argument("--datastore_autobatch", type=int, default=0, help="Coalesce the point operations issued concurrently by several threads into batches of up to this size (0 disables batching)")
+  parser.add_argument("--datastore_autobatch_latency", type=float, default=0.0, help="Time in seconds to wait for more operations before sending a batch")
+  parser.add_argument("--datastore_metrics", action="store_true", help="Record the count, latency and size of the datastore calls in ndb_metrics.metrics")
+  parser.add_argument("--datastore_profile", action="store_true", help="Enable the phase profiler (ndb.profiler) from the start; send SIGUSR1 to print its report")
   args = parser.parse_args()
   verbose = args.datastore_verbose
-  if args.datastore_type == "leveldb":
-    import ndb_datastore_leveldb
-    setDatastore(ndb_datastore_leveldb.LevelDBDatastore(args.datastore_path))
-  elif args.datastore_type == "lmdb":
-    import ndb_datastore_lmdb
-    setDatastore(ndb_datastore_lmdb.LMDBDatastore(args.datastore_path))
-  elif args.datastore_type == "bdb":
-    import ndb_datastore_bdb
-    setDatastore(ndb_datastore_bdb.BDBDatastore(args.datastore_path))
-  elif args.datastore_type == "memory":
-    setDatastore(ndb_datastore.MemDatastore())
+  if args.datastore_shards > 1:
+    import ndb_datastore_sharded
+    if not os.path.isdir(args.datastore_path):
+      os.makedirs(args.datastore_path)
+    shards = []
+    for i in range(args.datastore_shards):
+      shards.append(createDatastore(args.datastore_type, os.path.join(args.datastore_path, "shard-%d" % i)))
+    d = ndb_datastore_sharded.ShardedDatastore(shards, args.datastore_path)
   else:
-    raise ValueError("Bad datastore type in CLI args")
+    d = createDatastore(args.datastore_type, args.datastore_path)
+  if args.datastore_compression != "none":
+    import ndb_compression
+    d = ndb_compression.CompressingDatastore(d, args.datastore_compression, args.datastore_compression_threshold,
+                                             dictionaries=args.datastore_compression_dictionaries)
+  if args.datastore_autobatch > 0:
+    d = ndb_datastore.AutoBatchingDatastore(d, args.datastore_autobatch, args.datastore_autobatch_latency)
+  if args.datastore_metrics:
+    import ndb_metrics
+    d = ndb_metrics.MetricsDatastore(d)
+  if args.datastore_profile:
+    profiler.enable()
+    profiler.dump_on_signal()
+  setDatastore(d)
+
+# Marks the missing attributes.
+_missing = object()
+
+# Metaclass of the models. Gives the compact models (see Model.compact) a __slots__ attribute with a slot per property,
+# named slotPrefix followed by the name of the property, and slots for the key and the internal state of the instances.
+class ModelType(type):
+  slotPrefix = "_v_"
+  stateSlots = ("key", "_dirty", "_lazy", "_datastore")
+
+  def __new__(mcs, name, bases, attrs):
+    compact = attrs.get("compact", any(getattr(base, "compact", False) for base in bases))
+    if not compact:
+      return type.__new__(mcs, name, bases, attrs)
+    names = [k for k in attrs if isinstance(attrs[k], Property)]
+    slots = [mcs.slotPrefix + k for k in names]
+    slots += [k for k in mcs.stateSlots if not any(hasattr(base, k) for base in bases)]
+    attrs["__slots__"] = tuple(slots)
+    cls = type.__new__(mcs, name, bases, attrs)
+    for k in names:
+      attrs[k].name = k
+      attrs[k].slot = cls.__dict__[mcs.slotPrefix + k]
+    return cls
 
 # Class used to define and store objects. Analogous to an SQL table.
 # Derive this class to create a model.
@@ -83,58 +270,289 @@ def initDatastoreFromParams():
 # native Python values of the properties. E.g. if UserModel.email is a StringProperty, userModel.email is a Python
 # string (str or unicode).
 # The key must be a non-empty string (str or unicode).
-class Model:
+# Set datastore_name in the derived class to store its instances in a datastore other than the default one (see
+# setDatastore).
+# Set indexes in the derived class to declare composite indexes, used by the queries filtering or sorting on their
+# properties. Each index is a tuple of property names, where a "-" in front of a name makes the column descending, e.g.
+# indexes = [("isAdmin", "-numClicks", "email")]. See Index below.
+# Large TextProperty and BlobProperty values can be stored out of line, in separate records loaded on first access
+# (see TextProperty).
+# Set lazy_decoding to True in the derived class to decode the property values of the instances read from the
+# datastore on first access only: an instance keeps the stored values, and each one is decoded and validated when the
+# property is first read. This saves most of the decoding when only a few properties of wide instances are used. The
+# stored values of the properties that were not read are written back as is by put().
+# Set compact to True in the derived class to store the instances in slots (see ModelType) instead of an instance
+# dictionary, which takes several times less memory, e.g. for queries fetching many instances. Reading a property is a
+# little slower, the properties that are not set read as None, and the instances cannot have other attributes.
+class Model(object):
+  __metaclass__ = ModelType
+  __slots__ = ()
+  datastore_name = None
+  indexes = []
+  lazy_decoding = False
+  compact = False
+
   # Creates a Model instance with an optional key, and an optional list of initializers for the properties.
   def __init__(self, key=None, **kwds):
     self.key = key
-    for k in kwds:
-      self.__dict__[k] = kwds[k]
-    pass
+    if self.compact:
+      for k in kwds:
+        self._set_value(k, kwds[k])
+    else:
+      for k in kwds:
+        self.__dict__[k] = kwds[k]
+
+  # Records the properties changed since the instance was read from the datastore or stored, in the set _dirty (see
+  # update). Instances created otherwise have no _dirty set: all their properties count as changed.
+  def __setattr__(self, name, value):
+    if isinstance(self.__class__.__dict__.get(name), Property):
+      self._set_value(name, value)
+      dirty = getattr(self, "_dirty", None)
+      if dirty is not None:
+        dirty.add(name)
+      lazy = getattr(self, "_lazy", None)
+      if lazy:
+        lazy.pop(name, None)
+    else:
+      object.__setattr__(self, name, value)
+
+  # Sets the value of the property name, without recording the change.
+  def _set_value(self, name, value):
+    if self.compact:
+      property = self.__class__.__dict__.get(name)
+      if isinstance(property, Property):
+        property.slot.__set__(self, value)
+      else:
+        object.__setattr__(self, name, value)
+    else:
+      self.__dict__[name] = value
+
+  # Returns a dictionary with the attributes of the instance (the key, the values of the properties that are set, and
+  # the internal state), which restores it with _set_state.
+  def _get_state(self):
+    if not self.compact:
+      return self.__dict__
+    state = {}
+    for c in self.__class__.__mro__:
+      for slot in c.__dict__.get("__slots__", ()):
+        v = getattr(self, slot, _missing)
+        if v is not _missing:
+          state[slot[len(ModelType.slotPrefix):] if slot.startswith(ModelType.slotPrefix) else slot] = v
+    return state
+
+  # Sets the attributes of the instance from state, as returned by _get_state.
+  def _set_state(self, state):
+    for k in state:
+      self._set_value(k, state[k])
+
+  # Returns the value of the property name, or None if it is not set. The values not decoded yet (see lazy_decoding)
+  # are decoded on first access. Values stored out of line are loaded on first access from the datastore the instance
+  # was read from, which must still be open (snapshots included).
+  def _get_value(self, name):
+    if self.compact:
+      try:
+        return self.__class__.__dict__[name].slot.__get__(self)
+      except AttributeError:
+        pass
+    elif name in self.__dict__:
+      return self.__dict__[name]
+    lazy = getattr(self, "_lazy", None)
+    if not lazy or name not in lazy:
+      return None
+    stored = lazy[name]
+    property = self.__class__.__dict__[name]
+    if isinstance(stored, dict):
+      d = getattr(self, "_datastore", None) or self.get_datastore()
+      t = profiler.start()
+      record = d.get(ndb_datastore.blob_kind(self.kind()), stored["blob"])
+      profiler.stop(self.kind(), "io", t)
+      if record is None:
+        raise KeyError("Missing out-of-line value of property %s" % name)
+      t = profiler.start()
+      value = property._from_datastore(_decode_blob(record))
+    else:
+      t = profiler.start()
+      value = property._from_json(stored)
+    profiler.stop(self.kind(), "decode", t)
+    self._set_value(name, value)
+    lazy.pop(name, None)
+    return value
 
+  # Returns the datastore used by this model.
   @classmethod
   def get_datastore(cls):
-    return getDatastore()
+    d = getDatastore(cls.datastore_name)
+    if d is None:
+      raise ValueError("No datastore open for model %s" % cls.__name__)
+    return d
 
   # Returns the model instance for the given key if it exists, or raises a KeyError otherwise.
   @classmethod
   def get_by_id(cls, key):
     if not key:
       raise ValueError("Empty or missing key for model instance")
+    t = profiler.start()
     encoded = cls.get_datastore().get(cls.__name__, key)
+    profiler.stop(cls.kind(), "io", t)
     if encoded is None:
       raise KeyError("No model instance found for given key")
-    dict = json.loads(encoded)
+    return cls._from_encoded(key, encoded)
+
+  # Asynchronous version of get_by_id(). Returns a Future whose result is the model instance.
+  # Gets queued at the same time are sent to the datastore as a single batch.
+  @classmethod
+  def get_by_id_async(cls, key):
+    if not key:
+      raise ValueError("Empty or missing key for model instance")
+    def decode(encoded):
+      if encoded is None:
+        raise KeyError("No model instance found for given key")
+      return cls._from_encoded(key, encoded)
+    return cls.get_datastore().get_executor().get(cls.__name__, key).chain(decode)
+
+  # Returns the model instance for the given key, decoded from the value stored in the datastore. The values stored
+  # out of line, and all the values if lazy_decoding is set, are decoded on first access (see _get_value). The values
+  # stored out of line are loaded from datastore, by default the datastore of the model.
+  @classmethod
+  def _from_encoded(cls, key, encoded, datastore=None):
+    t = profiler.start()
+    lazy = {}
+    obj = cls(key, **cls._decode(encoded, lazy))
+    obj._dirty = set()
+    if lazy:
+      obj._lazy = lazy
+      if datastore is not None:
+        obj._datastore = datastore
+    profiler.stop(cls.kind(), "decode", t)
+    return obj
+
+  # Returns a dictionary with the property values decoded from the value stored in the datastore. The values stored out
+  # of line are left out; if lazy is a dictionary, their references ({"blob": key}) are added to it by property name,
+  # and so are the stored values of all the other properties if lazy_decoding is set, instead of being decoded.
+  @classmethod
+  def _decode(cls, encoded, lazy=None):
+    stored = cls._get_schema().decode(encoded)
     kwds = {}
     for k in cls.__dict__:
       if isinstance(cls.__dict__[k], Property):
         v = None
-        if k in dict:
-          v = dict[k]
-        v = cls.__dict__[k]._from_datastore(v)
+        if k in stored:
+          v = stored[k]
+        if isinstance(v, dict) or (cls.lazy_decoding and lazy is not None):
+          if lazy is not None:
+            lazy[k] = v
+          continue
+        v = cls.__dict__[k]._from_json(v)
         kwds[k] = v
-    return cls(key, **kwds)
+    return kwds
+
+  # Returns the Schema of the instances of the model stored in its datastore. The snapshots, transactions and other
+  # wrappers of a datastore share the Schema of the live datastore (see Datastore.get_origin): the versions are never
+  # changed once stored, so those of the live datastore decode the values read from its snapshots.
+  @classmethod
+  def _get_schema(cls):
+    d = cls.get_datastore().get_origin()
+    schema = schemaCache.get(d, {}).get(cls)
+    if schema is None:
+      with schemaLock:
+        schemas = schemaCache.get(d)
+        if schemas is None:
+          schemas = schemaCache[d] = {}
+        schema = schemas.get(cls)
+        if schema is None:
+          schema = schemas[cls] = Schema(cls, d)
+    return schema
 
   # Returns the model instance for the given key if it exists, or creates a new one, initializes the properties
   # using the provided property_initializers, and returns it.
+  # An existing instance costs a single read. A missing one is inserted with an atomic datastore operation (see
+  # Datastore.get_or_insert), so that concurrent calls all return the same instance, and is returned as stored, without
+  # reading it back.
   @classmethod
   def get_or_insert(cls, key, **property_initializers):
-    try:
-      return cls.get_by_id(key)
-    except KeyError:
-      obj = cls(key)
-      for k in property_initializers:
-        v = property_initializers[k]
-        if k in cls.__dict__ and isinstance(cls.__dict__[k], Property):
-          cls.__dict__[k].name = k
-          obj.__dict__[k] = v
-      obj.put()
-      return cls.get_by_id(key)
+    if not key:
+      raise ValueError("Empty or missing key for model instance")
+    d = cls.get_datastore()
+    kind = cls.kind()
+    t = profiler.start()
+    old = d.get(kind, key)
+    profiler.stop(kind, "io", t)
+    if old is not None:
+      return cls._from_encoded(key, old)
+    obj = cls(key)
+    for k in property_initializers:
+      v = property_initializers[k]
+      if k in cls.__dict__ and isinstance(cls.__dict__[k], Property):
+        cls.__dict__[k].name = k
+        obj._set_value(k, v)
+    encoded, blobs = obj._encode()
+    t = profiler.start()
+    ops = _blob_ops(d, kind, blobs)
+    if cls._get_indexes():
+      with _index_lock(kind, key):
+        old = d.get_or_insert(kind, key, encoded, ops + cls._index_ops(key, None, encoded))
+    else:
+      old = d.get_or_insert(kind, key, encoded, ops)
+    profiler.stop(kind, "io", t)
+    return cls._from_encoded(key, encoded if old is None else old)
+
+  # Adds delta to the number property prop (a property of the model, or its name) of the instance with the given key,
+  # and returns the new value. Raises a KeyError if the instance does not exist.
+  # Atomic, so that concurrent increments are never lost, and cheaper than get_by_id() and put(): the datastore updates
+  # the stored value in place (see _modify), without decoding, validating and encoding the instance (only its JSON
+  # record is rewritten). The validator, choices and auto_now properties are therefore not applied. For counters
+  # incremented by many concurrent writers, see ShardedCounter.
+  @classmethod
+  def increment(cls, key, prop, delta=1):
+    if not key:
+      raise ValueError("Empty or missing key for model instance")
+    name = prop
+    if isinstance(prop, Property):
+      name = Query(cls)._property_name(prop)
+    if not isinstance(cls.__dict__.get(name), (IntegerProperty, FloatProperty)):
+      raise ValueError("%s has no number property %s" % (cls.__name__, name))
+    schema = cls._get_schema()
+    numbers = []
+    def add(encoded):
+      values = schema.decode(encoded)
+      number = (values.get(name) or 0) + delta
+      values[name] = number
+      numbers.append(number)
+      return schema.encode(values)
+    t = profiler.start()
+    encoded = cls._modify(key, [name], add)
+    profiler.stop(cls.kind(), "io", t)
+    if encoded is None:
+      raise KeyError("No model instance found for given key")
+    return numbers[-1]
+
+  # Replaces the stored value of the instance with the given key by function(stored value) atomically (see
+  # Datastore.modify), and returns the new value, or None if the instance does not exist. names are the properties
+  # changed by function: if one of them is a column of an index, the instance is read and rewritten along with its index
+  # records, under the index lock.
+  @classmethod
+  def _modify(cls, key, names, function):
+    d = cls.get_datastore()
+    kind = cls.kind()
+    # function encodes with the current schema version, which must not be created while the datastore is locked.
+    cls._get_schema().get_current()
+    columns = set([name for index in cls._get_indexes() for name, _, _ in index.columns])
+    if not columns.intersection(names):
+      return d.modify(kind, key, function)
+    with _index_lock(kind, key):
+      old = d.get(kind, key)
+      if old is None:
+        return None
+      encoded = function(old)
+      d.write_batch(cls._index_ops(key, old, encoded) + [("set", kind, key, encoded)])
+    return encoded
 
   # Returns a Query object that can be used to iterate over the existing instances for this model.
-  # Filters are optional and filters can also be added to the Query object afterwards.
+  # Filters are optional and filters can also be added to the Query object afterwards. The options are passed to Query
+  # (e.g. snapshot).
   @classmethod
-  def query(cls, *filters):
-    q = Query(cls)
+  def query(cls, *filters, **options):
+    q = Query(cls, **options)
     for f in filters:
       q = q.filter(f)
     return q
@@ -150,18 +568,208 @@ class Model:
 
   # Stores this model instance in the datastore, and returns the key.
   def put(self):
+    encoded, blobs = self._encode()
+    self._write(encoded, blobs)
+    return self.key
+
+  # Stores the properties of this instance changed since it was read from the datastore or stored, leaving the others
+  # as stored, and returns the key. Only the changed properties (and the auto_now ones) are validated and encoded, and
+  # they are merged into the stored value atomically (see _modify), so small changes to large instances are much
+  # cheaper than with put(), and concurrent updates of different properties are all kept. Raises a KeyError if the
+  # instance does not exist anymore. Instances that were not read from the datastore are stored with put().
+  def update(self):
+    dirty = getattr(self, "_dirty", None)
+    if dirty is None:
+      return self.put()
+    cls = self.__class__
+    kind = self.kind()
+    t = profiler.start()
+    values = {}
+    for k in cls.__dict__:
+      property = cls.__dict__[k]
+      if isinstance(property, Property) and (k in dirty or (isinstance(property, DateTimeProperty) and property.auto_now)):
+        property.name = k
+        values[k] = property.validate(self._get_value(k))
+    t = profiler.stop(kind, "validate", t)
+    # Timed as "serialize", as by put().
+    fields = dict([(k, cls.__dict__[k]._to_json(values[k])) for k in values])
+    blobs = cls._store_out_of_line(fields)
+    t = profiler.stop(kind, "serialize", t)
+    ops = _blob_ops(self.get_datastore(), kind, blobs)
+    if ops:
+      self.get_datastore().write_batch(ops)
+    schema = cls._get_schema()
+    if cls._modify(self.key, fields.keys(), lambda encoded: _merge_fields(schema, encoded, fields)) is None:
+      raise KeyError("No model instance found for given key")
+    profiler.stop(kind, "io", t)
+    dirty.clear()
+    return self.key
+
+  # Validates this instance, generates its key if missing, and returns the value to store in the datastore, along with
+  # the records of the values stored out of line, as a dictionary by key. The instance then counts as unchanged for
+  # update().
+  def _encode(self):
+    t = profiler.start()
     if not self.key:
       self.key = self.generateKey()
-    self.get_datastore().set(self.kind(), self.key, json.dumps(self._to_dict_datastore()))
-    return self.key
+    profiler.stop(self.kind(), "key", t)
+    dict = self._to_dict_datastore()
+    t = profiler.start()
+    blobs = self._store_out_of_line(dict)
+    encoded = self._get_schema().encode(dict)
+    profiler.stop(self.kind(), "serialize", t)
+    self._dirty = set()
+    return encoded, blobs
+
+  # Replaces the values of values (a dictionary by property name, see Property._to_json) to store out of line by
+  # references to their records, and returns the records, as a dictionary by key.
+  @classmethod
+  def _store_out_of_line(cls, values):
+    blobs = {}
+    for k in cls._get_out_of_line_properties():
+      v = values.get(k)
+      property = cls.__dict__[k]
+      if isinstance(v, basestring) and len(v) + 2 > property.out_of_line:
+        encoded = json.dumps(v)
+        if len(encoded) > property.out_of_line:
+          blobKey = hashlib.sha1(encoded).hexdigest()
+          blobs[blobKey] = _encode_blob(encoded, property.compressed)
+          values[k] = {"blob": blobKey}
+    return blobs
+
+  # Returns the names of the properties of the model with values stored out of line.
+  @classmethod
+  def _get_out_of_line_properties(cls):
+    names = outOfLineCache.get(cls)
+    if names is None:
+      names = [k for k in cls.__dict__ if isinstance(cls.__dict__[k], TextProperty) and
+               cls.__dict__[k].out_of_line is not None]
+      outOfLineCache[cls] = names
+    return names
+
+  # Deletes the records of the values stored out of line that no instance of the model uses anymore, and returns their
+  # number. They are left behind when the instances are changed or deleted, since other instances may share them. Must
+  # not run concurrently with writes to the model.
+  @classmethod
+  def collect_blobs(cls, batchSize=1000):
+    d = cls.get_datastore()
+    kind = ndb_datastore.blob_kind(cls.kind())
+    schema = cls._get_schema()
+    used = set()
+    for _, encoded in d.iter_items(cls.kind()):
+      for v in schema.decode(encoded).values():
+        if isinstance(v, dict):
+          used.add(v["blob"])
+    unused = [key for key in d.iter(kind) if key not in used]
+    for i in range(0, len(unused), batchSize):
+      d.write_batch([("delete", kind, key) for key in unused[i:i + batchSize]])
+    return len(unused)
+
+  # Asynchronous version of put(). Returns a Future whose result is the key.
+  # The instance is validated right away; puts queued at the same time are written to the datastore as a single batch.
+  # Instances of models with indexes, or with values stored out of line, are written one at a time, since their index
+  # records depend on the stored value.
+  def put_async(self):
+    encoded, blobs = self._encode()
+    key = self.key
+    executor = self.get_datastore().get_executor()
+    if self._get_indexes() or blobs:
+      return executor.call(_bind_context(self._write), encoded, blobs).chain(lambda _: key)
+    return executor.write(("set", self.kind(), key, encoded)).chain(lambda _: key)
 
   # Deletes this model instance from the datastore.
   def delete(self):
     if not self.key:
       raise KeyError("Cannot delete model instance without a key")
-    self.get_datastore().delete(self.kind(), self.key)
+    self._write(None)
     return self.key
 
+  # Asynchronous version of delete(). Returns a Future whose result is the key.
+  def delete_async(self):
+    if not self.key:
+      raise KeyError("Cannot delete model instance without a key")
+    key = self.key
+    executor = self.get_datastore().get_executor()
+    if self._get_indexes():
+      return executor.call(_bind_context(self._write), None).chain(lambda _: key)
+    return executor.write(("delete", self.kind(), key)).chain(lambda _: key)
+
+  # Writes the value of this instance to the datastore, or deletes it if encoded is None.
+  # If the model has indexes, the previous value is read to find the index records to replace, and the instance is
+  # written along with its index records in a single batch.
+  # The records of the values stored out of line (blobs, see _encode) that are not stored yet are written in the same
+  # batch.
+  def _write(self, encoded, blobs=None):
+    d = self.get_datastore()
+    kind = self.kind()
+    t = profiler.start()
+    blobOps = _blob_ops(d, kind, blobs)
+    if not self._get_indexes():
+      if encoded is None:
+        d.delete(kind, self.key)
+      elif blobOps:
+        d.write_batch(blobOps + [("set", kind, self.key, encoded)])
+      else:
+        d.set(kind, self.key, encoded)
+      profiler.stop(kind, "io", t)
+      return
+    with _index_lock(kind, self.key):
+      old = d.get(kind, self.key)
+      t = profiler.stop(kind, "io", t)
+      ops = blobOps + self._index_ops(self.key, old, encoded)
+      t = profiler.stop(kind, "key", t)
+      if encoded is None:
+        ops.append(("delete", kind, self.key))
+      else:
+        ops.append(("set", kind, self.key, encoded))
+      d.write_batch(ops)
+      profiler.stop(kind, "io", t)
+
+  # Returns the list of Index objects declared by the model.
+  @classmethod
+  def _get_indexes(cls):
+    indexes = indexCache.get(cls)
+    if indexes is None:
+      indexes = [Index(cls, columns) for columns in cls.__dict__.get("indexes", [])]
+      indexCache[cls] = indexes
+    return indexes
+
+  # Returns the write operations updating the indexes when the stored value of the instance with the given key changes
+  # from oldEncoded to newEncoded (None meaning that the instance does not exist).
+  @classmethod
+  def _index_ops(cls, key, oldEncoded, newEncoded):
+    oldValues = None if oldEncoded is None else cls._decode(oldEncoded)
+    newValues = None if newEncoded is None else cls._decode(newEncoded)
+    ops = []
+    for index in cls._get_indexes():
+      oldRow = None if oldValues is None else index.row_key(key, oldValues)
+      newRow = None if newValues is None else index.row_key(key, newValues)
+      if oldRow == newRow:
+        continue
+      if oldRow is not None:
+        ops.append(("delete", index.kind, oldRow))
+      if newRow is not None:
+        ops.append(("set", index.kind, newRow, key))
+    return ops
+
+  # Rebuilds the indexes of this model from the stored instances, e.g. after adding an index to a model that already
+  # has instances. Must not run concurrently with writes to the model.
+  @classmethod
+  def build_indexes(cls, batchSize=1000):
+    d = cls.get_datastore()
+    for index in cls._get_indexes():
+      rows = list(d.iter(index.kind))
+      for i in range(0, len(rows), batchSize):
+        d.write_batch([("delete", index.kind, row) for row in rows[i:i + batchSize]])
+    keys = list(d.iter(cls.kind()))
+    for i in range(0, len(keys), batchSize):
+      batch = keys[i:i + batchSize]
+      ops = []
+      for key, encoded in zip(batch, d.get_multi(cls.kind(), batch)):
+        if encoded is not None:
+          ops.extend(cls._index_ops(key, None, encoded))
+      d.write_batch(ops)
+
   # Returns a Python dictionary containing the property values of this model instance.
   # Use include or exclude (lists of properties) to restrict the properties that are returned.
   def to_dict(self, include=None, exclude=None):
@@ -174,29 +782,649 @@ class Model:
         if exclude is not None:
           if self.__class__.__dict__[k] in exclude:
             continue
-        v = None
-        if k in self.__dict__:
-          v = self.__dict__[k]
+        v = self._get_value(k)
         self.__class__.__dict__[k].name = k
         v = self.__class__.__dict__[k].validate(v)
         dict[k] = v
     return dict
 
-  # Returns a dictionary used to store this instance in the datastore.
+  # Returns a dictionary used to store this instance in the datastore. The values that were not decoded (see
+  # _get_value) are stored as read, without being validated again, unless the property computes a new value (see
+  # Property._keeps_stored). With the profiler enabled, the validation and the encoding of the values are timed.
   def _to_dict_datastore(self):
+    profiled = profiler.enabled
     dict = {}
+    validateTime = 0.0
+    serializeTime = 0.0
+    lazy = getattr(self, "_lazy", None)
     for k in self.__class__.__dict__:
       if isinstance(self.__class__.__dict__[k], Property):
-        v = None
-        if k in self.__dict__:
-          v = self.__dict__[k]
+        if lazy and k in lazy and self.__class__.__dict__[k]._keeps_stored(lazy[k]):
+          dict[k] = lazy[k]
+          continue
+        v = self._get_value(k)
         self.__class__.__dict__[k].name = k
+        if profiled:
+          t0 = time.time()
         v = self.__class__.__dict__[k].validate(v)
-        v = self.__class__.__dict__[k]._to_datastore(v)
+        if profiled:
+          t1 = time.time()
+        v = self.__class__.__dict__[k]._to_json(v)
+        if profiled:
+          validateTime += t1 - t0
+          serializeTime += time.time() - t1
         dict[k] = v
+    if profiled:
+      profiler.add(self.kind(), "validate", validateTime)
+      profiler.add(self.kind(), "serialize", serializeTime, 0)
     return dict
 
 
+# Returns the stored value of an instance with the property values of fields (see Property._to_json) replacing its
+# own, encoded with schema.
+def _merge_fields(schema, encoded, fields):
+  values = schema.decode(encoded)
+  values.update(fields)
+  return schema.encode(values)
+
+
+# Schemas.
+# The instances are stored as JSON arrays: the version of the schema of the model, followed by the values of its
+# properties (see Property._to_json, and {"blob": key} for the values stored out of line) in the order of the
+# properties of that version, so the property names are not repeated in every value. The versions are stored in the
+# internal kind ndb_datastore.schema_kind(kind), keyed by version number (as a string), as {"properties": [names]}. A
+# new version is added when the properties of the model change, and the versions are never changed, so the instances
+# stored with an older version are still decoded: the properties they lack read as None (i.e. their default), and the
+# values of the properties removed since are ignored. Each instance is written with the current version when it is
+# stored again. The values stored before the schemas were introduced (a JSON object mapping each property name to its
+# JSON encoded value) are still decoded.
+# Exporting and importing a kind keeps its versions (see ndb_export); importing it into a datastore which already
+# stores instances of the kind with other versions is not supported.
+
+# Schemas by live datastore and model class, see Model._get_schema. The entries are dropped with their datastore.
+schemaCache = weakref.WeakKeyDictionary()
+schemaLock = threading.Lock()
+
+# Schema of the instances of a model in a datastore.
+# You should not use it directly from outside this module.
+class Schema:
+  def __init__(self, model, datastore):
+    self.model = model
+    # A proxy, so that the Schema in schemaCache does not keep the datastore alive.
+    self.datastore = weakref.proxy(datastore)
+    self.kind = ndb_datastore.schema_kind(model.kind())
+    self.lock = threading.Lock()
+    # Property names of each version.
+    self.versions = {}
+    # Current version and its property names, or None until the first encoding.
+    self.current = None
+
+  # Reads the versions stored in the datastore.
+  def load(self):
+    with self.lock:
+      for key, value in self.datastore.iter_items(self.kind):
+        self.versions[int(key)] = json.loads(value)["properties"]
+
+  # Returns the version matching the properties of the model, and its property names, adding it if needed.
+  def get_current(self):
+    current = self.current
+    if current is not None:
+      return current
+    names = sorted([k for k in self.model.__dict__ if isinstance(self.model.__dict__[k], Property)])
+    self.load()
+    with self.lock:
+      while True:
+        matching = [version for version in self.versions if self.versions[version] == names]
+        if matching:
+          self.current = (max(matching), names)
+          return self.current
+        version = max(self.versions.keys() + [0]) + 1
+        old = self.datastore.get_or_insert(self.kind, str(version), json.dumps({"properties": names}))
+        # Another process may have added the version first, with other properties.
+        self.versions[version] = names if old is None else json.loads(old)["properties"]
+
+  # Returns the property names of the given version.
+  def get_names(self, version):
+    names = self.versions.get(version)
+    if names is None:
+      self.load()
+      names = self.versions.get(version)
+      if names is None:
+        raise ValueError("Unknown version %d of the schema of %s" % (version, self.model.kind()))
+    return names
+
+  # Returns the value to store for an instance with the given property values (a dictionary by property name).
+  def encode(self, values):
+    version, names = self.get_current()
+    return json.dumps([version] + [values.get(k) for k in names], separators=(",", ":"))
+
+  # Returns the property values of the instance stored as encoded, as a dictionary by property name.
+  def decode(self, encoded):
+    stored = json.loads(encoded)
+    if isinstance(stored, dict):
+      return dict([(k, json.loads(v) if isinstance(v, basestring) else v) for k, v in stored.items()])
+    return dict(itertools.izip(self.get_names(stored[0]), itertools.islice(stored, 1, None)))
+
+
+# Out-of-line values.
+# The values of the properties stored out of line (see TextProperty) are stored in records of the internal kind
+# ndb_datastore.blob_kind(kind), keyed by the SHA-1 of the encoded value, so that equal values are stored once per kind.
+# The value of the instance holds {"blob": key} instead of the encoded value, so reading and writing the other
+# properties, or scanning the kind, never touches them. The records are written before or with the instances using
+# them, and are only deleted by Model.collect_blobs().
+
+# Index of the properties stored out of line of each model class, see Model._get_out_of_line_properties.
+outOfLineCache = {}
+
+# Returns the record storing the encoded value: "j" followed by the encoded value, or if compressed and smaller, "z"
+# followed by its zlib compression in base64 (the datastores store JSON strings).
+def _encode_blob(encoded, compressed):
+  if compressed:
+    record = "z" + base64.b64encode(zlib.compress(encoded))
+    if len(record) < len(encoded) + 1:
+      return record
+  return "j" + encoded
+
+# Returns the encoded value stored in the record.
+def _decode_blob(record):
+  if record[0] == "z":
+    return zlib.decompress(base64.b64decode(record[1:]))
+  return record[1:]
+
+# Returns the write operations storing the records of blobs (a dictionary by key, see Model._encode) missing from the
+# blob kind of kind.
+def _blob_ops(d, kind, blobs):
+  if not blobs:
+    return []
+  blobKind = ndb_datastore.blob_kind(kind)
+  keys = blobs.keys()
+  return [("set", blobKind, key, blobs[key]) for key, old in zip(keys, d.get_multi(blobKind, keys)) if old is None]
+
+# Returns the stored values (see Property._to_json), with the references to records of the blob kind of kind replaced
+# by the values they store, read from d in a single batch.
+def _resolve_blobs(d, kind, storedValues):
+  keys = [v["blob"] for v in storedValues if isinstance(v, dict)]
+  if not keys:
+    return storedValues
+  records = dict(zip(keys, d.get_multi(ndb_datastore.blob_kind(kind), keys)))
+  return [json.loads(_decode_blob(records[v["blob"]])) if isinstance(v, dict) else v for v in storedValues]
+
+
+# Asynchronous API.
+# The *_async functions and methods return Futures; call get_result() on them to wait for the operation and get its
+# result. The operations run on a bounded pool of threads owned by the datastore, and the gets and writes queued while
+# the pool is busy are sent to the datastore in batches.
+Future = ndb_datastore.Future
+wait_all = ndb_datastore.wait_all
+
+# Returns a list of Futures, one for each key, whose results are the instances of model with the given keys, or None
+# for the keys that do not exist.
+def get_multi_async(model, keys):
+  for key in keys:
+    if not key:
+      raise ValueError("Empty or missing key for model instance")
+  futures = model.get_datastore().get_executor().get_multi(model.kind(), keys)
+  return [futures[i].chain(lambda encoded, key=keys[i]: None if encoded is None else model._from_encoded(key, encoded))
+          for i in range(len(keys))]
+
+# Returns a list with the instances of model with the given keys, or None for the keys that do not exist.
+# The instances are read with a single get_multi of the datastore, without going through its executor.
+def get_multi(model, keys):
+  for key in keys:
+    if not key:
+      raise ValueError("Empty or missing key for model instance")
+  values = model.get_datastore().get_multi(model.kind(), keys)
+  return [None if encoded is None else model._from_encoded(key, encoded) for key, encoded in zip(keys, values)]
+
+# Returns the instances to store, grouped by datastore, as lists of (instance, "set" operation, blobs).
+def _group_puts(objs):
+  byDatastore = {}
+  for obj in objs:
+    encoded, blobs = obj._encode()
+    op = ("set", obj.kind(), obj.key, encoded)
+    byDatastore.setdefault(obj.get_datastore(), []).append((obj, op, blobs))
+  return byDatastore
+
+# Stores the model instances, and returns a list of Futures whose results are the keys.
+def put_multi_async(objs):
+  byDatastore = _group_puts(objs)
+  futures = {}
+  for d in byDatastore:
+    items = []
+    for obj, op, blobs in byDatastore[d]:
+      if obj._get_indexes() or blobs:
+        futures[id(obj)] = d.get_executor().call(_bind_context(obj._write), op[3], blobs).chain(
+          lambda _, key=obj.key: key)
+      else:
+        items.append((obj, op))
+    writes = d.get_executor().write_multi([op for _, op in items])
+    for i in range(len(items)):
+      futures[id(items[i][0])] = writes[i].chain(lambda _, key=items[i][0].key: key)
+  return [futures[id(obj)] for obj in objs]
+
+# Stores the model instances, and returns the list of keys.
+# The instances without indexes or out-of-line values are written with a single write_batch per datastore, without
+# going through its executor; the others are written one by one (see Model._write).
+def put_multi(objs):
+  byDatastore = _group_puts(objs)
+  for d in byDatastore:
+    ops = []
+    for obj, op, blobs in byDatastore[d]:
+      if obj._get_indexes() or blobs:
+        obj._write(op[3], blobs)
+      else:
+        ops.append(op)
+    if ops:
+      d.write_batch(ops)
+  return [obj.key for obj in objs]
+
+
+# Sharded counters.
+# A ShardedCounter spreads a counter over several small records, so that concurrent increments rarely write the same
+# record: each increment adds to a random shard with Datastore.increment, and value() sums the shards. The records are
+# stored in the internal kind "__counter__", separately from the model instances, so incrementing a counter never
+# rewrites an instance. The number of shards can be raised later, but not lowered.
+# Example: clicks = ShardedCounter("clicks:" + user.email); clicks.increment(); print clicks.value()
+class ShardedCounter:
+  kind = "__counter__"
+
+  # datastore_name: name of the datastore storing the counter (see getDatastore).
+  def __init__(self, name, shards=16, datastore_name=None):
+    self.name = name
+    self.shards = shards
+    self.datastore_name = datastore_name
+
+  def get_datastore(self):
+    d = getDatastore(self.datastore_name)
+    if d is None:
+      raise ValueError("No datastore open for counter %s" % self.name)
+    return d
+
+  def _shard_keys(self):
+    return ["%s/%d" % (self.name, i) for i in range(self.shards)]
+
+  # Adds delta to the counter. The shard is created by its first increment.
+  def increment(self, delta=1):
+    d = self.get_datastore()
+    key = "%s/%d" % (self.name, random.randrange(self.shards))
+    while d.increment(self.kind, key, "count", delta) is None:
+      d.get_or_insert(self.kind, key, json.dumps({"count": "0"}))
+
+  # Returns the value of the counter, 0 if it was never incremented.
+  def value(self):
+    values = self.get_datastore().get_multi(self.kind, self._shard_keys())
+    return sum([json.loads(json.loads(value)["count"]) for value in values if value is not None])
+
+  # Resets the counter to 0, deleting its shards.
+  def delete(self):
+    self.get_datastore().write_batch([("delete", self.kind, key) for key in self._shard_keys()])
+
+
+# Composite indexes.
+# Each index of a model is stored in an internal kind (see ndb_datastore.is_internal_kind), with one record per
+# instance. The key of the record encodes the values of the index columns followed by the instance key, in a way that
+# sorts like the values (see _index_encode), and the value of the record is the instance key. A query on the columns
+# of an index reads a range of index records, then the instances they point to.
+# The index records are written in the same batch as the instances by put() and delete(), which makes them consistent
+# on the datastores applying batches atomically.
+
+# Index objects of each model class, see Model._get_indexes.
+indexCache = {}
+# Locks serializing the writes of the instances of indexed models, striped by kind and key. A write reads the previous
+# value to find its index records, so two concurrent writes of the same instance could otherwise leave a stale record.
+indexLocks = [threading.Lock() for i in range(64)]
+
+# Returns the lock serializing the writes of the instance with the given kind and key.
+def _index_lock(kind, key):
+  return indexLocks[hash((kind, key)) % len(indexLocks)]
+
+# Context manager holding the index locks of all the (kind, key) pairs of keys, taken in a fixed order.
+@contextlib.contextmanager
+def _index_locks(keys):
+  locks = sorted(set([hash(k) % len(indexLocks) for k in keys]))
+  for i in locks:
+    indexLocks[i].acquire()
+  try:
+    yield
+  finally:
+    for i in reversed(locks):
+      indexLocks[i].release()
+
+# Returns the big-endian bytes of the non-negative integer n, prefixed with their count, so that the encodings of
+# integers sort like the integers.
+def _index_encode_natural(n):
+  digits = "%x" % n
+  if len(digits) % 2:
+    digits = "0" + digits
+  data = digits.decode("hex")
+  return chr(len(data)) + data
+
+# Returns a str encoding the property value, such that the encodings sort like the values, None first. The encodings
+# are prefix-free, so they can be concatenated to encode several columns. If descending is True, every byte is
+# inverted, which reverses the order.
+# Bools are encoded as the integers they are equal to (False as 0, True as 1), so that an IntegerProperty holding bools
+# (and the filters comparing it with bools) sorts as Python compares it. The other types cannot be mixed, since the
+# properties and the filter values are validated. The indexes with BooleanProperty columns written before bools were
+# encoded this way must be rebuilt (see Model.build_indexes).
+def _index_encode(value, descending=False):
+  if value is None:
+    encoded = "\x00"
+  elif isinstance(value, (int, long)):
+    if value >= 0:
+      encoded = "\x03" + _index_encode_natural(value)
+    else:
+      encoded = "\x02" + "".join([chr(255 - ord(c)) for c in _index_encode_natural(-value)])
+  elif isinstance(value, float):
+    # IEEE 754 doubles sort like integers once the sign bit is flipped, and all the bits of the negative ones.
+    data = struct.pack(">d", value if value != 0 else 0.0)
+    if ord(data[0]) & 0x80:
+      data = "".join([chr(255 - ord(c)) for c in data])
+    else:
+      data = chr(ord(data[0]) | 0x80) + data[1:]
+    encoded = "\x04" + data
+  elif isinstance(value, basestring):
+    if isinstance(value, unicode):
+      value = value.encode("utf-8")
+    encoded = "\x05" + value.replace("\x00", "\x00\xff") + "\x00\x00"
+  elif isinstance(value, datetime.datetime):
+    delta = value - datetime.datetime.utcfromtimestamp(0)
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    if microseconds >= 0:
+      encoded = "\x07" + _index_encode_natural(microseconds)
+    else:
+      encoded = "\x06" + "".join([chr(255 - ord(c)) for c in _index_encode_natural(-microseconds)])
+  else:
+    raise ValueError("Value type cannot be indexed")
+  if descending:
+    encoded = "".join([chr(255 - ord(c)) for c in encoded])
+  return encoded
+
+# A composite index of a model, declared by a tuple of property names (see Model.indexes).
+# You should not use it directly from outside this module.
+class Index:
+  def __init__(self, model, columns):
+    if not columns:
+      raise ValueError("Index without columns")
+    self.model = model
+    self.name = ",".join(columns)
+    self.kind = "__index__%s__%s" % (model.kind(), self.name)
+    self.columns = []
+    for column in columns:
+      descending = column.startswith("-")
+      name = column[1:] if descending else column
+      property = model.__dict__.get(name)
+      if not isinstance(property, Property):
+        raise ValueError("Index column does not match any property")
+      if not property.indexed:
+        raise ValueError("Index column on a property marked as not indexed")
+      if isinstance(property, TextProperty) and property.out_of_line is not None:
+        raise ValueError("Index column on a property stored out of line")
+      self.columns.append((name, property, descending))
+
+  # Returns the key of the index record of the instance with the given key and property values (a dictionary).
+  def row_key(self, key, values):
+    parts = [_index_encode(values.get(name), descending) for name, _, descending in self.columns]
+    parts.append(_index_encode(key))
+    return "".join(parts).encode("hex")
+
+
+# Returns the values accepted by filter f if they are few enough to read from an index one by one: the value of an
+# equality, the values of in, or for properties with few possible values (booleans or choices), the ones accepted by
+# the comparison. Returns None otherwise.
+def _equality_values(f):
+  if f.operator == "=":
+    return [f.value]
+  if isinstance(f.property, BooleanProperty):
+    domain = [None, False, True]
+  elif f.property.choices is not None:
+    domain = [None] + list(f.property.choices)
+  elif f.operator == "in":
+    domain = f.value
+  else:
+    return None
+  try:
+    values = [v for v in domain if f._compare(v)]
+  except TypeError:
+    return None
+  encoded = {}
+  for v in values:
+    encoded.setdefault(_index_encode(v), v)
+  return encoded.values()
+
+
+# Returns the estimated fraction of the instances accepted by all the filters, assuming they are independent.
+# Filters accepting a few values accept one in ten of the instances per value (or the right fraction of the possible
+# values for booleans and choices), != nine in ten, and the other comparisons one in three.
+def _selectivity(filters):
+  selectivity = 1.0
+  for f in filters:
+    values = _equality_values(f)
+    if values is not None:
+      if isinstance(f.property, BooleanProperty):
+        domain = 3
+      elif f.property.choices is not None:
+        domain = len(f.property.choices) + 1
+      else:
+        domain = 10
+      selectivity *= min(1.0, float(len(values)) / domain)
+    elif f.operator == "!=":
+      selectivity *= 0.9
+    else:
+      selectivity *= 1.0 / 3
+  return selectivity
+
+
+# Access path of a query, chosen by Query._plan.
+# index is the Index read, or None if the whole kind is scanned. For an index, groups is a list of (prefix, ranges)
+# pairs, one for each combination of the values required by the equality filters: prefix is the hex encoding of these
+# values, and ranges is a list of (start, end) bounds for the rest of the index record key, in index order. The
+# results of the groups are merged on the rest of the key.
+# filters are the query filters handled by the index; the others are applied to the instances read. sorted tells if
+# the instances are read in the order of the query.
+# You should not use it directly from outside this module.
+class QueryPlan:
+  def __init__(self, index, groups, filters, sorted):
+    self.index = index
+    self.groups = groups
+    self.filters = filters
+    self.sorted = sorted
+
+
+# Query statistics.
+# Every query run with Query.iter() records a QueryStats once its iterator is exhausted (or by fetch()). The statistics
+# are added up in a registry per kind and access path, read with get_query_stats(), and passed to the hooks registered
+# with add_query_hook(), e.g. to log the slow queries.
+
+# Totals of the recorded queries, by (kind, access, index).
+queryStats = {}
+queryStatsLock = threading.Lock()
+# Functions called with the QueryStats of each recorded query.
+queryHooks = []
+
+# Registers a function called with the QueryStats of each query once it has been run.
+def add_query_hook(hook):
+  queryHooks.append(hook)
+
+def remove_query_hook(hook):
+  queryHooks.remove(hook)
+
+# Returns a list of dictionaries with the totals of the recorded queries for each kind and access path: kind, access,
+# index, queries (the number of queries), rowsScanned, rowsReturned, and timings (seconds spent in each phase). The
+# list is sorted by decreasing rowsScanned, so the costliest scans come first.
+def get_query_stats():
+  with queryStatsLock:
+    totals = [dict(total, timings=dict(total["timings"])) for total in queryStats.values()]
+  return sorted(totals, key=lambda total: total["rowsScanned"], reverse=True)
+
+def reset_query_stats():
+  with queryStatsLock:
+    queryStats.clear()
+
+# Statistics of one run of a query: the access path (see Query.explain), the number of instances read from the
+# datastore (rowsScanned) and accepted by the filters (rowsReturned), and the time spent in seconds reading from the
+# datastore ("fetch"), decoding the instances ("decode"), applying the filters ("filter") and sorting ("sort").
+# You should not create it directly from outside this module.
+class QueryStats:
+  phases = ["fetch", "decode", "filter", "sort"]
+
+  def __init__(self, query, plan=None):
+    self.kind = query.model.kind()
+    self.access = "scan" if plan is None or plan.index is None else "index"
+    self.index = None if plan is None or plan.index is None else plan.index.name
+    self.rowsScanned = 0
+    self.rowsReturned = 0
+    self.timings = dict.fromkeys(self.phases, 0.0)
+    self.sortPending = False # Set by QueryOrderedIterator until the results are sorted
+    self.finished = False
+
+  # The fetch, filter and sort times are also reported to the profiler, as the io, filter and sort phases of the model
+  # (the decode time is reported by Model._from_encoded).
+  def add_time(self, phase, seconds):
+    self.timings[phase] += seconds
+    if profiler.enabled:
+      profiler.add(self.kind, "io" if phase == "fetch" else phase, seconds)
+
+  # Accounts for a batch of scanned instances, of which returned were accepted by the filters.
+  def add_batch(self, scanned, returned, fetchTime, decodeTime, filterTime):
+    self.rowsScanned += scanned
+    self.rowsReturned += returned
+    self.timings["fetch"] += fetchTime
+    self.timings["decode"] += decodeTime
+    self.timings["filter"] += filterTime
+    if profiler.enabled:
+      profiler.add(self.kind, "io", fetchTime)
+      profiler.add(self.kind, "filter", filterTime)
+
+  # Records the statistics in the registry and calls the hooks, unless done already.
+  def finish(self):
+    if self.finished or self.sortPending:
+      return
+    self.finished = True
+    with queryStatsLock:
+      total = queryStats.get((self.kind, self.access, self.index))
+      if total is None:
+        total = {"kind": self.kind, "access": self.access, "index": self.index, "queries": 0, "rowsScanned": 0,
+                 "rowsReturned": 0, "timings": dict.fromkeys(self.phases, 0.0)}
+        queryStats[(self.kind, self.access, self.index)] = total
+      total["queries"] += 1
+      total["rowsScanned"] += self.rowsScanned
+      total["rowsReturned"] += self.rowsReturned
+      for phase in self.phases:
+        total["timings"][phase] += self.timings[phase]
+    for hook in list(queryHooks):
+      hook(self)
+
+  def to_dict(self):
+    return {"rowsScanned": self.rowsScanned, "rowsReturned": self.rowsReturned, "timings": dict(self.timings)}
+
+
+# Phase profiler.
+# When enabled, the time spent by the module is attributed to each model and phase:
+#   key: generating the instance keys and the keys of the index records
+#   validate: validating the property values before storing them
+#   serialize: encoding the property values and the stored value
+#   decode: decoding the stored values into instances
+#   io: waiting for the datastore
+#   filter, sort: applying the query filters and sort orders in memory
+# The phases are timed with time.time() around each step, so the overhead is small enough to profile a production
+# process; when disabled, each step only checks a flag. Use the profiler instance below, e.g.:
+#   ndb.profiler.enable(); ...; print ndb.profiler.report()
+# or call ndb.profiler.dump_on_signal() at startup, then "kill -USR1 <pid>" to print a report to stderr.
+class Profiler:
+  phases = ["key", "validate", "serialize", "decode", "io", "filter", "sort"]
+
+  def __init__(self):
+    self.enabled = False
+    self.lock = threading.Lock()
+    self.totals = {}
+
+  def enable(self):
+    self.enabled = True
+
+  def disable(self):
+    self.enabled = False
+
+  def reset(self):
+    with self.lock:
+      self.totals = {}
+
+  # Returns the start time of a step if the profiler is enabled, or None.
+  def start(self):
+    if self.enabled:
+      return time.time()
+    return None
+
+  # Attributes the time since start (as returned by start() or stop()) to the phase of the model kind. Returns the
+  # current time, to time the next step, or None if start is None.
+  def stop(self, kind, phase, start):
+    if start is None:
+      return None
+    now = time.time()
+    self.add(kind, phase, now - start)
+    return now
+
+  # Attributes seconds to the phase of the model kind, counting calls calls.
+  def add(self, kind, phase, seconds, calls=1):
+    with self.lock:
+      total = self.totals.get((kind, phase))
+      if total is None:
+        total = [0, 0.0]
+        self.totals[(kind, phase)] = total
+      total[0] += calls
+      total[1] += seconds
+
+  # Returns a dictionary mapping each model kind to a dictionary mapping each phase to its number of calls and time
+  # in seconds ({"calls": ..., "seconds": ...}).
+  def stats(self):
+    stats = {}
+    with self.lock:
+      for (kind, phase), (calls, seconds) in self.totals.items():
+        stats.setdefault(kind, {})[phase] = {"calls": calls, "seconds": seconds}
+    return stats
+
+  # Returns the statistics as a table, with the share of each phase in the time of its model.
+  def report(self):
+    stats = self.stats()
+    lines = ["%-24s %-10s %10s %12s %12s %7s" % ("Model", "Phase", "Calls", "Total (s)", "Mean (us)", "Share")]
+    for kind in sorted(stats):
+      total = sum([p["seconds"] for p in stats[kind].values()])
+      for phase in self.phases:
+        if phase not in stats[kind]:
+          continue
+        calls = stats[kind][phase]["calls"]
+        seconds = stats[kind][phase]["seconds"]
+        lines.append("%-24s %-10s %10d %12.6f %12.1f %6.1f%%" % (kind, phase, calls, seconds,
+                     seconds / calls * 1e6 if calls else 0.0, seconds / total * 100 if total else 0.0))
+    return "\n".join(lines) + "\n"
+
+  # Writes the report to out (standard error by default).
+  def dump(self, out=None):
+    if out is None:
+      out = sys.stderr
+    out.write(self.report())
+    out.flush()
+
+  # Makes the signal signum (SIGUSR1 by default) dump the report, e.g. to profile a running process.
+  def dump_on_signal(self, signum=None):
+    if signum is None:
+      signum = signal.SIGUSR1
+    signal.signal(signum, lambda signum, frame: self.dump())
+
+# The profiler of the module.
+profiler = Profiler()
+
+# Functions comparing a property value with the value of a filter, by filter operator, used by Filter for the single
+# values and for the NumPy columns alike (!= combines < and > with |, which works on both).
+filterOperators = {
+  "=": operator.eq,
+  "!=": lambda a, b: (a < b) | (a > b),
+  "<": operator.lt,
+  "<=": operator.le,
+  ">": operator.gt,
+  ">=": operator.ge,
+  "in": lambda a, b: a in b,
+}
+
 # Class used to store query filters.
 # You should not use it directly from outside this module.
 class Filter:
@@ -208,24 +1436,99 @@ class Filter:
 
   # Returns True if the model instance obj is accepted by this filter.
   def _apply(self, obj):
-    v = None
-    if self.propertyName in obj.__dict__:
-      v = obj.__dict__[self.propertyName]
-    if self.operator == "=":
-      return v == self.value
-    if self.operator == "!=":
-      return v < self.value or v > self.value
-    if self.operator == "<":
-      return v < self.value
-    if self.operator == "<=":
-      return v <= self.value
-    if self.operator == ">":
-      return v > self.value
-    if self.operator == ">=":
-      return v >= self.value
+    return self._compare(obj._get_value(self.propertyName))
+
+  # Returns a readable description of this filter, e.g. "numClicks > 5".
+  def _describe(self):
+    return "%s %s %r" % (self.propertyName, self.operator, self.value)
+
+  # Returns a function telling if a property value is accepted by this filter, specialized on the operator.
+  def _predicate(self):
+    compare = self._operator_function()
+    value = self.value
+    if self.operator == "in":
+      try:
+        value = frozenset(value)
+      except TypeError:
+        pass
+    return lambda v: compare(v, value)
+
+  # Returns True if the property value v is accepted by this filter.
+  def _compare(self, v):
+    return self._operator_function()(v, self.value)
+
+  # Returns the function of filterOperators comparing a property value with the value of this filter.
+  def _operator_function(self):
+    compare = filterOperators.get(self.operator)
+    if compare is None:
+      raise ValueError("Could not apply filter")
+    return compare
+
+  # Returns a NumPy bool array telling which values of column (see Query.to_columns) are accepted by this filter.
+  # Missing values compare like None does in Python.
+  def _mask(self, numpy, column):
+    value = self.value
     if self.operator == "in":
-      return v in self.value
-    raise ValueError("Could not apply filter")
+      value = [_to_column_value(numpy, self.property, v) for v in value if v is not None]
+    else:
+      value = _to_column_value(numpy, self.property, value)
+    data = column.data
+    if value is None:
+      # Any value is greater than None.
+      matches = numpy.empty(len(data), dtype=bool)
+      matches.fill(self._compare(0))
+    elif self.operator == "in":
+      matches = numpy.in1d(data, numpy.array(value, dtype=data.dtype))
+    else:
+      matches = self._operator_function()(data, value)
+    missing = numpy.ma.getmaskarray(column)
+    if not missing.any():
+      return matches
+    return numpy.where(missing, self._compare(None), matches)
+
+
+# Filters of a query, compiled for evaluation over batches of model instances.
+# Each filter is turned once into a predicate specialized on its operator. A batch is filtered one filter at a time,
+# so each filter only sees the instances accepted by the previous ones. Filters on numeric and date properties are
+# evaluated with NumPy masks when NumPy is available and the batch is large enough.
+# You should not use it directly from outside this module.
+class FilterEvaluator:
+  # Smallest batch evaluated with NumPy. Below this, building the arrays costs more than it saves.
+  minNumpyBatch = 64
+
+  def __init__(self, filters):
+    try:
+      import numpy
+      self.numpy = numpy
+    except ImportError:
+      self.numpy = None
+    self.filters = []
+    for f in filters:
+      vectorized = self.numpy is not None and isinstance(f.property, (IntegerProperty, FloatProperty, BooleanProperty,
+                                                                       DateTimeProperty))
+      self.filters.append((f, f.propertyName, f._predicate(), vectorized))
+
+  # Returns the list of instances in objs accepted by all the filters, in the same order.
+  def filter(self, objs):
+    for f, name, predicate, vectorized in self.filters:
+      if not objs:
+        break
+      values = [obj._get_value(name) for obj in objs]
+      if vectorized and len(objs) >= self.minNumpyBatch:
+        mask = self._mask(f, values)
+        if mask is not None:
+          objs = [objs[i] for i in self.numpy.flatnonzero(mask)]
+          continue
+      objs = [obj for obj, v in itertools.izip(objs, values) if predicate(v)]
+    return objs
+
+  # Evaluates filter f over values with NumPy. Returns None if the values don't fit in the column type (e.g. longs
+  # above 64 bits), in which case the predicate is used instead.
+  def _mask(self, f, values):
+    try:
+      return f._mask(self.numpy, _values_to_column(self.numpy, f.property, values))
+    except (OverflowError, TypeError, ValueError):
+      return None
 
 
 # Class used to store query sort orders by property.
@@ -239,43 +1542,52 @@ class SortOrder:
 
 # Class used to iterate over model instances from the datastore, and optionally apply filters and sorting.
 # Do not create Query instances directly; call MyModel.query() instead.
+# Pass snapshot (a snapshot of the datastore of the model, see Datastore.snapshot) to read it instead of the datastore,
+# e.g. to run several queries on the same state of the datastore: MyModel.query(snapshot=snapshot). The caller closes
+# the snapshot. See also the snapshot() context manager.
 class Query:
-  def __init__(self, model):
+  def __init__(self, model, snapshot=None):
     self.model = model
+    self.snapshot = snapshot
     self.filters = []
     self.sortOrders = []
 
+  # Returns the datastore read by the query: its snapshot if it has one, the datastore of the model otherwise.
+  def get_datastore(self):
+    if self.snapshot is not None:
+      return self.snapshot
+    return self.model.get_datastore()
+
   # Adds filter f to the queryinstance and returns the query instance.
   # A filter can be created by comparing a model property with a value, e.g.
   # q = q.filter(UserModel.email == "test@example.com").
   # The following operators are supported: ==, !=, <, <=, >, >= and in via the Property.IN function.
   def filter(self, f):
     assert(isinstance(f, Filter))
-    f.propertyName = None
-    for k in self.model.__dict__:
-      if isinstance(self.model.__dict__[k], Property):
-        if self.model.__dict__[k] is f.property:
-          f.propertyName = k
+    f.propertyName = self._property_name(f.property)
     if f.propertyName is None:
       raise ValueError("Filter does not match any property")
     self.filters.append(f)
     return self
 
+  # Returns the name of the model property, or None if the model does not have it.
+  def _property_name(self, property):
+    for k in self.model.__dict__:
+      if self.model.__dict__[k] is property:
+        return k
+    return None
+
   # Adds a property to the list of properties used to sort the results.
   # Use a unary minus in front of the property to sort in descending order.
   # Example: q = q.order(-UserModel.email)
-  # Note: sorting is done in memory after all the instances have been read from the datastore. With large numbers of
-  # instances, you can run OOM.
+  # Note: unless an index of the model returns the instances in this order (see Model.indexes), sorting is done in
+  # memory after all the instances have been read from the datastore. With large numbers of instances, you can run OOM.
   def order(self, *sortOrderValues):
     for sortOrder in sortOrderValues:
       assert(isinstance(sortOrder, Property) or isinstance(sortOrder, SortOrder))
       if isinstance(sortOrder, Property):
         sortOrder = SortOrder(sortOrder)
-      sortOrder.propertyName = None
-      for k in self.model.__dict__:
-        if isinstance(self.model.__dict__[k], Property):
-          if self.model.__dict__[k] is sortOrder.property:
-            sortOrder.propertyName = k
+      sortOrder.propertyName = self._property_name(sortOrder.property)
       if sortOrder.propertyName is None:
         raise ValueError("Sort order does not match any property")
       self.sortOrders.append(sortOrder)
@@ -284,11 +1596,228 @@ class Query:
   # Returns an iterator for the results of the query. The values returned by the iterator are the model instances
   # matched by the query, sorted if specified or in an arbitrary order otherwise.
   # Example: users = [user for user in UserModel.query().filter(UserModel.age > 18).order(UserModel.email)]
+  # The instances are read from an index of the model if one helps (see _plan), or with a scan of the kind otherwise.
+  # The iterator records the statistics of the query in its stats attribute (see QueryStats).
   def iter(self):
-    if not self.sortOrders:
-      return QueryIterator(self)
+    plan = self._plan()
+    stats = QueryStats(self, plan)
+    if plan.index is None:
+      iterator = QueryIterator(self, stats)
     else:
-      return QueryOrderedIterator(self)
+      iterator = IndexQueryIterator(self, plan, stats)
+    if not self.sortOrders or plan.sorted:
+      return iterator
+    return QueryOrderedIterator(self, iterator)
+
+  # Returns a dictionary describing how the query is run:
+  # kind: the kind queried.
+  # access: "index" if the instances are read from an index, "scan" if the whole kind is read.
+  # index: the index used (its declaration, e.g. "isAdmin,-numClicks,email"), or None.
+  # ranges: the number of index ranges read.
+  # indexFilters, otherFilters: the filters handled by the index, and the ones applied to the instances read.
+  # sort: "index" if the index returns the instances in the order of the query, "memory" if they are sorted in memory,
+  # or None if the query has no sort order.
+  # estimatedRowsScanned, estimatedRowsReturned: the number of instances read and returned, estimated from the number
+  # of instances of the kind in the datastore catalog, with a fixed selectivity for each filter (see _selectivity).
+  # With analyze set, the query is run, and its statistics are added: rowsScanned, rowsReturned and timings (see
+  # QueryStats).
+  def explain(self, analyze=False):
+    plan = self._plan()
+    count = self.get_datastore().get_kind_stats().get(self.model.kind(), {}).get("count", 0)
+    sort = None
+    if self.sortOrders:
+      sort = "index" if plan.sorted else "memory"
+    result = {
+      "kind": self.model.kind(),
+      "access": "scan" if plan.index is None else "index",
+      "index": None if plan.index is None else plan.index.name,
+      "ranges": 0 if plan.index is None else sum([len(ranges) for _, ranges in plan.groups]),
+      "indexFilters": [f._describe() for f in plan.filters],
+      "otherFilters": [f._describe() for f in self.filters if f not in plan.filters],
+      "sort": sort,
+      "estimatedRowsScanned": int(round(count * _selectivity(plan.filters))),
+      "estimatedRowsReturned": int(round(count * _selectivity(self.filters))),
+    }
+    if analyze:
+      iterator = self.iter()
+      for obj in iterator:
+        pass
+      result.update(iterator.stats.to_dict())
+    return result
+
+  # Maximum number of value combinations of the equality filters read from an index.
+  maxIndexGroups = 100
+
+  # Returns the QueryPlan of the query: the index of the model handling the most filters, preferring the indexes that
+  # return the instances in the order of the query, or a scan of the kind if no index helps.
+  def _plan(self):
+    best = QueryPlan(None, None, [], not self.sortOrders)
+    for index in self.model._get_indexes():
+      plan = self._plan_index(index)
+      if (len(plan.filters), plan.sorted) > (len(best.filters), best.sorted):
+        best = plan
+    return best
+
+  # Returns the QueryPlan reading the index.
+  # The equality filters on the first columns select a prefix of the index records (several if a filter accepts a
+  # few values, e.g. in, or != on a BooleanProperty); the comparisons on the next column select a range after each
+  # prefix. The instances come out in the order of the remaining columns.
+  def _plan_index(self, index):
+    handled = []
+    prefixes = [""]
+    fixed = set()
+    i = 0
+    while i < len(index.columns):
+      name, property, descending = index.columns[i]
+      values = None
+      for f in self.filters:
+        if f.propertyName == name and f not in handled:
+          values = _equality_values(f)
+          if values is not None:
+            break
+      if values is None or len(prefixes) * len(values) > self.maxIndexGroups:
+        break
+      handled.append(f)
+      if len(values) == 1:
+        fixed.add(name)
+      prefixes = [prefix + _index_encode(v, descending) for prefix in prefixes for v in values]
+      i += 1
+    ranges = [("", "g")]
+    if i < len(index.columns):
+      ranges = self._plan_range(index.columns[i], handled)
+    groups = [(prefix.encode("hex"), ranges) for prefix in prefixes]
+    sortOrders = [(so.propertyName, so.reversed) for so in self.sortOrders if so.propertyName not in fixed]
+    columns = [(name, descending) for name, _, descending in index.columns[i:]]
+    return QueryPlan(index, groups, handled, sortOrders == columns[:len(sortOrders)])
+
+  # Returns the ranges of index record keys (after the prefix) selected by the comparisons on column, and adds the
+  # filters used to handled. Keys are hex encoded, so "g" sorts after any key.
+  def _plan_range(self, column, handled):
+    name, property, descending = column
+    start = ""
+    end = "g"
+    excluded = None
+    for f in self.filters:
+      if f.propertyName != name or f in handled or f.operator not in ("<", "<=", ">", ">=", "!="):
+        continue
+      value = _index_encode(f.value, descending).encode("hex")
+      if f.operator == "!=":
+        if excluded is not None:
+          continue
+        excluded = value
+      elif (f.operator in (">", ">=")) != descending:
+        # Lower bound, after the records with the value unless it is accepted.
+        start = max(start, value if f.operator in (">=", "<=") else value + "g")
+      else:
+        end = min(end, value + "g" if f.operator in (">=", "<=") else value)
+      handled.append(f)
+    if excluded is None:
+      ranges = [(start, end)]
+    else:
+      ranges = [(start, min(end, excluded)), (max(start, excluded + "g"), end)]
+    return [(s, e) for s, e in ranges if s < e]
+
+  # Same as iter(), but the instances are decoded and filtered by a pool of processes, so that large scans can use
+  # several cores.
+  # The parent process reads the kind in key order and sends it to the pool in chunks of chunkSize instances; each
+  # chunk is a contiguous range of keys, decoded and filtered by one worker. Set ordered to False to get the results
+  # of each chunk as soon as it is ready, instead of in key order. processes defaults to the number of CPUs.
+  # Sorting, if any, is done in memory once all the results have been received.
+  # Only the decoding and the filtering are parallel: the reads stay in the parent, each chunk is pickled to a worker
+  # and its matching instances pickled back, and a new pool is forked for each query. It pays off for large scans whose
+  # decoding or filters dominate (e.g. selective filters on large instances), not for cheap ones, which iter() reads
+  # faster.
+  def iter_parallel(self, processes=None, ordered=True, chunkSize=1000):
+    iterator = ParallelQueryIterator(self, processes, ordered, chunkSize)
+    if not self.sortOrders:
+      return iterator
+    return QueryOrderedIterator(self, iterator)
+
+  # Returns the values of the given properties for the query results as NumPy arrays, without creating model
+  # instances. The result is a dictionary mapping each property name to a numpy.ma.MaskedArray, masked where the value
+  # is None. IntegerProperty values are int64, FloatProperty float64, BooleanProperty bool, DateTimeProperty
+  # datetime64[us] (UTC), and the others Python objects. Set keys to True to get the keys in the "key" column.
+  # The kind is read in chunks of chunkSize instances. The filters are evaluated on the columns of each chunk with
+  # NumPy, and the sort orders with a stable argsort at the end.
+  # Requires NumPy, which is not needed otherwise.
+  # Example: columns = UserModel.query(UserModel.age > 18).to_columns([UserModel.age, UserModel.weight])
+  def to_columns(self, properties, keys=False, chunkSize=10000):
+    import numpy
+    names = []
+    for property in properties:
+      name = self._property_name(property)
+      if name is None or not isinstance(property, Property):
+        raise ValueError("Column does not match any property")
+      names.append(name)
+    needed = list(collections.OrderedDict.fromkeys(
+      names + [f.propertyName for f in self.filters] + [so.propertyName for so in self.sortOrders]))
+    chunks = dict([(name, []) for name in needed])
+    keyChunks = []
+    d = self.get_datastore()
+    schema = self.model._get_schema()
+    items = d.iter_items(self.model.kind())
+    while True:
+      chunk = list(itertools.islice(items, chunkSize))
+      if not chunk:
+        break
+      records = [schema.decode(encoded) for _, encoded in chunk]
+      columns = {}
+      for name in needed:
+        storedValues = _resolve_blobs(d, self.model.kind(), [r.get(name) for r in records])
+        columns[name] = _to_column(numpy, self.model.__dict__[name], storedValues)
+      mask = numpy.ones(len(chunk), dtype=bool)
+      for f in self.filters:
+        mask &= f._mask(numpy, columns[f.propertyName])
+      for name in needed:
+        chunks[name].append(columns[name][mask])
+      if keys:
+        keyColumn = numpy.empty(len(chunk), dtype=object)
+        keyColumn[:] = [key for key, _ in chunk]
+        keyChunks.append(keyColumn[mask])
+    columns = {}
+    for name in needed:
+      if chunks[name]:
+        columns[name] = numpy.ma.concatenate(chunks[name])
+      else:
+        columns[name] = _to_column(numpy, self.model.__dict__[name], [])
+    if keys:
+      columns["key"] = numpy.concatenate(keyChunks) if keyChunks else numpy.empty(0, dtype=object)
+      names.append("key")
+    if self.sortOrders:
+      order = numpy.arange(len(columns[needed[0]]))
+      for so in reversed(self.sortOrders):
+        column = columns[so.propertyName][order]
+        if so.reversed:
+          # Sorting the reversed column and reversing the result keeps the sort stable.
+          n = len(order)
+          order = order[(n - 1 - _column_argsort(numpy, column[::-1]))[::-1]]
+        else:
+          order = order[_column_argsort(numpy, column)]
+      for name in columns:
+        columns[name] = columns[name][order]
+    return dict([(name, columns[name]) for name in names])
+
+  # Returns a list with the results of the query, or at most limit results if limit is set.
+  def fetch(self, limit=None):
+    results = []
+    iterator = self.iter()
+    # The limit is checked before reading the next result, so that no instance is read and decoded in excess.
+    while limit is None or len(results) < limit:
+      try:
+        results.append(iterator.next())
+      except StopIteration:
+        break
+    iterator.close()
+    iterator.stats.finish()
+    return results
+
+  # Asynchronous version of fetch(). Returns a Future whose result is the list of results.
+  def fetch_async(self, limit=None):
+    return self.model.get_datastore().get_executor().call(_bind_context(self.fetch), limit)
+
+  # Returns the filters compiled for batch evaluation.
+  def _filter_evaluator(self):
+    return FilterEvaluator(self.filters)
 
   # Returns True if the model instance obj matches the filters.
   def _apply_filters(self, obj):
@@ -298,30 +1827,217 @@ class Query:
     return True
 
 
+# Closes an iterator returned by a datastore (e.g. stops the threads of a ShardedDatastoreIterator, or ends the read
+# transaction of a generator), if it can be closed.
+def _close_iterator(iterator):
+  close = getattr(iterator, "close", None)
+  if close is not None:
+    close()
+
+
 # Helper class used to iterate over the query results without sorting.
+# The instances are read and decoded in batches, and each batch is filtered at once.
 # You should not have to care about it from outside the module.
 class QueryIterator:
-  def __init__(self, query):
+  batchSize = 200
+
+  def __init__(self, query, stats=None):
     self.query = query
-    self.datastoreIterator = self.query.model.get_datastore().iter(self.query.model.kind())
+    self.stats = stats if stats is not None else QueryStats(query)
+    self.items = self.query.get_datastore().iter_items(self.query.model.kind())
+    self.evaluator = self.query._filter_evaluator()
+    self.results = collections.deque()
 
   def __iter__(self):
     return self
 
   def next(self):
-    while True:
-      key = self.datastoreIterator.next()
-      obj = self.query.model.get_by_id(key)
-      if self.query._apply_filters(obj):
-        return obj
+    while not self.results:
+      t0 = time.time()
+      batch = list(itertools.islice(self.items, self.batchSize))
+      t1 = time.time()
+      if not batch:
+        self.stats.add_time("fetch", t1 - t0)
+        self.stats.finish()
+        raise StopIteration()
+      objs = [self.query.model._from_encoded(key, encoded, self.query.snapshot) for key, encoded in batch]
+      t2 = time.time()
+      objs = self.evaluator.filter(objs)
+      self.stats.add_batch(len(batch), len(objs), t1 - t0, t2 - t1, time.time() - t2)
+      self.results.extend(objs)
+    return self.results.popleft()
+
+  # Stops reading the kind. Called by fetch() when it stops early.
+  def close(self):
+    _close_iterator(self.items)
+
+
+# Queries being run by ParallelQueryIterator, by id. The worker processes are forked once the query is registered, so
+# they find it here.
+parallelQueries = {}
+
+# Decodes and filters a chunk of (key, encoded value) pairs for a parallel query. Runs in the worker processes.
+# Returns (True, list of (key, property values) for the instances matching the filters), or (False, exception).
+def _run_parallel_query_chunk(args):
+  queryId, chunk = args
+  try:
+    query = parallelQueries[queryId]
+    objs = [query.model._from_encoded(key, encoded) for key, encoded in chunk]
+    return True, [(obj.key, obj._get_state()) for obj in query._filter_evaluator().filter(objs)]
+  except Exception, e:
+    return False, e
+
+
+# Helper class used to iterate over the query results using a pool of processes, without sorting.
+# You should not have to care about it from outside the module.
+class ParallelQueryIterator:
+  def __init__(self, query, processes, ordered, chunkSize):
+    self.query = query
+    self.ordered = ordered
+    self.chunkSize = chunkSize
+    self.items = self.query.get_datastore().iter_items(self.query.model.kind())
+    # The workers decode with the versions of the schema known when they are forked.
+    self.query.model._get_schema().load()
+    self.queryId = id(self)
+    parallelQueries[self.queryId] = self.query
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+    self.pool = multiprocessing.Pool(processes)
+    # At most maxPending chunks are in flight, so that the kind is not read into memory faster than it is processed.
+    self.maxPending = 2 * processes
+    self.pending = collections.OrderedDict()
+    self.nextChunkId = 0
+    self.finished = Queue.Queue()
+    self.exhausted = False
+    self.results = collections.deque()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    while not self.results:
+      while not self.exhausted and len(self.pending) < self.maxPending:
+        self._submit_chunk()
+      if not self.pending:
+        self.close()
+        raise StopIteration()
+      if self.ordered:
+        ok, results = self.pending.popitem(last=False)[1].get()
+      else:
+        chunkId, (ok, results) = self.finished.get()
+        del self.pending[chunkId]
+      if not ok:
+        self.close()
+        raise results
+      self.results.extend(results)
+    key, kwds = self.results.popleft()
+    obj = self.query.model(key)
+    obj._set_state(kwds)
+    if "_lazy" in kwds and self.query.snapshot is not None:
+      obj._datastore = self.query.snapshot
+    return obj
+
+  def _submit_chunk(self):
+    chunk = list(itertools.islice(self.items, self.chunkSize))
+    if len(chunk) < self.chunkSize:
+      self.exhausted = True
+    if not chunk:
+      return
+    chunkId = self.nextChunkId
+    self.nextChunkId += 1
+    callback = None
+    if not self.ordered:
+      callback = lambda result: self.finished.put((chunkId, result))
+    self.pending[chunkId] = self.pool.apply_async(_run_parallel_query_chunk, [(self.queryId, chunk)],
+                                                  callback=callback)
+
+  # Stops the worker processes. Called automatically once all the results have been returned.
+  def close(self):
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
+      parallelQueries.pop(self.queryId, None)
+      _close_iterator(self.items)
+
+  def __del__(self):
+    self.close()
+
+
+# Helper class used to iterate over the query results read from an index (see QueryPlan).
+# The instance keys are read from the index records, and the instances are read with get_multi in batches. All the
+# filters are applied to the instances read, so that instances changed since their index record was read are not
+# returned by mistake.
+# You should not have to care about it from outside the module.
+class IndexQueryIterator:
+  batchSize = 200
+
+  def __init__(self, query, plan, stats=None):
+    self.query = query
+    self.stats = stats if stats is not None else QueryStats(query, plan)
+    self.datastore = self.query.get_datastore()
+    scans = [self._scan(plan.index.kind, prefix, ranges) for prefix, ranges in plan.groups]
+    self.scans = scans
+    if len(scans) == 1:
+      rows = scans[0]
+    elif plan.sorted:
+      rows = heapq.merge(*scans)
+    else:
+      rows = itertools.chain(*scans)
+    self.keys = (key for _, key in rows)
+    self.evaluator = self.query._filter_evaluator()
+    self.results = collections.deque()
+
+  # Returns an iterator over the (rest of the record key, instance key) pairs of the index records in the ranges after
+  # the prefix.
+  def _scan(self, kind, prefix, ranges):
+    for start, end in ranges:
+      items = self.datastore.iter_items(kind, prefix + start, prefix + end)
+      try:
+        for rowKey, key in items:
+          yield rowKey[len(prefix):], key
+      finally:
+        _close_iterator(items)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    model = self.query.model
+    while not self.results:
+      t0 = time.time()
+      keys = list(itertools.islice(self.keys, self.batchSize))
+      if not keys:
+        self.stats.add_time("fetch", time.time() - t0)
+        self.stats.finish()
+        raise StopIteration()
+      values = self.datastore.get_multi(model.kind(), keys)
+      t1 = time.time()
+      objs = [model._from_encoded(key, encoded, self.query.snapshot) for key, encoded in zip(keys, values)
+              if encoded is not None]
+      t2 = time.time()
+      objs = self.evaluator.filter(objs)
+      self.stats.add_batch(len(keys), len(objs), t1 - t0, t2 - t1, time.time() - t2)
+      self.results.extend(objs)
+    return self.results.popleft()
+
+  # Stops reading the index. Called by fetch() when it stops early.
+  def close(self):
+    for scan in self.scans:
+      scan.close()
 
 
 # Helper class used to iterate over the query results with sorting.
 # You should not have to care about it from outside the module.
 class QueryOrderedIterator:
-  def __init__(self, query):
+  def __init__(self, query, queryIterator=None):
     self.query = query
-    self.queryIterator = QueryIterator(self.query)
+    if queryIterator is None:
+      queryIterator = QueryIterator(self.query)
+    self.queryIterator = queryIterator
+    # The statistics are recorded once the instances are sorted.
+    self.stats = getattr(queryIterator, "stats", None)
+    if self.stats is not None:
+      self.stats.sortPending = True
     self.sortedObjects = None
     self.sortedObjectsIterator = None
 
@@ -337,21 +2053,93 @@ class QueryOrderedIterator:
           self.sortedObjects.append(obj)
         except StopIteration:
           break
+      t0 = time.time()
       for so in reversed(self.query.sortOrders):
-        self.sortedObjects.sort(key=lambda x: (x.__dict__[so.propertyName]), reverse=so.reversed)
+        self.sortedObjects.sort(key=lambda x: x._get_value(so.propertyName), reverse=so.reversed)
+      if self.stats is not None:
+        self.stats.add_time("sort", time.time() - t0)
+        self.stats.sortPending = False
+        self.stats.finish()
       self.sortedObjectsIterator = self.sortedObjects.__iter__()
     return self.sortedObjectsIterator.next()
 
+  def close(self):
+    self.queryIterator.close()
+
+
+# Columnar scans, used by Query.to_columns.
+
+# Returns the NumPy dtype used for the columns of property.
+def _column_dtype(numpy, property):
+  if isinstance(property, BooleanProperty):
+    return numpy.dtype(bool)
+  if isinstance(property, IntegerProperty):
+    return numpy.dtype(numpy.int64)
+  if isinstance(property, FloatProperty):
+    return numpy.dtype(numpy.float64)
+  if isinstance(property, DateTimeProperty):
+    return numpy.dtype("datetime64[us]")
+  return numpy.dtype(object)
+
+# Converts a property value to the type used in the columns of property.
+def _to_column_value(numpy, property, value):
+  if isinstance(value, datetime.datetime):
+    return numpy.datetime64(value, "us")
+  return value
+
+# Returns a masked column for property, built from a list of property values.
+def _values_to_column(numpy, property, values):
+  mask = numpy.array([v is None for v in values], dtype=bool)
+  dtype = _column_dtype(numpy, property)
+  if isinstance(property, DateTimeProperty):
+    data = numpy.array(values, dtype=dtype)
+  else:
+    data = numpy.array([0 if v is None else v for v in values], dtype=dtype)
+  return numpy.ma.MaskedArray(data, mask=mask)
+
+# Returns a masked column for property, built from the values stored in the datastore (as returned by
+# Property._to_json, or None if missing).
+def _to_column(numpy, property, values):
+  if property.default is not None:
+    default = property.default
+    if isinstance(default, datetime.datetime):
+      default = (default - datetime.datetime.utcfromtimestamp(0)).total_seconds()
+    values = [default if v is None else v for v in values]
+  mask = numpy.array([v is None for v in values], dtype=bool)
+  dtype = _column_dtype(numpy, property)
+  if dtype == numpy.dtype(object):
+    data = numpy.empty(len(values), dtype=object)
+    data[:] = values
+  elif isinstance(property, DateTimeProperty):
+    seconds = numpy.array([0.0 if v is None else v for v in values], dtype=numpy.float64)
+    data = numpy.round(seconds * 1e6).astype(numpy.int64).astype(dtype)
+  else:
+    data = numpy.array([0 if v is None else v for v in values], dtype=dtype)
+  return numpy.ma.MaskedArray(data, mask=mask)
+
+# Returns the indices that sort the column in ascending order, with a stable sort. Missing values come first, like None
+# in Python.
+def _column_argsort(numpy, column):
+  mask = numpy.ma.getmaskarray(column)
+  data = column.data
+  if data.dtype == numpy.dtype(object):
+    data = data.copy()
+    data[mask] = None
+    return numpy.argsort(data, kind="mergesort")
+  if data.dtype.kind == "M":
+    data = data.view(numpy.int64)
+  return numpy.lexsort((data, ~mask))
+
 
 # Abstract class for defining model properties.
 # You should use one of the specializations: StringProperty, IntegerProperty, BooleanProperty etc.
-class Property:
+class Property(object):
   # Parameters:
   # default: when you put() a model instance with an empty() property value, it is set to default instead.
   # required: if True, an exception is raised when attempting to store an instance with an empty() property value.
   # validator: custom function used to validate property values.
   # choices: list/set of values which are valid property values.
-  # indexed: ignored.
+  # indexed: if False, the property cannot be a column of the composite indexes of the model (see Model.indexes).
   def __init__(self, default=None, required=False, validator=None, choices=None, indexed=True):
     self.default = default
     self.required = required
@@ -360,6 +2148,7 @@ class Property:
     self.indexed = indexed
     self.name = None # set by model... at some point
     self.data_type = None # set by subclass
+    self.slot = None # set by ModelType for the compact models
 
   # The complete validation routine for the property.
   # If value is valid, it returns the value, either unchanged or adapted to the required type.
@@ -389,18 +2178,51 @@ class Property:
   def empty(self, value):
     return value is None
 
-  # Returns a str encoding the value, to be stored in the datastore.
-  def _to_datastore(self, value):
+  # Returns the property itself when read from the model class. On instances, the value is found in the instance
+  # dictionary, or in the slot of the property for the compact models, except for the values not decoded yet, which
+  # are decoded on first access (see Model._get_value).
+  def __get__(self, obj, cls):
+    if obj is not None:
+      if self.slot is not None:
+        try:
+          return self.slot.__get__(obj, cls)
+        except AttributeError:
+          return obj._get_value(self.name)
+      lazy = obj.__dict__.get("_lazy")
+      if lazy:
+        if cls.__dict__.get(self.name) is not self:
+          for k in cls.__dict__:
+            if cls.__dict__[k] is self:
+              self.name = k
+        if self.name in lazy:
+          return obj._get_value(self.name)
+    return self
+
+  # Returns True if the stored value (as read from the datastore, see Model._get_value) can be written back as is,
+  # without being decoded. Empty values are decoded, to get the default.
+  def _keeps_stored(self, stored):
+    return stored is not None
+
+  # Returns the value to store in the datastore, as a JSON value (see Schema).
+  def _to_json(self, value):
     if self.empty(value):
       value = self.default
-    return json.dumps(value)
+    return value
+
+  # Validates and returns the value, as stored by _to_json.
+  def _from_json(self, stored):
+    return self.validate(stored)
+
+  # Returns a str encoding the value, to be stored in the datastore.
+  def _to_datastore(self, value):
+    return json.dumps(self._to_json(value))
 
   # Decodes, validates and returns the value, as encoded by _to_datastore.
   def _from_datastore(self, encoded):
     value = None
     if encoded:
       value = json.loads(encoded)
-    return self.validate(value)
+    return self._from_json(value)
 
   # Filtering support.
   # These operators return a Filter instance storing the comparison.
@@ -461,8 +2283,22 @@ class StringProperty(Property):
     Property.__init__(self, default, required, validator, choices, indexed)
     self.data_type = basestring
 
-TextProperty = StringProperty
-BlobProperty = StringProperty
+# Stores a text, like StringProperty. Large texts can be stored out of line, in a separate record loaded on first
+# access, so that reading or updating the other properties and scanning the kind stay fast whatever their size (see
+# Model.collect_blobs).
+# out_of_line: size in bytes of the encoded value above which it is stored out of line, or None to always store it in
+# the value of the instance. Properties stored out of line cannot be index columns.
+# compressed: if True, the values stored out of line are compressed with zlib.
+class TextProperty(StringProperty):
+  def __init__(self, default=None, required=False, validator=None, choices=None, indexed=True, out_of_line=None,
+               compressed=False):
+    StringProperty.__init__(self, default, required, validator, choices, indexed)
+    self.out_of_line = out_of_line
+    self.compressed = compressed
+
+# Stores binary data in a str, with the same options as TextProperty.
+class BlobProperty(TextProperty):
+  pass
 
 # Stores an integer (int or long).
 class IntegerProperty(Property):
@@ -493,19 +2329,24 @@ class DateTimeProperty(Property):
     self.auto_now_add = auto_now_add
     self.auto_now = auto_now
 
-  def _to_datastore(self, value):
+  # Stored as the number of seconds since the epoch.
+  def _to_json(self, value):
     if self.auto_now or (self.auto_now_add and value is None):
       value = datetime.datetime.now()
     if value is None:
       value = self.default
     if value is not None:
       value = (value - datetime.datetime.utcfromtimestamp(0)).total_seconds()
-    return json.dumps(value)
+    return value
 
-  def _from_datastore(self, encoded):
-    value = json.loads(encoded)
+  def _from_json(self, stored):
+    value = stored
     if not self.empty(value):
       value = datetime.datetime.utcfromtimestamp(value)
     return self.validate(value)
 
+  # The values set to the current time when stored are never written back as read.
+  def _keeps_stored(self, stored):
+    return not self.auto_now and Property._keeps_stored(self, stored)
+
 initDatastoreFromParams()
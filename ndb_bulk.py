@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+import collections
+import datetime
+import itertools
+import json
+import multiprocessing
+import ndb
+import ndb_datastore
+import os
+import sys
+import time
+
+# Bulk loading.
+# bulk_load() stores a large number of instances of a model much faster than put() in a loop:
+# - the records are validated and encoded by a pool of processes;
+# - they are written in large batches sorted by key with Datastore.bulk_set, which doesn't read the previous values
+#   when a batch doesn't overlap the stored instances, and appends to the LMDB B-tree when the batch comes after them
+#   (so loading records sorted by key is the fastest);
+# - the indexes of the model are not updated for each instance, but rebuilt in a single pass at the end;
+# - the progress is reported after each batch, and a checkpoint file records how many records have been stored, so
+#   that an interrupted load is resumed by running it again with the same records and checkpoint file.
+# The records are model instances, or dictionaries of property values with the key under "key" (as read from JSON:
+# the values of DateTimeProperty properties may also be seconds since the epoch or ISO 8601 strings).
+
+# Models being loaded by bulk_load, by id. The worker processes are forked once the model is registered, so they find
+# it here.
+bulkModels = {}
+
+# Returns the model instance for a record given as (key, property values).
+def _record_instance(model, key, values):
+  values = dict(values)
+  for name in values:
+    property = model.__dict__.get(name)
+    if not isinstance(property, ndb.Property):
+      raise ValueError("%s has no property %s" % (model.__name__, name))
+    value = values[name]
+    if isinstance(property, ndb.DateTimeProperty):
+      if isinstance(value, (int, long, float)):
+        values[name] = datetime.datetime.utcfromtimestamp(value)
+      elif isinstance(value, basestring):
+        values[name] = _parse_datetime(value)
+  return model(key, **values)
+
+def _parse_datetime(value):
+  for format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+    try:
+      return datetime.datetime.strptime(value.rstrip("Z"), format)
+    except ValueError:
+      pass
+  raise ValueError("Invalid date and time: %r" % value)
+
+# Validates and encodes a chunk of (record number, key, property values) records. Runs in the worker processes.
+# Returns (True, list of (key, encoded value, records of the values stored out of line)), or (False, exception).
+def _encode_chunk(args):
+  modelId, chunk = args
+  model = bulkModels[modelId]
+  try:
+    encoded = []
+    for number, key, values in chunk:
+      try:
+        obj = _record_instance(model, key, values)
+        encoded.append((obj.key,) + obj._encode())
+      except Exception, e:
+        raise ValueError("Record %d: %s" % (number, e))
+    return True, encoded
+  except Exception, e:
+    return False, e
+
+# Returns the record as (key, property values).
+def _split_record(record):
+  if isinstance(record, ndb.Model):
+    state = record._get_state()
+    names = state.keys() + state.get("_lazy", {}).keys()
+    return record.key, dict([(k, getattr(record, k)) for k in names if k != "key" and not k.startswith("_")])
+  values = dict(record)
+  return values.pop("key", None), values
+
+# Returns the number of records already stored according to the checkpoint file, or 0.
+def _read_checkpoint(checkpoint, model):
+  if checkpoint is None or not os.path.exists(checkpoint):
+    return 0
+  with open(checkpoint) as f:
+    state = json.load(f)
+  if state["kind"] != model.kind():
+    raise ValueError("The checkpoint %s is for kind %s, not %s" % (checkpoint, state["kind"], model.kind()))
+  return state["records"]
+
+# Replaces the checkpoint file atomically.
+def _write_checkpoint(checkpoint, model, records):
+  with open(checkpoint + ".tmp", "w") as f:
+    json.dump({"kind": model.kind(), "records": records}, f)
+  os.rename(checkpoint + ".tmp", checkpoint)
+
+# Default progress function: prints the number of records stored and the throughput on stderr.
+def print_progress(records, seconds):
+  sys.stderr.write("%d records loaded, %.0f records/s\n" % (records, records / seconds if seconds > 0 else 0))
+
+# Stores the instances of model given by records (an iterable, see above), and returns a dictionary with the number of
+# records stored, the elapsed time and the throughput.
+# processes: number of worker processes encoding the records (default: number of CPUs; 1 encodes in this process).
+# batchSize: number of records per write. If several records have the same key in a batch, the last one is stored.
+# chunkSize: number of records per task of the worker processes.
+# checkpoint: path of the checkpoint file. If it exists, the records it counts are skipped; it is removed at the end.
+# progress: function called as progress(records stored, seconds elapsed) after each batch, or None.
+def bulk_load(model, records, processes=None, batchSize=10000, chunkSize=1000, checkpoint=None,
+              progress=print_progress):
+  d = model.get_datastore()
+  kind = model.kind()
+  skipped = _read_checkpoint(checkpoint, model)
+  records = itertools.islice(records, skipped, None)
+  numbered = itertools.izip(itertools.count(skipped + 1), records)
+  chunks = iter(lambda: [(n,) + _split_record(r) for n, r in itertools.islice(numbered, chunkSize)], [])
+  # The worker processes encode with the current version of the schema, added here if needed.
+  model._get_schema().get_current()
+  start = time.time()
+  stored = skipped
+  batch = []
+  batchRecords = 0
+  for encoded in _encode_chunks(model, chunks, processes):
+    batch.extend(encoded)
+    batchRecords += len(encoded)
+    if len(batch) >= batchSize:
+      stored += batchRecords
+      _write_bulk_batch(d, kind, batch)
+      batch = []
+      batchRecords = 0
+      if checkpoint is not None:
+        _write_checkpoint(checkpoint, model, stored)
+      if progress is not None:
+        progress(stored - skipped, time.time() - start)
+  if batch:
+    stored += batchRecords
+    _write_bulk_batch(d, kind, batch)
+    if checkpoint is not None:
+      _write_checkpoint(checkpoint, model, stored)
+    if progress is not None:
+      progress(stored - skipped, time.time() - start)
+  if model._get_indexes():
+    model.build_indexes()
+  if checkpoint is not None and os.path.exists(checkpoint):
+    os.remove(checkpoint)
+  seconds = time.time() - start
+  return {"records": stored - skipped, "seconds": seconds,
+          "recordsPerSecond": (stored - skipped) / seconds if seconds > 0 else None}
+
+# Stores a batch of (key, encoded value, records of the values stored out of line) tuples, keeping the last value of
+# each key, in the order of the encoded keys. The records of the values stored out of line are written first.
+def _write_bulk_batch(d, kind, batch):
+  blobs = {}
+  for _, _, records in batch:
+    blobs.update(records)
+  if blobs:
+    blobKind = ndb_datastore.blob_kind(kind)
+    d.bulk_set(blobKind, sorted(blobs.items(), key=lambda item: ndb_datastore.encode_key(blobKind, item[0])))
+  items = dict([(key, encoded) for key, encoded, _ in batch]).items()
+  items.sort(key=lambda item: ndb_datastore.encode_key(kind, item[0]))
+  d.bulk_set(kind, items)
+
+# Returns an iterator over the encoded chunks, in the order of chunks.
+def _encode_chunks(model, chunks, processes):
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  modelId = id(model)
+  bulkModels[modelId] = model
+  try:
+    if processes == 1:
+      for chunk in chunks:
+        ok, result = _encode_chunk((modelId, chunk))
+        if not ok:
+          raise result
+        yield result
+      return
+    pool = multiprocessing.Pool(processes)
+    try:
+      # At most 2 chunks per process are in flight, so that the records are not read faster than they are encoded.
+      pending = collections.deque()
+      for chunk in chunks:
+        pending.append(pool.apply_async(_encode_chunk, [(modelId, chunk)]))
+        if len(pending) >= 2 * processes:
+          ok, result = pending.popleft().get()
+          if not ok:
+            raise result
+          yield result
+      while pending:
+        ok, result = pending.popleft().get()
+        if not ok:
+          raise result
+        yield result
+    finally:
+      pool.terminate()
+  finally:
+    bulkModels.pop(modelId, None)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+import base64
+import hashlib
+import json
+import ndb_datastore
+import threading
+import zlib
+
+# Compression of the stored values.
+# Wrap a datastore in a CompressingDatastore to compress the values of the objects it stores, whatever the backend.
+# The values of a kind repeat the same property names and similar values, so they compress much better against a
+# shared dictionary than one by one. With dictionaries enabled, the first values written to each kind are sampled, and
+# once enough of them have been collected, a dictionary is built from them and stored in the internal kind
+# dictionaryKind; the next values of the kind are compressed with zlib primed with the dictionary (Python 2 zlib has
+# no preset dictionaries: the primed compressor and decompressor are copied for each value). The dictionaries are keyed
+# by kind and by a hash of their content, so they are never replaced, and the values compressed with an older one stay
+# readable (e.g. after an import).
+# Stored values start with a letter telling how they are encoded:
+#   "j": the value itself follows (used for the values that would otherwise start with one of these letters);
+#   "z", "s", "l": the base64 of the value compressed with zlib, snappy or lz4;
+#   "d": the 8-character id of a dictionary of the kind, then the base64 of the value compressed with it;
+# other values are stored as is: values shorter than the threshold, values that don't shrink once compressed (base64
+# makes them a third larger, since the datastores store JSON strings), and the values stored before compression was
+# enabled. The model values are JSON arrays (or JSON objects, for the values stored before the schemas), so they start
+# with "[" or "{", never with one of these letters. The internal kinds (indexes, out-of-line values, counters) are not
+# compressed. The snapshots, and so the exports, read the values decompressed.
+
+# Internal kind storing the dictionaries, keyed by "<kind>/<id>". The record of key <kind> holds the id of the
+# dictionary used to compress the new values of the kind.
+dictionaryKind = "__compression__"
+
+# Size of the deflate window in bits for the values compressed with a dictionary. The dictionary and the value must fit
+# in the window for the value to use all the dictionary.
+windowBits = 15
+
+# Returns the (compress, decompress) functions of the codec with the given name. snappy and lz4 need the python-snappy
+# and lz4 packages.
+def _load_codec(name):
+  if name == "zlib":
+    return zlib.compress, zlib.decompress
+  elif name == "snappy":
+    import snappy
+    return snappy.compress, snappy.uncompress
+  elif name == "lz4":
+    import lz4.block
+    return lz4.block.compress, lz4.block.decompress
+  raise ValueError("Unknown compression codec %s" % name)
+
+# Markers of the values compressed by each codec.
+codecMarkers = {"zlib": "z", "snappy": "s", "lz4": "l"}
+
+# Returns a compressor and a decompressor primed with dictionary: their copies compress and decompress values against
+# it.
+def _prime(dictionary, level):
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -windowBits, 4)
+  primed = compressor.compress(dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+  decompressor = zlib.decompressobj(-windowBits)
+  decompressor.decompress(primed)
+  return compressor, decompressor
+
+# Returns a dictionary built from samples (a list of values): the concatenation of the most recent samples, up to size
+# bytes. Deflate encodes closer matches more cheaply, so the most recent samples come last.
+def build_dictionary(samples, size):
+  return "".join(samples)[-size:]
+
+# Datastore wrapper compressing the values (see above).
+# codec: "zlib", "snappy" or "lz4" (the latter two are faster, if installed). Values compressed with a dictionary always
+# use zlib.
+# threshold: size in bytes below which the values are stored as is.
+# level: zlib compression level.
+# dictionaries: if True, the values are compressed with a dictionary per kind, built from the first samples values
+# written to the kind, of at most dictionarySize bytes.
+class CompressingDatastore(ndb_datastore.DatastoreWrapper):
+  def __init__(self, datastore, codec="zlib", threshold=128, level=6, dictionaries=False, samples=100,
+               dictionarySize=16384, shared=None):
+    ndb_datastore.DatastoreWrapper.__init__(self, datastore)
+    self.codec = codec
+    self.compressFunction = _load_codec(codec)[0]
+    self.marker = codecMarkers[codec]
+    self.threshold = threshold
+    self.level = level
+    self.dictionaries = dictionaries
+    self.samples = samples
+    self.dictionarySize = dictionarySize
+    # State shared with the snapshots: the lock, the (id, primed compressor) used for each kind (None while sampling),
+    # the samples of each kind, and the primed decompressors by "<kind>/<id>".
+    if shared is None:
+      shared = {"lock": threading.Lock(), "compressors": {}, "samples": {}, "decompressors": {}}
+    self.shared = shared
+
+  # Returns the value to store for value.
+  def _compress(self, kind, value):
+    if ndb_datastore.is_internal_kind(kind):
+      return value
+    if len(value) < self.threshold:
+      if value and value[0] in "jzdsl":
+        return "j" + value
+      return value
+    data = value.encode("utf-8") if isinstance(value, unicode) else value
+    compressor = self._get_compressor(kind, data) if self.dictionaries else None
+    if compressor is not None:
+      dictionaryId, primed = compressor
+      c = primed.copy()
+      stored = "d" + dictionaryId + base64.b64encode(c.compress(data) + c.flush())
+    elif self.codec == "zlib":
+      stored = self.marker + base64.b64encode(zlib.compress(data, self.level))
+    else:
+      stored = self.marker + base64.b64encode(self.compressFunction(data))
+    if len(stored) < len(value):
+      return stored
+    if value[0] in "jzdsl":
+      return "j" + value
+    return value
+
+  # Returns the value stored as stored.
+  def _decompress(self, kind, stored):
+    if stored is None or not stored or ndb_datastore.is_internal_kind(kind) or stored[0] not in "jzdsl":
+      return stored
+    marker = stored[0]
+    if marker == "j":
+      return stored[1:]
+    if marker == "d":
+      d = self._get_decompressor(kind, stored[1:9]).copy()
+      return d.decompress(base64.b64decode(stored[9:])) + d.flush()
+    if marker == "z":
+      return zlib.decompress(base64.b64decode(stored[1:]))
+    codec = [name for name in codecMarkers if codecMarkers[name] == marker][0]
+    return _load_codec(codec)[1](base64.b64decode(stored[1:]))
+
+  # Returns the (id, primed compressor) of the dictionary of kind, or None while the values of the kind are sampled, in
+  # which case data is added to the samples. Once there are enough samples, builds the dictionary and stores it,
+  # unless another process stored one first, which is used instead.
+  def _get_compressor(self, kind, data):
+    shared = self.shared
+    with shared["lock"]:
+      if kind in shared["compressors"]:
+        return shared["compressors"][kind]
+      samples = shared["samples"].get(kind)
+      if samples is None:
+        # First value of the kind written by this process: use the dictionary stored, if any.
+        dictionaryId = self.datastore.get(dictionaryKind, kind)
+        if dictionaryId is not None:
+          return self._load_compressor(kind, dictionaryId)
+        samples = shared["samples"][kind] = []
+      samples.append(data)
+      if len(samples) < self.samples:
+        return None
+      del shared["samples"][kind]
+      dictionary = build_dictionary(samples, self.dictionarySize)
+      dictionaryId = hashlib.sha1(dictionary).hexdigest()[:8]
+      self.datastore.set(dictionaryKind, "%s/%s" % (kind, dictionaryId),
+                         json.dumps({"dictionary": base64.b64encode(dictionary)}))
+      stored = self.datastore.get_or_insert(dictionaryKind, kind, dictionaryId)
+      return self._load_compressor(kind, stored if stored is not None else dictionaryId)
+
+  # Loads the dictionary dictionaryId of kind as the one compressing its values, and returns its compressor. Called
+  # with the lock held.
+  def _load_compressor(self, kind, dictionaryId):
+    compressor, decompressor = _prime(self._read_dictionary(kind, dictionaryId), self.level)
+    self.shared["decompressors"]["%s/%s" % (kind, dictionaryId)] = decompressor
+    self.shared["compressors"][kind] = (dictionaryId, compressor)
+    return self.shared["compressors"][kind]
+
+  # Returns the primed decompressor of the dictionary dictionaryId of kind.
+  def _get_decompressor(self, kind, dictionaryId):
+    recordKey = "%s/%s" % (kind, dictionaryId)
+    decompressor = self.shared["decompressors"].get(recordKey)
+    if decompressor is None:
+      with self.shared["lock"]:
+        decompressor = _prime(self._read_dictionary(kind, dictionaryId), self.level)[1]
+        self.shared["decompressors"][recordKey] = decompressor
+    return decompressor
+
+  def _read_dictionary(self, kind, dictionaryId):
+    record = self.datastore.get(dictionaryKind, "%s/%s" % (kind, dictionaryId))
+    if record is None:
+      raise ValueError("Missing compression dictionary %s of kind %s" % (dictionaryId, kind))
+    return base64.b64decode(json.loads(record)["dictionary"])
+
+  def _compress_ops(self, ops):
+    return [(op[0], op[1], op[2], self._compress(op[1], op[3])) if op[0] == "set" else op for op in ops]
+
+  def set(self, kind, key, value):
+    self.datastore.set(kind, key, self._compress(kind, value))
+
+  def get(self, kind, key):
+    return self._decompress(kind, self.datastore.get(kind, key))
+
+  def get_multi(self, kind, keys):
+    return [self._decompress(kind, value) for value in self.datastore.get_multi(kind, keys)]
+
+  def write_batch(self, ops):
+    ndb_datastore.check_ops(ops)
+    self.datastore.write_batch(self._compress_ops(ops))
+
+  # The checks compare the values as read: the values stored are read again, and the commit checks that they haven't
+  # changed since.
+  def commit(self, checks, ops):
+    storedChecks = []
+    for kind, key, value in checks:
+      stored = self.datastore.get(kind, key)
+      if self._decompress(kind, stored) != value:
+        return False
+      storedChecks.append((kind, key, stored))
+    return self.datastore.commit(storedChecks, self._compress_ops(ops))
+
+  def get_or_insert(self, kind, key, value, ops=[]):
+    old = self.datastore.get_or_insert(kind, key, self._compress(kind, value), self._compress_ops(ops))
+    return self._decompress(kind, old)
+
+  def modify(self, kind, key, function):
+    values = []
+    def modifyStored(stored):
+      value = function(self._decompress(kind, stored))
+      values.append(value)
+      return self._compress(kind, value)
+    if self.datastore.modify(kind, key, modifyStored) is None:
+      return None
+    return values[-1]
+
+  def bulk_set(self, kind, items):
+    self.datastore.bulk_set(kind, [(key, self._compress(kind, value)) for key, value in items])
+
+  def iter_items(self, kind, start=None, end=None):
+    return ((key, self._decompress(kind, value)) for key, value in self.datastore.iter_items(kind, start, end))
+
+  def snapshot(self):
+    return CompressingDatastore(self.datastore.snapshot(), self.codec, self.threshold, self.level, self.dictionaries,
+                                self.samples, self.dictionarySize, self.shared)
@@ -4,6 +4,55 @@
 # Web: https://code.google.com/p/ndb-py
 # License: GPLv2
 
+import collections
+import json
+import sys
+import threading
+import time
+
+# Returns the key used by the persistent datastores to store the object with the given kind and key.
+# Both parts are hex encoded, so the keys of a kind share the same prefix and never contain spaces.
+def encode_key(kind, key):
+  return "%s %s" % (json.dumps(kind).encode("hex"), json.dumps(key).encode("hex"))
+
+# Returns the (kind, key) pair encoded by encode_key.
+def decode_key(encoded):
+  kind, key = encoded.split(" ")
+  return json.loads(kind.decode("hex")), json.loads(key.decode("hex"))
+
+# Returns whether kind is used internally by the module (e.g. for the indexes) rather than by a model. Internal kinds
+# start with "__" and are not listed by get_kinds.
+def is_internal_kind(kind):
+  return kind.startswith("__")
+
+# Returns the internal kind storing the values of kind stored out of line (see ndb.TextProperty).
+def blob_kind(kind):
+  return "__blob__" + kind
+
+# Returns the internal kind storing the versions of the schema of the instances of kind (see ndb.Schema).
+def schema_kind(kind):
+  return "__schema__" + kind
+
+# Returns whether key is in the range [start, end) of iter_items. A bound of None means no limit.
+def in_key_range(key, start, end):
+  return (start is None or key >= start) and (end is None or key < end)
+
+# Raises a ValueError if ops is not a valid list of write operations (see Datastore.write_batch).
+def check_ops(ops):
+  for op in ops:
+    if not ((op[0] == "set" and len(op) == 4) or (op[0] == "delete" and len(op) == 3)):
+      raise ValueError("Bad write operation")
+
+# Returns the value of an object, stored as a JSON object whose fields hold JSON encoded values (e.g. the shards of
+# ndb.ShardedCounter), with delta added to the number of the field, and the new number. A missing or null field counts
+# as 0. See Datastore.increment.
+def add_to_field(value, field, delta):
+  obj = json.loads(value)
+  number = json.loads(obj.get(field) or "null")
+  number = (number or 0) + delta
+  obj[field] = json.dumps(number)
+  return json.dumps(obj), number
+
 # Interface for the datastore.
 # Outside the module you should not care about the datastore, except for creating it. See the function setDatastore
 # below.
@@ -25,31 +74,436 @@ class Datastore:
   def delete(self, kind, key):
     raise NotImplementedError()
 
+  # Returns a list with the values of the objects with the given kind and keys, in the same order as keys. The value
+  # is None for objects that do not exist.
+  def get_multi(self, kind, keys):
+    return [self.get(kind, key) for key in keys]
+
+  # Applies a list of write operations. Each operation is a tuple, either ("set", kind, key, value) or
+  # ("delete", kind, key), applied in order. Datastores that support it apply all of them atomically.
+  def write_batch(self, ops):
+    check_ops(ops)
+    for op in ops:
+      if op[0] == "set":
+        self.set(op[1], op[2], op[3])
+      else:
+        self.delete(op[1], op[2])
+
+  # Applies the write operations ops (see write_batch) atomically if the objects of checks, a list of (kind, key, value)
+  # tuples, still have the given values (None meaning that the object does not exist). Returns True if the operations
+  # were applied, False otherwise. Used by the optimistic transactions (see TransactionDatastore).
+  def commit(self, checks, ops):
+    raise NotImplementedError()
+
+  # Returns the value of the object with the given kind and key if it exists. Otherwise stores it with the given value,
+  # along with the write operations ops if any (e.g. its index records), and returns None. Atomic: if several threads
+  # or processes insert the same object at once, only one of them stores it.
+  def get_or_insert(self, kind, key, value, ops=[]):
+    while True:
+      old = self.get(kind, key)
+      if old is not None:
+        return old
+      if self.commit([(kind, key, None)], [("set", kind, key, value)] + ops):
+        return None
+
+  # Replaces the value of the object with the given kind and key by function(value), and returns the new value, or None
+  # if the object does not exist. Atomic: the object cannot change between the read and the write, so concurrent
+  # modifications are never lost. function may be called several times, and must not have side effects.
+  def modify(self, kind, key, function):
+    while True:
+      old = self.get(kind, key)
+      if old is None:
+        return None
+      value = function(old)
+      if self.commit([(kind, key, old)], [("set", kind, key, value)]):
+        return value
+
+  # Adds delta to the number in the field of the object with the given kind and key, stored as a JSON object (see
+  # add_to_field), and returns the new number, or None if the object does not exist. Atomic, see modify.
+  def increment(self, kind, key, field, delta):
+    numbers = []
+    def add(value):
+      value, number = add_to_field(value, field, delta)
+      numbers.append(number)
+      return value
+    if self.modify(kind, key, add) is None:
+      return None
+    return numbers[-1]
+
+  # Stores the (key, value) pairs of items in kind. Used by bulk loads (see ndb_bulk): the keys must be unique, and sorted
+  # by their encoding (see encode_key), so that the datastores can write them faster. Not atomic.
+  def bulk_set(self, kind, items):
+    self.write_batch([("set", kind, key, value) for key, value in items])
+
   # Returns an iterator over the keys of the objects with a given kind.
   def iter(self, kind):
     raise NotImplementedError()
 
+  # Returns an iterator over the (key, value) pairs of the objects with a given kind.
+  # The persistent datastores read the values along with the keys, in key order.
+  # If start or end is given, only the keys in the range [start, end) are returned, in increasing order. Ranges are
+  # only supported for keys made of lowercase hex digits (as used by the indexes), for which all the datastores agree
+  # on the order.
+  def iter_items(self, kind, start=None, end=None):
+    if start is None and end is None:
+      return self._iter_all_items(kind)
+    keys = sorted([key for key in self.iter(kind) if in_key_range(key, start, end)])
+    return ((key, value) for key, value in zip(keys, self.get_multi(kind, keys)) if value is not None)
+
+  def _iter_all_items(self, kind):
+    for key in self.iter(kind):
+      value = self.get(kind, key)
+      if value is not None:
+        yield key, value
+
   # Returns the path where the datastore is located on disk, or None if not applicable.
   def get_path(self):
     return None
 
-  # Returns a sorted list of all the kinds in the datastore.
+  # Returns a sorted list of all the kinds in the datastore, internal kinds excluded.
   def get_kinds(self):
     raise NotImplementedError()
 
+  # Returns a dictionary mapping each kind to a dictionary holding the number of objects ("count") and the total size
+  # of their values in bytes ("bytes"). Internal kinds are included, so the size of the indexes can be monitored.
+  def get_kind_stats(self):
+    raise NotImplementedError()
+
+  # Returns a read-only datastore holding the state of this one at the time of the call, consistent across kinds,
+  # which doesn't block the writes to this one. Its writes raise a ValueError. Close it once done, to release the
+  # resources it holds.
+  def snapshot(self):
+    raise NotImplementedError()
+
+  # Returns the live datastore holding the data read through this one: itself, the datastore a snapshot was taken from
+  # (its origin attribute), or the datastore a wrapper forwards to.
+  def get_origin(self):
+    origin = getattr(self, "origin", None)
+    if origin is None:
+      return self
+    return origin.get_origin()
+
+  # Returns the executor used to run the asynchronous operations on this datastore, creating it on first use.
+  def get_executor(self):
+    with executorLock:
+      if getattr(self, "executor", None) is None:
+        self.executor = DatastoreExecutor(self)
+      return self.executor
+
+  # Stops the executor, if any. Pending operations are completed first.
+  def stop_executor(self):
+    with executorLock:
+      executor = getattr(self, "executor", None)
+      self.executor = None
+    if executor is not None:
+      executor.stop()
+
   def close(self):
     pass
 
 
+# Result of an asynchronous operation.
+# get_result() waits for the operation to complete, then returns its result or raises its exception.
+class Future:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.event = threading.Event()
+    self.result = None
+    self.excInfo = None
+    self.callbacks = []
+
+  def set_result(self, result):
+    self.result = result
+    self._complete()
+
+  # Sets the exception raised by the operation. Call it from an except block, so the traceback is kept.
+  def set_exception(self, exception):
+    excInfo = sys.exc_info()
+    if excInfo[1] is not exception:
+      excInfo = (exception.__class__, exception, None)
+    self.excInfo = excInfo
+    self._complete()
+
+  def _complete(self):
+    with self.lock:
+      self.event.set()
+      callbacks = self.callbacks
+      self.callbacks = []
+    for callback in callbacks:
+      callback(self)
+
+  def done(self):
+    return self.event.is_set()
+
+  def wait(self):
+    self.event.wait()
+
+  def get_result(self):
+    self.event.wait()
+    if self.excInfo is not None:
+      raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+    return self.result
+
+  # Calls callback(future) once the operation completes, or right away if it has already completed.
+  def add_callback(self, callback):
+    with self.lock:
+      if not self.event.is_set():
+        self.callbacks.append(callback)
+        return
+    callback(self)
+
+  # Returns a new future, completed with function(result) once this one completes.
+  def chain(self, function):
+    future = Future()
+    def callback(f):
+      try:
+        future.set_result(function(f.get_result()))
+      except Exception, e:
+        future.set_exception(e)
+    self.add_callback(callback)
+    return future
+
+
+# Waits for all the futures to complete.
+def wait_all(futures):
+  for future in futures:
+    future.wait()
+
+# Protects the creation of the datastore executors.
+executorLock = threading.Lock()
+
+# Runs datastore operations on a bounded pool of threads, on behalf of the asynchronous API.
+# Operations queued while the workers are busy are batched: all the pending gets are served with one get_multi() per
+# kind, and all the pending sets and deletes with one write_batch().
+class DatastoreExecutor:
+  def __init__(self, datastore, maxWorkers=4, maxBatchSize=500):
+    self.datastore = datastore
+    self.maxBatchSize = maxBatchSize
+    self.queue = collections.deque()
+    self.condition = threading.Condition()
+    self.stopped = False
+    self.threads = []
+    for i in range(maxWorkers):
+      t = threading.Thread(target=self._run)
+      t.daemon = True
+      self.threads.append(t)
+      t.start()
+
+  # Queues a get of the object with the given kind and key. The future returns the value, or None.
+  def get(self, kind, key):
+    return self._submit([("get", kind, key)])[0]
+
+  # Queues the gets of several objects of the same kind at once. Returns a list of futures, as get() does.
+  def get_multi(self, kind, keys):
+    return self._submit([("get", kind, key) for key in keys])
+
+  # Queues a write operation, as accepted by Datastore.write_batch. The future returns None.
+  def write(self, op):
+    return self._submit([("write", op)])[0]
+
+  # Queues several write operations at once. Returns a list of futures, as write() does.
+  def write_multi(self, ops):
+    return self._submit([("write", op) for op in ops])
+
+  # Queues a call to function(*args). The future returns its result.
+  def call(self, function, *args):
+    return self._submit([("call", function, args)])[0]
+
+  def stop(self):
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    for t in self.threads:
+      t.join()
+
+  def _submit(self, ops):
+    futures = [Future() for op in ops]
+    with self.condition:
+      if self.stopped:
+        raise ValueError("The datastore executor has been stopped")
+      self.queue.extend(zip(ops, futures))
+      self.condition.notify()
+    return futures
+
+  # Takes the next operation from the queue, along with the queued operations of the same type that can be batched
+  # with it.
+  def _next_batch(self):
+    with self.condition:
+      while not self.queue:
+        if self.stopped:
+          return None
+        self.condition.wait()
+      batch = [self.queue.popleft()]
+      opType = batch[0][0][0]
+      if opType != "call" and self.queue:
+        rest = collections.deque()
+        for item in self.queue:
+          if item[0][0] == opType and len(batch) < self.maxBatchSize:
+            batch.append(item)
+          else:
+            rest.append(item)
+        self.queue = rest
+      return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      opType = batch[0][0][0]
+      if opType == "get":
+        self._run_gets(batch)
+      elif opType == "write":
+        self._run_writes(batch)
+      else:
+        op, future = batch[0]
+        try:
+          future.set_result(op[1](*op[2]))
+        except Exception, e:
+          future.set_exception(e)
+
+  def _run_gets(self, batch):
+    byKind = collections.OrderedDict()
+    for op, future in batch:
+      byKind.setdefault(op[1], []).append((op[2], future))
+    for kind in byKind:
+      items = byKind[kind]
+      keys = list(collections.OrderedDict.fromkeys([key for key, _ in items]))
+      try:
+        values = dict(zip(keys, self.datastore.get_multi(kind, keys)))
+      except Exception, e:
+        for _, future in items:
+          future.set_exception(e)
+        continue
+      for key, future in items:
+        future.set_result(values[key])
+
+  def _run_writes(self, batch):
+    try:
+      self.datastore.write_batch([op[1] for op, _ in batch])
+    except Exception, e:
+      for _, future in batch:
+        future.set_exception(e)
+      return
+    for _, future in batch:
+      future.set_result(None)
+
+
+# Catalog of the kinds stored in a persistent datastore.
+# For each kind it keeps the number of objects and the total size of their values. The datastore stores it as one
+# metadata record per kind, written together with the objects it accounts for, and loads it when opened. This way
+# get_kinds() and get_kind_stats() do not have to seek through the keys.
+class KindCatalog:
+  # Prefix of the metadata records. Object keys are hex encoded (see encode_key), so they never start with "!".
+  prefix = "!kind "
+  # Key of the record marking the catalog as complete. Datastores created before the catalog existed don't have it,
+  # and must rebuild the catalog with a full scan the first time they are opened.
+  marker = "!catalog"
+
+  def __init__(self):
+    self.stats = {}
+
+  # Returns the key of the metadata record for kind.
+  def record_key(self, kind):
+    return self.prefix + json.dumps(kind).encode("hex")
+
+  # Loads a metadata record read from the datastore.
+  def load(self, recordKey, record):
+    kind = json.loads(recordKey[len(self.prefix):].decode("hex"))
+    self.stats[kind] = json.loads(record)
+
+  # Accounts for a change in the stored value of an object, from oldValue to newValue (either can be None, meaning
+  # that the object does not exist), in the in-memory catalog only. Used to rebuild the catalog; the writes go through
+  # KindCatalogChanges instead.
+  def update_value(self, kind, oldValue, newValue):
+    countDelta, bytesDelta = _value_delta(oldValue, newValue)
+    stats = self.stats.get(kind, {"count": 0, "bytes": 0})
+    self.stats[kind] = {"count": stats["count"] + countDelta, "bytes": stats["bytes"] + bytesDelta}
+
+  # Returns all the metadata records, used after rebuilding the catalog.
+  def records(self):
+    return [(self.record_key(kind), json.dumps(self.stats[kind])) for kind in self.stats]
+
+  def get_kinds(self):
+    return sorted([kind for kind in self.stats.keys() if self.stats[kind]["count"] > 0 and not is_internal_kind(kind)])
+
+  def get_kind_stats(self):
+    stats = {}
+    for kind in self.stats.keys():
+      if self.stats[kind]["count"] > 0:
+        stats[kind] = dict(self.stats[kind])
+    return stats
+
+
+# Returns the change in the number of objects and in their total size when the stored value of an object changes from
+# oldValue to newValue (either can be None, meaning that the object does not exist).
+def _value_delta(oldValue, newValue):
+  countDelta = 0
+  bytesDelta = 0
+  if oldValue is not None:
+    countDelta -= 1
+    bytesDelta -= len(oldValue)
+  if newValue is not None:
+    countDelta += 1
+    bytesDelta += len(newValue)
+  return countDelta, bytesDelta
+
+
+# Changes of a KindCatalog made by a write.
+# The changes are accumulated while the write is prepared, then added to the metadata records as stored when the write
+# is applied, so that the processes sharing a datastore (e.g. LMDB) keep each other's counts, and loaded into the
+# in-memory catalog once the write has succeeded.
+class KindCatalogChanges:
+  def __init__(self, catalog):
+    self.catalog = catalog
+    self.deltas = {}
+    self.written = []
+
+  # Accounts for a change of countDelta objects and bytesDelta bytes in kind.
+  def add(self, kind, countDelta, bytesDelta):
+    delta = self.deltas.setdefault(kind, [0, 0])
+    delta[0] += countDelta
+    delta[1] += bytesDelta
+
+  # Accounts for a change in the stored value of an object, from oldValue to newValue (either can be None).
+  def add_value(self, kind, oldValue, newValue):
+    self.add(kind, *_value_delta(oldValue, newValue))
+
+  # Returns the (key, value) of the metadata records to write along with the change. read(recordKey) returns a record
+  # as stored, or None; call it within the write (transaction or write lock), so that no other write changes the
+  # records meanwhile.
+  def records(self, read):
+    self.written = []
+    for kind in self.deltas:
+      recordKey = self.catalog.record_key(kind)
+      stored = read(recordKey)
+      stats = {"count": 0, "bytes": 0} if stored is None else json.loads(stored)
+      stats = {"count": stats["count"] + self.deltas[kind][0], "bytes": stats["bytes"] + self.deltas[kind][1]}
+      self.written.append((recordKey, json.dumps(stats)))
+    return self.written
+
+  # Loads the records written into the in-memory catalog. Call it once the write has succeeded.
+  def apply(self):
+    for recordKey, record in self.written:
+      self.catalog.load(recordKey, record)
+
+
 # In-memory, dictionary-based datastore.
 class MemDatastore(Datastore):
   def __init__(self):
     self.data = {}
+    self.sizes = {}
+    self.lock = threading.RLock()
 
   def set(self, kind, key, value):
-    if kind not in self.data:
-      self.data[kind] = {}
-    self.data[kind][key] = value
+    with self.lock:
+      if kind not in self.data:
+        self.data[kind] = {}
+        self.sizes[kind] = 0
+      if key in self.data[kind]:
+        self.sizes[kind] -= len(self.data[kind][key])
+      self.data[kind][key] = value
+      self.sizes[kind] += len(value)
 
   def get(self, kind, key):
     if kind not in self.data:
@@ -59,19 +513,100 @@ class MemDatastore(Datastore):
     return self.data[kind][key]
 
   def delete(self, kind, key):
-    if kind not in self.data:
-      return
-    if key not in self.data[kind]:
-      return
-    del self.data[kind][key]
+    with self.lock:
+      if kind not in self.data:
+        return
+      if key not in self.data[kind]:
+        return
+      self.sizes[kind] -= len(self.data[kind][key])
+      del self.data[kind][key]
+
+  def get_multi(self, kind, keys):
+    data = self.data.get(kind, {})
+    return [data.get(key) for key in keys]
+
+  def write_batch(self, ops):
+    with self.lock:
+      Datastore.write_batch(self, ops)
+
+  def commit(self, checks, ops):
+    with self.lock:
+      for kind, key, value in checks:
+        if self.get(kind, key) != value:
+          return False
+      Datastore.write_batch(self, ops)
+    return True
+
+  def modify(self, kind, key, function):
+    with self.lock:
+      old = self.get(kind, key)
+      if old is None:
+        return None
+      value = function(old)
+      self.set(kind, key, value)
+    return value
 
   def iter(self, kind):
     if kind not in self.data:
       self.data[kind] = {}
+      self.sizes[kind] = 0
     return MemDatastoreIterator(self, kind)
 
+  def iter_items(self, kind, start=None, end=None):
+    with self.lock:
+      items = self.data.get(kind, {}).items()
+    if start is not None or end is not None:
+      items = sorted([item for item in items if in_key_range(item[0], start, end)])
+    return items.__iter__()
+
+  # The snapshot is a copy of the dictionaries of the datastore; the values are shared.
+  def snapshot(self):
+    snapshot = MemDatastoreSnapshot()
+    with self.lock:
+      for kind in self.data:
+        snapshot.data[kind] = dict(self.data[kind])
+      snapshot.sizes = dict(self.sizes)
+    snapshot.origin = self
+    return snapshot
+
   def get_kinds(self):
-    return sorted(self.data.keys())
+    return sorted([kind for kind in self.data.keys() if self.data[kind] and not is_internal_kind(kind)])
+
+  def get_kind_stats(self):
+    stats = {}
+    for kind in self.data.keys():
+      if self.data[kind]:
+        stats[kind] = {"count": len(self.data[kind]), "bytes": self.sizes[kind]}
+    return stats
+
+
+class MemDatastoreSnapshot(MemDatastore):
+  def set(self, kind, key, value):
+    raise ValueError("Datastore snapshots are read-only")
+
+  def delete(self, kind, key):
+    raise ValueError("Datastore snapshots are read-only")
+
+  def write_batch(self, ops):
+    raise ValueError("Datastore snapshots are read-only")
+
+  def commit(self, checks, ops):
+    raise ValueError("Datastore snapshots are read-only")
+
+
+# Base class of the snapshots of the persistent datastores (see Datastore.snapshot).
+class DatastoreSnapshot(Datastore):
+  def set(self, kind, key, value):
+    raise ValueError("Datastore snapshots are read-only")
+
+  def delete(self, kind, key):
+    raise ValueError("Datastore snapshots are read-only")
+
+  def write_batch(self, ops):
+    raise ValueError("Datastore snapshots are read-only")
+
+  def commit(self, checks, ops):
+    raise ValueError("Datastore snapshots are read-only")
 
 
 class MemDatastoreIterator:
@@ -85,3 +620,242 @@ class MemDatastoreIterator:
 
   def next(self):
     return self.datastoreIterator.next()
+
+
+# Datastore forwarding all the calls to another datastore.
+# Derive it to add behavior on top of any datastore implementation.
+class DatastoreWrapper(Datastore):
+  def __init__(self, datastore):
+    self.datastore = datastore
+
+  def set(self, kind, key, value):
+    self.datastore.set(kind, key, value)
+
+  def get(self, kind, key):
+    return self.datastore.get(kind, key)
+
+  def delete(self, kind, key):
+    self.datastore.delete(kind, key)
+
+  def get_multi(self, kind, keys):
+    return self.datastore.get_multi(kind, keys)
+
+  def write_batch(self, ops):
+    self.datastore.write_batch(ops)
+
+  def commit(self, checks, ops):
+    return self.datastore.commit(checks, ops)
+
+  def get_or_insert(self, kind, key, value, ops=[]):
+    return self.datastore.get_or_insert(kind, key, value, ops)
+
+  def modify(self, kind, key, function):
+    return self.datastore.modify(kind, key, function)
+
+  def iter(self, kind):
+    return self.datastore.iter(kind)
+
+  def bulk_set(self, kind, items):
+    self.datastore.bulk_set(kind, items)
+
+  def iter_items(self, kind, start=None, end=None):
+    return self.datastore.iter_items(kind, start, end)
+
+  def get_path(self):
+    return self.datastore.get_path()
+
+  def snapshot(self):
+    return self.datastore.snapshot()
+
+  def get_origin(self):
+    return self.datastore.get_origin()
+
+  def get_kinds(self):
+    return self.datastore.get_kinds()
+
+  def get_kind_stats(self):
+    return self.datastore.get_kind_stats()
+
+  def close(self):
+    self.datastore.close()
+
+
+# Datastore wrapper running an optimistic transaction on the wrapped datastore.
+# The reads are served by the writes of the transaction if it wrote the objects, and by the wrapped datastore
+# otherwise; the values read from the wrapped datastore are recorded, so that reading an object again returns the same
+# value. The writes are buffered until commit_transaction(), which applies them atomically if none of the objects read
+# has changed meanwhile (see Datastore.commit). The iterations are not part of the transaction: they read the wrapped
+# datastore, without the writes of the transaction.
+class TransactionDatastore(DatastoreWrapper):
+  def __init__(self, datastore):
+    DatastoreWrapper.__init__(self, datastore)
+    self.lock = threading.Lock()
+    # Values read from the wrapped datastore, by (kind, key).
+    self.reads = {}
+    # Values written (None for the deletes), by (kind, key), in the order of their last write.
+    self.writes = collections.OrderedDict()
+
+  def set(self, kind, key, value):
+    self.write_batch([("set", kind, key, value)])
+
+  def get(self, kind, key):
+    return self.get_multi(kind, [key])[0]
+
+  def delete(self, kind, key):
+    self.write_batch([("delete", kind, key)])
+
+  def get_multi(self, kind, keys):
+    with self.lock:
+      missing = [key for key in keys if (kind, key) not in self.writes and (kind, key) not in self.reads]
+    missing = list(collections.OrderedDict.fromkeys(missing))
+    values = self.datastore.get_multi(kind, missing) if missing else []
+    with self.lock:
+      for key, value in zip(missing, values):
+        self.reads.setdefault((kind, key), value)
+      return [self.writes[(kind, key)] if (kind, key) in self.writes else self.reads[(kind, key)] for key in keys]
+
+  def write_batch(self, ops):
+    check_ops(ops)
+    with self.lock:
+      for op in ops:
+        self.writes.pop((op[1], op[2]), None)
+        self.writes[(op[1], op[2])] = op[3] if op[0] == "set" else None
+
+  def bulk_set(self, kind, items):
+    self.write_batch([("set", kind, key, value) for key, value in items])
+
+  # The read and the write are validated along with the other ones when the transaction is committed.
+  def get_or_insert(self, kind, key, value, ops=[]):
+    old = self.get(kind, key)
+    if old is None:
+      self.write_batch([("set", kind, key, value)] + ops)
+    return old
+
+  def modify(self, kind, key, function):
+    old = self.get(kind, key)
+    if old is None:
+      return None
+    value = function(old)
+    self.set(kind, key, value)
+    return value
+
+  # Returns the (kind, key) pairs of the objects written by the transaction.
+  def written_keys(self):
+    with self.lock:
+      return self.writes.keys()
+
+  # Applies the writes of the transaction to the wrapped datastore if the objects read are unchanged. Returns True if
+  # the transaction was committed, False if it conflicted with another write.
+  def commit_transaction(self):
+    with self.lock:
+      checks = [(kind, key, value) for (kind, key), value in self.reads.items()]
+      ops = []
+      for (kind, key), value in self.writes.items():
+        if value is None:
+          ops.append(("delete", kind, key))
+        else:
+          ops.append(("set", kind, key, value))
+    return self.datastore.commit(checks, ops)
+
+
+# Coalesces items submitted concurrently by several threads into batches.
+# The first thread to submit an item while no batch is being sent becomes the sender: it waits up to maxLatency
+# seconds for more items (less if maxBatchSize items are pending), and calls send() with the pending items, up to
+# maxBatchSize. Each sender sends a single batch, the one holding its own item, so that it returns as soon as its item
+# is done; if items were submitted meanwhile, the thread which submitted the first of them becomes the next sender. The
+# other threads just wait for their result.
+# send(items) must return a list with one result per item.
+class AutoBatcher:
+  def __init__(self, send, maxBatchSize=500, maxLatency=0.0):
+    self.send = send
+    self.maxBatchSize = maxBatchSize
+    self.maxLatency = maxLatency
+    self.condition = threading.Condition()
+    self.pending = []
+    self.sending = False
+    # Future of the item whose submitter is handed the sender role, or None.
+    self.nextSender = None
+
+  # Submits item, waits for the batch holding it to be sent, and returns the result for item.
+  def submit(self, item):
+    future = Future()
+    with self.condition:
+      self.pending.append((item, future))
+      sender = not self.sending
+      if sender:
+        self.sending = True
+      else:
+        if len(self.pending) >= self.maxBatchSize:
+          self.condition.notify_all()
+        while not future.done() and self.nextSender is not future:
+          self.condition.wait()
+        sender = self.nextSender is future
+        if sender:
+          self.nextSender = None
+    if sender:
+      self._send_batch()
+    return future.get_result()
+
+  # Sends the first pending items, which hold the item of the sender, then hands the sender role to the submitter of
+  # the next pending item, or gives it up if there is none, in the same critical section that finds it, so that no
+  # item is left without a sender.
+  def _send_batch(self):
+    try:
+      with self.condition:
+        if self.maxLatency > 0:
+          deadline = time.time() + self.maxLatency
+          while len(self.pending) < self.maxBatchSize:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+              break
+            self.condition.wait(remaining)
+        batch = self.pending[:self.maxBatchSize]
+        self.pending = self.pending[self.maxBatchSize:]
+      try:
+        results = self.send([item for item, _ in batch])
+      except Exception, e:
+        for _, future in batch:
+          future.set_exception(e)
+      else:
+        for i in range(len(batch)):
+          batch[i][1].set_result(results[i])
+    finally:
+      with self.condition:
+        if self.pending:
+          self.nextSender = self.pending[0][1]
+        else:
+          self.sending = False
+        self.condition.notify_all()
+
+
+# Datastore wrapper batching the point operations issued concurrently by several threads.
+# Concurrent gets are served with one get_multi() per kind, and concurrent sets and deletes are applied with one
+# write_batch(), i.e. one LevelDB write batch or one LMDB transaction. Callers don't have to change: each call still
+# blocks until its own operation is done. See AutoBatcher for maxBatchSize and maxLatency.
+class AutoBatchingDatastore(DatastoreWrapper):
+  def __init__(self, datastore, maxBatchSize=500, maxLatency=0.0):
+    DatastoreWrapper.__init__(self, datastore)
+    self.gets = AutoBatcher(self._send_gets, maxBatchSize, maxLatency)
+    self.writes = AutoBatcher(self._send_writes, maxBatchSize, maxLatency)
+
+  def set(self, kind, key, value):
+    self.writes.submit(("set", kind, key, value))
+
+  def get(self, kind, key):
+    return self.gets.submit((kind, key))
+
+  def delete(self, kind, key):
+    self.writes.submit(("delete", kind, key))
+
+  def _send_gets(self, items):
+    byKind = collections.OrderedDict()
+    for kind, key in items:
+      byKind.setdefault(kind, collections.OrderedDict())[key] = None
+    for kind in byKind:
+      keys = byKind[kind].keys()
+      byKind[kind] = dict(zip(keys, self.datastore.get_multi(kind, keys)))
+    return [byKind[kind][key] for kind, key in items]
+
+  def _send_writes(self, ops):
+    self.datastore.write_batch(ops)
+    return [None] * len(ops)
@@ -8,6 +8,7 @@ import bsddb
 import json
 import ndb_datastore
 import os
+import threading
 
 # Datastore implemented on top of BerkeleyDB via the bsddb module.
 class BDBDatastore(ndb_datastore.Datastore):
@@ -18,49 +19,129 @@ class BDBDatastore(ndb_datastore.Datastore):
     except:
       pass
     self.db = bsddb.btopen(os.path.join(self.path, "datastore.db"), "c")
+    # Serializes the writes, so that the kind catalog is updated consistently.
+    self.lock = threading.Lock()
+    self.catalog = ndb_datastore.KindCatalog()
+    self._load_catalog()
 
   def set(self, kind, key, value):
-    kind = json.dumps(kind).encode("hex")
-    key = json.dumps(key).encode("hex")
-    value = json.dumps(value)
-    self.db["%s %s" % (kind, key)] = value
+    self.write_batch([("set", kind, key, value)])
 
   def get(self, kind, key):
-    kind = json.dumps(kind).encode("hex")
-    key = json.dumps(key).encode("hex")
-    value = None
-    try:
-      value = self.db["%s %s" % (kind, key)]
-    except:
-      value = None
+    value = self._get(ndb_datastore.encode_key(kind, key))
     if value is None:
       return None
     value = json.loads(value)
     return value
 
-  def delete(self, kind, key):
+  # Returns the raw value stored with the encoded key, or None.
+  def _get(self, key):
     try:
-      del self.db["%s %s" % (kind, key)]
+      return self.db[key]
     except:
-      pass
+      return None
+
+  def delete(self, kind, key):
+    self.write_batch([("delete", kind, key)])
+
+  # Applies the operations in order while holding the write lock. BerkeleyDB is used without transactions, so the
+  # batch is not atomic.
+  def write_batch(self, ops):
+    ndb_datastore.check_ops(ops)
+    with self.lock:
+      self._write_ops(ops)
+
+  # Checks the values and applies the operations while holding the write lock. Isolated from the other writes, but
+  # not atomic, as write_batch.
+  def commit(self, checks, ops):
+    ndb_datastore.check_ops(ops)
+    with self.lock:
+      for kind, key, value in checks:
+        if self.get(kind, key) != value:
+          return False
+      self._write_ops(ops)
+    return True
+
+  def get_or_insert(self, kind, key, value, ops=[]):
+    ndb_datastore.check_ops(ops)
+    with self.lock:
+      old = self.get(kind, key)
+      if old is None:
+        self._write_ops([("set", kind, key, value)] + ops)
+    return old
+
+  def modify(self, kind, key, function):
+    with self.lock:
+      old = self.get(kind, key)
+      if old is None:
+        return None
+      value = function(old)
+      self._write_ops([("set", kind, key, value)])
+    return value
+
+  # Applies the operations in order, then updates the metadata records. The caller holds the write lock.
+  def _write_ops(self, ops):
+    changes = ndb_datastore.KindCatalogChanges(self.catalog)
+    for op in ops:
+      key = ndb_datastore.encode_key(op[1], op[2])
+      old = self._get(key)
+      value = None
+      if op[0] == "set":
+        value = json.dumps(op[3])
+        self.db[key] = value
+      elif old is not None:
+        del self.db[key]
+      else:
+        continue
+      changes.add_value(op[1], old, value)
+    for recordKey, record in changes.records(self._get):
+      self.db[recordKey] = record
+    changes.apply()
 
   def iter(self, kind):
     return BDBDatastoreIterator(self, kind)
 
-  def get_kinds(self):
-    kinds = set()
-    offset = ""
+  def iter_items(self, kind, start=None, end=None):
+    prefix = json.dumps(kind).encode("hex") + " "
+    offset = prefix if start is None else ndb_datastore.encode_key(kind, start)
+    last = None if end is None else ndb_datastore.encode_key(kind, end)
     while True:
       try:
-        key, _ = self.db.set_location(offset)
-        if (not key):
-          break
-        key = key.split(" ")[0]
-        offset = key + "."
-        kinds.add(json.loads(key.decode("hex")))
+        key, value = self.db.set_location(offset)
+      except:
+        return
+      if not key.startswith(prefix) or (last is not None and key >= last):
+        return
+      offset = key + "."
+      yield json.loads(key[len(prefix):].decode("hex")), json.loads(value)
+
+  def get_kinds(self):
+    return self.catalog.get_kinds()
+
+  def get_kind_stats(self):
+    return self.catalog.get_kind_stats()
+
+  # Loads the kind catalog, or rebuilds it with a full scan if the datastore does not have one yet.
+  def _load_catalog(self):
+    prefix = ndb_datastore.KindCatalog.prefix
+    if self._get(ndb_datastore.KindCatalog.marker) is not None:
+      try:
+        key, value = self.db.set_location(prefix)
+        while key.startswith(prefix):
+          self.catalog.load(key, value)
+          key, value = self.db.next()
       except:
-        break
-    return sorted(list(kinds))
+        pass
+      return
+    for key in self.db.keys():
+      if key.startswith("!"):
+        continue
+      kind, _ = ndb_datastore.decode_key(key)
+      self.catalog.update_value(kind, None, self.db[key])
+    for recordKey, record in self.catalog.records():
+      self.db[recordKey] = record
+    self.db[ndb_datastore.KindCatalog.marker] = "1"
+    self.db.sync()
 
   def get_path(self):
     return self.path
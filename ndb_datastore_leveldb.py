@@ -7,56 +7,192 @@
 import json
 import leveldb
 import ndb_datastore
+import threading
 
 # Datastore implemented on top of LevelDB.
 class LevelDBDatastore(ndb_datastore.Datastore):
   def __init__(self, path="level.db"):
     self.path = path
     self.db = leveldb.DB(self.path, create_if_missing=True)
+    # Serializes the writes, so that the kind catalog is updated consistently.
+    self.lock = threading.Lock()
+    self.catalog = ndb_datastore.KindCatalog()
+    self._load_catalog()
 
   def set(self, kind, key, value):
-    kind = json.dumps(kind).encode("hex")
-    key = json.dumps(key).encode("hex")
-    value = json.dumps(value)
-    self.db.put("%s %s" % (kind, key), value)
+    self.write_batch([("set", kind, key, value)])
 
   def get(self, kind, key):
-    kind = json.dumps(kind).encode("hex")
-    key = json.dumps(key).encode("hex")
-    value = self.db.get("%s %s" % (kind, key))
-    if value is None:
-      return None
-    value = json.loads(value)
-    return value
+    return _get_multi(self.db, kind, [key])[0]
+
+  def get_multi(self, kind, keys):
+    return _get_multi(self.db.snapshot(), kind, keys)
 
   def delete(self, kind, key):
-    self.db.delete("%s %s" % (kind, key))
+    self.write_batch([("delete", kind, key)])
+
+  # Applies all the operations with a single LevelDB write batch.
+  def write_batch(self, ops):
+    ndb_datastore.check_ops(ops)
+    with self.lock:
+      self._write_ops(ops)
+
+  # Checks the values and applies the operations while holding the write lock, so that no other write can come in
+  # between.
+  def commit(self, checks, ops):
+    ndb_datastore.check_ops(ops)
+    with self.lock:
+      for kind, key, value in checks:
+        if _get_multi(self.db, kind, [key])[0] != value:
+          return False
+      self._write_ops(ops)
+    return True
+
+  # The object is read first without taking the write lock, since it usually exists. Otherwise it is read again and
+  # inserted while holding the lock.
+  def get_or_insert(self, kind, key, value, ops=[]):
+    ndb_datastore.check_ops(ops)
+    old = self.get(kind, key)
+    if old is not None:
+      return old
+    with self.lock:
+      old = self.get(kind, key)
+      if old is None:
+        self._write_ops([("set", kind, key, value)] + ops)
+    return old
+
+  # Reads and rewrites the object while holding the write lock.
+  def modify(self, kind, key, function):
+    with self.lock:
+      old = _get_multi(self.db, kind, [key])[0]
+      if old is None:
+        return None
+      value = function(old)
+      self._write_ops([("set", kind, key, value)])
+    return value
+
+  # Applies the operations with a single write batch. The caller holds the write lock.
+  def _write_ops(self, ops):
+    batch = leveldb.WriteBatch()
+    changes = ndb_datastore.KindCatalogChanges(self.catalog)
+    written = {}
+    for op in ops:
+      key = ndb_datastore.encode_key(op[1], op[2])
+      if key in written:
+        old = written[key]
+      else:
+        old = self.db.get(key)
+      value = None
+      if op[0] == "set":
+        value = json.dumps(op[3])
+        batch.put(key, value)
+      elif old is not None:
+        batch.delete(key)
+      else:
+        continue
+      written[key] = value
+      changes.add_value(op[1], old, value)
+    self._write(batch, changes)
+
+  # Writes the batch along with the metadata records changed by changes. The caller holds the write lock.
+  def _write(self, batch, changes):
+    for recordKey, record in changes.records(self.db.get):
+      batch.put(recordKey, record)
+    self.db.write(batch)
+    changes.apply()
+
+  # Writes the items in a single write batch. If no object lies within the range of their keys, the items are all new,
+  # so their previous values are not read.
+  def bulk_set(self, kind, items):
+    if not items:
+      return
+    first = ndb_datastore.encode_key(kind, items[0][0])
+    last = ndb_datastore.encode_key(kind, items[-1][0])
+    with self.lock:
+      for row in self.db.range(start_key=first, end_key=last, end_inclusive=True):
+        break
+      else:
+        batch = leveldb.WriteBatch()
+        changes = ndb_datastore.KindCatalogChanges(self.catalog)
+        size = 0
+        for key, value in items:
+          value = json.dumps(value)
+          batch.put(ndb_datastore.encode_key(kind, key), value)
+          size += len(value)
+        changes.add(kind, len(items), size)
+        self._write(batch, changes)
+        return
+    self.write_batch([("set", kind, key, value) for key, value in items])
 
   def iter(self, kind):
     return LevelDBDatastoreIterator(self, kind)
 
+  def iter_items(self, kind, start=None, end=None):
+    return _iter_items(self.db, kind, start, end)
+
   def get_kinds(self):
-    kinds = set()
-    offset = ""
-    while True:
-      try:
-        key = self.db.range(start_key=offset).next().key
-        if (not key):
-          break
-        key = key.split(" ")[0]
-        offset = key + "."
-        kinds.add(json.loads(key.decode("hex")))
-      except:
-        break
-    return sorted(list(kinds))
+    return self.catalog.get_kinds()
+
+  def get_kind_stats(self):
+    return self.catalog.get_kind_stats()
+
+  # Loads the kind catalog, or rebuilds it with a full scan if the datastore does not have one yet.
+  def _load_catalog(self):
+    if self.db.get(ndb_datastore.KindCatalog.marker) is not None:
+      _read_catalog(self.db, self.catalog)
+      return
+    for row in self.db.range():
+      if row.key.startswith("!"):
+        continue
+      kind, _ = ndb_datastore.decode_key(row.key)
+      self.catalog.update_value(kind, None, row.value)
+    batch = leveldb.WriteBatch()
+    for recordKey, record in self.catalog.records():
+      batch.put(recordKey, record)
+    batch.put(ndb_datastore.KindCatalog.marker, "1")
+    self.db.write(batch)
 
   def get_path(self):
     return self.path
 
+  def snapshot(self):
+    snapshot = LevelDBSnapshot(self.db.snapshot())
+    snapshot.origin = self
+    return snapshot
+
   def close(self):
     self.db.close()
     self.db = None
 
+# Read-only view of a LevelDB datastore, reading from a LevelDB snapshot (see LevelDBDatastore.snapshot).
+class LevelDBSnapshot(ndb_datastore.DatastoreSnapshot):
+  def __init__(self, db):
+    self.db = db
+    self.catalog = ndb_datastore.KindCatalog()
+    _read_catalog(db, self.catalog)
+
+  def get(self, kind, key):
+    return _get_multi(self.db, kind, [key])[0]
+
+  def get_multi(self, kind, keys):
+    return _get_multi(self.db, kind, keys)
+
+  def iter(self, kind):
+    return (json.loads(row.key.decode("hex")) for row in self.db.scope(json.dumps(kind).encode("hex") + " "))
+
+  def iter_items(self, kind, start=None, end=None):
+    return _iter_items(self.db, kind, start, end)
+
+  def get_kinds(self):
+    return self.catalog.get_kinds()
+
+  def get_kind_stats(self):
+    return self.catalog.get_kind_stats()
+
+  # The LevelDB snapshot is released once it is no longer referenced.
+  def close(self):
+    self.db = None
+
 class LevelDBDatastoreIterator:
   def __init__(self, datastore, kind):
     self.datastore = datastore
@@ -71,3 +207,36 @@ class LevelDBDatastoreIterator:
     key = self.datastoreIterator.next().key.strip()
     key = json.loads(key.decode("hex"))
     return key
+
+# Returns the values of the objects with the given kind and keys read from db (a LevelDB database or snapshot), None
+# for the missing ones.
+def _get_multi(db, kind, keys):
+  values = []
+  for key in keys:
+    value = db.get(ndb_datastore.encode_key(kind, key))
+    if value is not None:
+      value = json.loads(value)
+    values.append(value)
+  return values
+
+# Returns an iterator over the (key, value) pairs of kind read from db, in the range [start, end) if given.
+def _iter_items(db, kind, start, end):
+  rows = db.scope(json.dumps(kind).encode("hex") + " ")
+  if start is not None or end is not None:
+    rows = rows.range(start_key=_encode_bound(start), end_key=_encode_bound(end))
+  for row in rows:
+    yield json.loads(row.key.decode("hex")), json.loads(row.value)
+
+# Loads the metadata records of the kind catalog read from db into catalog.
+def _read_catalog(db, catalog):
+  prefix = ndb_datastore.KindCatalog.prefix
+  for row in db.range(start_key=prefix):
+    if not row.key.startswith(prefix):
+      break
+    catalog.load(row.key, row.value)
+
+# Returns the encoded form of a bound of iter_items, relative to the prefix of the kind.
+def _encode_bound(key):
+  if key is None:
+    return None
+  return json.dumps(key).encode("hex")
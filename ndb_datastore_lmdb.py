@@ -4,9 +4,11 @@
 # Web: https://code.google.com/p/ndb-py
 # License: GPLv2
 
+import contextlib
 import json
 import lmdb
 import ndb_datastore
+import threading
 
 # Datastore implemented on top of OpenLDAP's LMDB.
 class LMDBDatastore(ndb_datastore.Datastore):
@@ -18,57 +20,230 @@ class LMDBDatastore(ndb_datastore.Datastore):
                         sync=False,
                         map_async=True,
                         writemap=True)
+    # Serializes the write transactions of this process (LMDB does too) with the updates of the in-memory catalog, so that
+    # it ends up with the records of the last one.
+    self.lock = threading.Lock()
+    self.catalog = ndb_datastore.KindCatalog()
+    self._load_catalog()
 
   def set(self, kind, key, value):
-    kind = json.dumps(kind).encode("hex")
-    key = json.dumps(key).encode("hex")
-    value = json.dumps(value)
-    with self.db.begin(write=True) as txn:
-      txn.put("%s %s" % (kind, key), value)
+    self.write_batch([("set", kind, key, value)])
 
   def get(self, kind, key):
-    kind = json.dumps(kind).encode("hex")
-    key = json.dumps(key).encode("hex")
     with self.db.begin(write=False) as txn:
-      value = txn.get("%s %s" % (kind, key))
-    if value is None:
-      return None
-    value = json.loads(value)
-    return value
+      return _get_multi(txn, kind, [key])[0]
+
+  def get_multi(self, kind, keys):
+    with self.db.begin(write=False) as txn:
+      return _get_multi(txn, kind, keys)
 
   def delete(self, kind, key):
-    with self.db.begin(write=True) as txn:
-      txn.delete("%s %s" % (kind, key))
+    self.write_batch([("delete", kind, key)])
+
+  # Context manager running an LMDB write transaction, yielding it with the KindCatalogChanges of the write. The metadata
+  # records are updated at the end of the transaction, and the in-memory catalog once it is committed.
+  @contextlib.contextmanager
+  def _write_txn(self):
+    changes = ndb_datastore.KindCatalogChanges(self.catalog)
+    with self.lock:
+      with self.db.begin(write=True) as txn:
+        yield txn, changes
+        for recordKey, record in changes.records(txn.get):
+          txn.put(recordKey, record)
+      changes.apply()
+
+  # Applies all the operations in a single LMDB write transaction.
+  def write_batch(self, ops):
+    ndb_datastore.check_ops(ops)
+    with self._write_txn() as (txn, changes):
+      self._write_ops(txn, changes, ops)
+
+  # Checks the values and applies the operations in a single LMDB write transaction.
+  def commit(self, checks, ops):
+    ndb_datastore.check_ops(ops)
+    with self._write_txn() as (txn, changes):
+      for kind, key, value in checks:
+        if _get_multi(txn, kind, [key])[0] != value:
+          return False
+      self._write_ops(txn, changes, ops)
+    return True
+
+  # The object is read first without taking the write lock, since it usually exists. Otherwise it is inserted in a write
+  # transaction, unless another one inserted it meanwhile.
+  def get_or_insert(self, kind, key, value, ops=[]):
+    ndb_datastore.check_ops(ops)
+    old = self.get(kind, key)
+    if old is not None:
+      return old
+    encodedKey = ndb_datastore.encode_key(kind, key)
+    encoded = json.dumps(value)
+    with self._write_txn() as (txn, changes):
+      if not txn.put(encodedKey, encoded, overwrite=False):
+        return json.loads(txn.get(encodedKey))
+      changes.add_value(kind, None, encoded)
+      self._write_ops(txn, changes, ops)
+    return None
+
+  # Reads and rewrites the object in a single LMDB write transaction.
+  def modify(self, kind, key, function):
+    with self._write_txn() as (txn, changes):
+      old = _get_multi(txn, kind, [key])[0]
+      if old is None:
+        return None
+      value = function(old)
+      self._write_ops(txn, changes, [("set", kind, key, value)])
+    return value
+
+  def _write_ops(self, txn, changes, ops):
+    for op in ops:
+      key = ndb_datastore.encode_key(op[1], op[2])
+      old = txn.get(key)
+      value = None
+      if op[0] == "set":
+        value = json.dumps(op[3])
+        txn.put(key, value)
+      elif old is not None:
+        txn.delete(key)
+      else:
+        continue
+      changes.add_value(op[1], old, value)
+
+  # Writes the items in a single transaction. If no object lies within the range of their keys, the items are all new,
+  # so their previous values are not read; if they also come after all the keys of the datastore, they are appended to
+  # the B-tree (MDB_APPEND), which skips the searches and fills the pages completely.
+  def bulk_set(self, kind, items):
+    if not items:
+      return
+    encoded = [(ndb_datastore.encode_key(kind, key), json.dumps(value)) for key, value in items]
+    with self._write_txn() as (txn, changes):
+      cursor = txn.cursor()
+      if cursor.set_range(encoded[0][0]) and cursor.key() <= encoded[-1][0]:
+        for key, value in encoded:
+          old = txn.get(key)
+          txn.put(key, value)
+          changes.add_value(kind, old, value)
+        return
+      append = not cursor.last() or cursor.key() < encoded[0][0]
+      cursor.putmulti(encoded, append=append)
+      changes.add(kind, len(encoded), sum([len(value) for _, value in encoded]))
 
   def iter(self, kind):
     return LMDBDatastoreIterator(self, kind)
 
+  def iter_items(self, kind, start=None, end=None):
+    with self.db.begin(write=False) as txn:
+      for item in _iter_items(txn, kind, start, end):
+        yield item
+
   def get_path(self):
     return self.path
 
+  # The snapshot is an LMDB read transaction: it doesn't block the writers, but the pages it reads cannot be reused
+  # until it is closed, so the file grows if it is kept open while the datastore is heavily written.
+  def snapshot(self):
+    snapshot = LMDBSnapshot(self.db.begin(write=False))
+    snapshot.origin = self
+    return snapshot
+
   def get_kinds(self):
-    kinds = set()
-    offset = ""
-    with self.db.begin(write=False) as txn:
-      while True:
-        try:
-          cursor = txn.cursor()
-          cursor.set_range(offset)
-          key = cursor.key()
-          if (not key):
-            raise StopIteration()
-          key = key.split(" ")[0]
-          offset = key + "."
-          kinds.add(json.loads(key.decode("hex")))
-        except:
-          cursor = None
-          break
-    return sorted(list(kinds))
+    return self.catalog.get_kinds()
+
+  def get_kind_stats(self):
+    return self.catalog.get_kind_stats()
+
+  # Loads the kind catalog, or rebuilds it with a full scan if the datastore does not have one yet.
+  # The catalog is only changed inside write transactions, which LMDB serializes.
+  def _load_catalog(self):
+    with self.db.begin(write=True) as txn:
+      if txn.get(ndb_datastore.KindCatalog.marker) is not None:
+        _read_catalog(txn, self.catalog)
+        return
+      for key, value in txn.cursor():
+        if key.startswith("!"):
+          continue
+        kind, _ = ndb_datastore.decode_key(key)
+        self.catalog.update_value(kind, None, value)
+      for recordKey, record in self.catalog.records():
+        txn.put(recordKey, record)
+      txn.put(ndb_datastore.KindCatalog.marker, "1")
 
   def close(self):
     self.db.close()
     self.db = None
 
+# Read-only view of an LMDB datastore, reading from a read transaction (see LMDBDatastore.snapshot).
+# An LMDB transaction must not be used by several threads at once, so the reads (and each step of the iterations) are
+# serialized.
+class LMDBSnapshot(ndb_datastore.DatastoreSnapshot):
+  def __init__(self, txn):
+    self.txn = txn
+    self.lock = threading.Lock()
+    self.catalog = ndb_datastore.KindCatalog()
+    _read_catalog(txn, self.catalog)
+
+  def get(self, kind, key):
+    return self.get_multi(kind, [key])[0]
+
+  def get_multi(self, kind, keys):
+    with self.lock:
+      return _get_multi(self.txn, kind, keys)
+
+  def iter(self, kind):
+    return (key for key, _ in self.iter_items(kind))
+
+  def iter_items(self, kind, start=None, end=None):
+    items = _iter_items(self.txn, kind, start, end)
+    while True:
+      with self.lock:
+        item = next(items, None)
+      if item is None:
+        return
+      yield item
+
+  def get_kinds(self):
+    return self.catalog.get_kinds()
+
+  def get_kind_stats(self):
+    return self.catalog.get_kind_stats()
+
+  def close(self):
+    with self.lock:
+      if self.txn is not None:
+        self.txn.abort()
+        self.txn = None
+
+# Returns the values of the objects with the given kind and keys read in txn, None for the missing ones.
+def _get_multi(txn, kind, keys):
+  values = []
+  for key in keys:
+    value = txn.get(ndb_datastore.encode_key(kind, key))
+    if value is not None:
+      value = json.loads(value)
+    values.append(value)
+  return values
+
+# Returns an iterator over the (key, value) pairs of kind read in txn, in the range [start, end) if given.
+def _iter_items(txn, kind, start, end):
+  prefix = json.dumps(kind).encode("hex") + " "
+  first = prefix if start is None else ndb_datastore.encode_key(kind, start)
+  last = None if end is None else ndb_datastore.encode_key(kind, end)
+  cursor = txn.cursor()
+  cursor.set_range(first)
+  for key, value in cursor:
+    if not key.startswith(prefix) or (last is not None and key >= last):
+      break
+    yield json.loads(key[len(prefix):].decode("hex")), json.loads(value)
+
+# Loads the metadata records of the kind catalog read in txn into catalog.
+def _read_catalog(txn, catalog):
+  prefix = ndb_datastore.KindCatalog.prefix
+  cursor = txn.cursor()
+  cursor.set_range(prefix)
+  for key, value in cursor:
+    if not key.startswith(prefix):
+      break
+    catalog.load(key, value)
+
 class LMDBDatastoreIterator:
   def __init__(self, datastore, kind):
     self.datastore = datastore
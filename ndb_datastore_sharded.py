@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+import bisect
+import hashlib
+import heapq
+import json
+import ndb_datastore
+import Queue
+import threading
+
+# Datastore spreading the objects over several datastores (shards), e.g. LevelDB datastores on different disks.
+# Each object is stored in one shard, chosen with a consistent hash of its kind and key. Since every shard has its own
+# files and its own write lock, writes to different shards run in parallel.
+# Batches are split per shard and sent to the shards in parallel; each part is atomic if the shard supports it, but the
+# batch as a whole is not. The list of shards must not change once data has been stored (the objects are not moved).
+class ShardedDatastore(ndb_datastore.Datastore):
+  # Number of points of each shard on the hash ring. More points spread the keys more evenly.
+  pointsPerShard = 64
+
+  # pool: the ShardPool to run the calls to the shards on (used by the snapshots, which share the one of their
+  # datastore). By default the datastore creates its own once needed, and stops it when closed.
+  def __init__(self, shards, path=None, pool=None):
+    if not shards:
+      raise ValueError("A sharded datastore needs at least one shard")
+    self.shards = list(shards)
+    self.path = path
+    self.ring = []
+    for i in range(len(self.shards)):
+      for j in range(self.pointsPerShard):
+        self.ring.append((self._hash("%d %d" % (i, j)), i))
+    self.ring.sort()
+    self.ringHashes = [h for h, _ in self.ring]
+    # Serializes the commits.
+    self.commitLock = threading.Lock()
+    self.pool = pool
+    self.ownsPool = pool is None
+    self.poolLock = threading.Lock()
+
+  # Returns the pool running the calls to the shards, starting it if needed.
+  def _get_pool(self):
+    with self.poolLock:
+      if self.pool is None:
+        self.pool = ShardPool(len(self.shards))
+      return self.pool
+
+  def _hash(self, s):
+    return int(hashlib.md5(s).hexdigest()[:16], 16)
+
+  # Returns the index of the shard holding the object with the given kind and key.
+  def shard_index(self, kind, key):
+    h = self._hash(json.dumps([kind, key]))
+    i = bisect.bisect(self.ringHashes, h)
+    if i == len(self.ring):
+      i = 0
+    return self.ring[i][1]
+
+  def set(self, kind, key, value):
+    self.shards[self.shard_index(kind, key)].set(kind, key, value)
+
+  def get(self, kind, key):
+    return self.shards[self.shard_index(kind, key)].get(kind, key)
+
+  def delete(self, kind, key):
+    self.shards[self.shard_index(kind, key)].delete(kind, key)
+
+  def get_multi(self, kind, keys):
+    positions = {}
+    for i in range(len(keys)):
+      positions.setdefault(self.shard_index(kind, keys[i]), []).append(i)
+    calls = []
+    for shard in positions:
+      calls.append((self.shards[shard].get_multi, kind, [keys[i] for i in positions[shard]]))
+    values = [None] * len(keys)
+    results = self._get_pool().run(calls)
+    shards = positions.keys()
+    for j in range(len(shards)):
+      for i, value in zip(positions[shards[j]], results[j]):
+        values[i] = value
+    return values
+
+  def write_batch(self, ops):
+    ndb_datastore.check_ops(ops)
+    byShard = {}
+    for op in ops:
+      byShard.setdefault(self.shard_index(op[1], op[2]), []).append(op)
+    self._get_pool().run([(self.shards[shard].write_batch, byShard[shard]) for shard in byShard])
+
+  # The commits are serialized. Those touching a single shard are delegated to it, and are atomic if it supports it. The
+  # others are isolated from the other commits, but not from the plain writes, and they are not atomic, as write_batch.
+  def commit(self, checks, ops):
+    ndb_datastore.check_ops(ops)
+    shards = set([self.shard_index(kind, key) for kind, key, _ in checks] +
+                 [self.shard_index(op[1], op[2]) for op in ops])
+    with self.commitLock:
+      if len(shards) == 1:
+        return self.shards[shards.pop()].commit(checks, ops)
+      for kind, key, value in checks:
+        if self.get(kind, key) != value:
+          return False
+      if ops:
+        self.write_batch(ops)
+    return True
+
+  # Without other operations, the insert is delegated to the shard of the object. The other operations may belong to
+  # other shards, so the insert is committed instead.
+  def get_or_insert(self, kind, key, value, ops=[]):
+    if ops:
+      return ndb_datastore.Datastore.get_or_insert(self, kind, key, value, ops)
+    return self.shards[self.shard_index(kind, key)].get_or_insert(kind, key, value)
+
+  # Delegated to the shard of the object. Like the plain writes, not isolated from the commits spanning several shards.
+  def modify(self, kind, key, function):
+    return self.shards[self.shard_index(kind, key)].modify(kind, key, function)
+
+  # Splits the items per shard, keeping their order, and writes the parts in parallel.
+  def bulk_set(self, kind, items):
+    byShard = {}
+    for item in items:
+      byShard.setdefault(self.shard_index(kind, item[0]), []).append(item)
+    self._get_pool().run([(self.shards[shard].bulk_set, kind, byShard[shard]) for shard in byShard])
+
+  # Returns an iterator over the keys of the given kind, reading all the shards in parallel. Call its close() method if
+  # it is not read to the end.
+  def iter(self, kind):
+    return ShardedDatastoreIterator(self.shards, kind, "iter")
+
+  # Returns an iterator over the (key, value) pairs of the given kind, reading all the shards in parallel.
+  # Ranges must be returned in key order, so they are merged from the shards instead.
+  def iter_items(self, kind, start=None, end=None):
+    if start is not None or end is not None:
+      return heapq.merge(*[shard.iter_items(kind, start, end) for shard in self.shards])
+    return ShardedDatastoreIterator(self.shards, kind, "iter_items")
+
+  def get_path(self):
+    return self.path
+
+  # Returns a sharded datastore over snapshots of the shards. Each shard is consistent, but the shards are not
+  # snapshotted at exactly the same time.
+  def snapshot(self):
+    snapshot = ShardedDatastore([shard.snapshot() for shard in self.shards], pool=self._get_pool())
+    snapshot.origin = self
+    return snapshot
+
+  def get_kinds(self):
+    kinds = set()
+    for shard in self.shards:
+      kinds.update(shard.get_kinds())
+    return sorted(list(kinds))
+
+  def get_kind_stats(self):
+    stats = {}
+    for shard in self.shards:
+      shardStats = shard.get_kind_stats()
+      for kind in shardStats:
+        if kind not in stats:
+          stats[kind] = {"count": 0, "bytes": 0}
+        stats[kind]["count"] += shardStats[kind]["count"]
+        stats[kind]["bytes"] += shardStats[kind]["bytes"]
+    return stats
+
+  def close(self):
+    with self.poolLock:
+      if self.pool is not None and self.ownsPool:
+        self.pool.stop()
+      self.pool = None
+    for shard in self.shards:
+      shard.close()
+
+
+# Pool of threads running the calls to the shards of a ShardedDatastore, so that the batches don't start new threads.
+class ShardPool:
+  def __init__(self, size):
+    self.tasks = Queue.Queue()
+    self.threads = []
+    for i in range(size):
+      t = threading.Thread(target=_run_tasks, args=[self.tasks])
+      t.daemon = True
+      t.start()
+      self.threads.append(t)
+
+  # Runs each (function, arg1, arg2...) tuple of calls in parallel, and returns the list of results. The first call is
+  # run by the calling thread, the others by the pool.
+  # If any call raises an exception, the first one is raised once all the calls have completed.
+  def run(self, calls):
+    if not calls:
+      return []
+    futures = [ndb_datastore.Future() for call in calls]
+    for future, call in zip(futures[1:], calls[1:]):
+      self.tasks.put((future, call))
+    _run_task(futures[0], calls[0])
+    ndb_datastore.wait_all(futures)
+    return [future.get_result() for future in futures]
+
+  # Stops the threads once the calls already submitted have been run.
+  def stop(self):
+    for t in self.threads:
+      self.tasks.put(None)
+    for t in self.threads:
+      t.join()
+    self.threads = []
+
+
+def _run_task(future, call):
+  try:
+    future.set_result(call[0](*call[1:]))
+  except Exception, e:
+    future.set_exception(e)
+
+# Runs the tasks of a ShardPool until it is stopped.
+def _run_tasks(tasks):
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    _run_task(*task)
+
+
+# Reads what the method (iter or iter_items) of shard returns for kind into queue, for ShardedDatastoreIterator, until
+# the stop event is set.
+# The threads don't hold a reference to the iterator, so that it is garbage collected (and stops them) once abandoned.
+def _read_shard(shard, method, kind, queue, stop):
+  try:
+    for key in getattr(shard, method)(kind):
+      if not _put(queue, stop, ("key", key)):
+        return
+    _put(queue, stop, ("end", None))
+  except Exception, e:
+    _put(queue, stop, ("error", e))
+
+# Queues an item, giving up if the stop event is set. Returns False in that case.
+def _put(queue, stop, item):
+  while not stop.is_set():
+    try:
+      queue.put(item, timeout=0.1)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+
+# Iterator over a kind in all the shards, returning what the method (iter or iter_items) of the shards returns.
+# Each shard is read by its own thread, and the results are returned as they arrive, in no particular order. The threads
+# stop once the iterator is read to the end, closed, or garbage collected.
+class ShardedDatastoreIterator:
+  # Maximum number of results read ahead from the shards.
+  bufferSize = 1000
+
+  def __init__(self, shards, kind, method):
+    self.queue = Queue.Queue(self.bufferSize)
+    self.stop = threading.Event()
+    self.running = len(shards)
+    for shard in shards:
+      t = threading.Thread(target=_read_shard, args=[shard, method, kind, self.queue, self.stop])
+      t.daemon = True
+      t.start()
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    while self.running > 0:
+      itemType, value = self.queue.get()
+      if itemType == "key":
+        return value
+      self.running -= 1
+      if itemType == "error":
+        self.close()
+        raise value
+    raise StopIteration()
+
+  # Stops the threads reading the shards. Called automatically once the iterator is garbage collected.
+  def close(self):
+    self.running = 0
+    self.stop.set()
+
+  def __del__(self):
+    self.close()
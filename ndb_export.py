@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+import collections
+import json
+import multiprocessing
+import ndb_datastore
+import struct
+import sys
+import time
+import zlib
+
+# Export and import of datastores.
+# export_datastore() streams the objects of a datastore to a file, reading them from a snapshot (see
+# Datastore.snapshot), so the export is consistent and runs against a live datastore without blocking its writers.
+# import_datastore() loads such a file into a datastore. Both run in constant memory, and compress or decompress the
+# blocks on a pool of processes.
+#
+# File format (version 1):
+#   - the 8 bytes "NDBDUMP1";
+#   - a sequence of blocks. Each block is a 16-byte header, packed as struct ">4sIII": the block type, the size of the
+#     data, the size of the data once decompressed, and the CRC-32 of the data; followed by the data, compressed with
+#     zlib. The block types are:
+#     "DATA": objects, one per line, each as the JSON array [kind, key, value]. The objects of a kind are in key order
+#             for the persistent datastores, and a kind may span several blocks;
+#     "END ": the JSON object {"kinds": {kind: number of objects exported}}. It is the last block, so that truncated
+#             files are detected.
+# The values are exported as stored, so a file can only be imported by a version of the module storing the same format.
+# Internal kinds (the indexes) are exported along with the models when all the kinds are. When only some kinds are,
+# the versions of their schemas (see ndb.Schema) and their values stored out of line are exported with them, but the
+# indexes of their models must be rebuilt after the import with Model.build_indexes().
+
+magic = "NDBDUMP1"
+blockHeader = struct.Struct(">4sIII")
+
+# Returns the encoded block of the given type holding data.
+def _encode_block(type, data, level):
+  compressed = zlib.compress(data, level)
+  return blockHeader.pack(type, len(compressed), len(data), zlib.crc32(compressed) & 0xffffffff) + compressed
+
+def _encode_data_block(args):
+  data, level = args
+  return _encode_block("DATA", data, level)
+
+# Returns the data of a block, checking its size and checksum.
+def _decode_block(header, compressed):
+  type, size, dataSize, crc = header
+  if zlib.crc32(compressed) & 0xffffffff != crc:
+    raise ValueError("Bad checksum of %s block" % type.strip())
+  data = zlib.decompress(compressed)
+  if len(data) != dataSize:
+    raise ValueError("Bad size of %s block" % type.strip())
+  return data
+
+# Decodes a DATA block, and returns its objects as a list of (kind, list of (key, value) sorted by encoded key).
+# Runs in the worker processes.
+def _decode_data_block(args):
+  byKind = collections.OrderedDict()
+  for line in _decode_block(*args).split("\n"):
+    kind, key, value = json.loads(line)
+    byKind.setdefault(kind, []).append((key, value))
+  result = []
+  for kind in byKind:
+    items = byKind[kind]
+    items.sort(key=lambda item: ndb_datastore.encode_key(kind, item[0]))
+    result.append((kind, items))
+  return result
+
+# Returns an iterator over function(item) for each item of items, in order, computed by a pool of processes (or in
+# this process if processes is 1). At most 2 items per process are in flight, so that memory use is bounded.
+def _map_ordered(function, items, processes):
+  if processes is None:
+    processes = multiprocessing.cpu_count()
+  if processes == 1:
+    for item in items:
+      yield function(item)
+    return
+  pool = multiprocessing.Pool(processes)
+  try:
+    pending = collections.deque()
+    for item in items:
+      pending.append(pool.apply_async(function, [item]))
+      if len(pending) >= 2 * processes:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+
+# Progress function printing the number of objects exported or imported and the throughput on stderr.
+def print_progress(objects, seconds):
+  sys.stderr.write("%d objects, %.0f objects/s\n" % (objects, objects / seconds if seconds > 0 else 0))
+
+# Writes the objects of datastore to out (a file object open for writing in binary mode), and returns a dictionary with
+# the number of objects exported per kind.
+# kinds: list of the kinds to export (default: all the kinds, internal kinds included).
+# blockSize: approximate size of the data of each block, before compression.
+# level: zlib compression level.
+# processes: number of processes compressing the blocks (default: number of CPUs).
+# progress: function called as progress(objects exported, seconds elapsed) after each block, or None.
+def export_datastore(datastore, out, kinds=None, blockSize=1 << 20, level=6, processes=None, progress=None):
+  start = time.time()
+  snapshot = datastore.snapshot()
+  try:
+    stats = snapshot.get_kind_stats()
+    if kinds is None:
+      kinds = sorted(stats.keys())
+    else:
+      internalKinds = [internal for kind in kinds
+                       for internal in (ndb_datastore.schema_kind(kind), ndb_datastore.blob_kind(kind))]
+      kinds = [internal for internal in internalKinds if internal in stats] + kinds
+    counts = collections.OrderedDict([(kind, 0) for kind in kinds])
+    def blocks():
+      lines = []
+      size = 0
+      for kind in kinds:
+        for key, value in snapshot.iter_items(kind):
+          line = json.dumps([kind, key, value])
+          lines.append(line)
+          size += len(line) + 1
+          counts[kind] += 1
+          if size >= blockSize:
+            yield "\n".join(lines), level
+            lines = []
+            size = 0
+      if lines:
+        yield "\n".join(lines), level
+    out.write(magic)
+    for block in _map_ordered(_encode_data_block, blocks(), processes):
+      out.write(block)
+      if progress is not None:
+        progress(sum(counts.values()), time.time() - start)
+    out.write(_encode_block("END ", json.dumps({"kinds": counts}), level))
+  finally:
+    snapshot.close()
+  return dict(counts)
+
+# Reads the objects exported to input (a file object open for reading in binary mode) and stores them in datastore,
+# replacing the objects with the same kinds and keys. Returns a dictionary with the number of objects imported per
+# kind. Raises a ValueError if the file is corrupted or truncated; the objects read until then are stored.
+# processes: number of processes decompressing the blocks (default: number of CPUs).
+# progress: function called as progress(objects imported, seconds elapsed) after each block, or None.
+def import_datastore(datastore, input, processes=None, progress=None):
+  start = time.time()
+  if input.read(len(magic)) != magic:
+    raise ValueError("Not an ndb export file")
+  end = []
+  def blocks():
+    while True:
+      header = _read_exactly(input, blockHeader.size)
+      header = blockHeader.unpack(header)
+      compressed = _read_exactly(input, header[1])
+      if header[0] == "END ":
+        end.append(json.loads(_decode_block(header, compressed)))
+        return
+      if header[0] != "DATA":
+        raise ValueError("Unknown block type %r" % header[0])
+      yield header, compressed
+  counts = {}
+  for block in _map_ordered(_decode_data_block, blocks(), processes):
+    for kind, items in block:
+      datastore.bulk_set(kind, items)
+      counts[kind] = counts.get(kind, 0) + len(items)
+    if progress is not None:
+      progress(sum(counts.values()), time.time() - start)
+  for kind, count in end[0]["kinds"].items():
+    if counts.get(kind, 0) != count:
+      raise ValueError("Imported %d objects of kind %s instead of %d" % (counts.get(kind, 0), kind, count))
+  return counts
+
+def _read_exactly(input, size):
+  data = input.read(size)
+  if len(data) != size:
+    raise ValueError("Truncated export file")
+  return data
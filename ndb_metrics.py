@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Web: https://code.google.com/p/ndb-py
+# License: GPLv2
+
+import bisect
+import ndb_datastore
+import re
+import socket
+import threading
+import time
+
+# Datastore metrics.
+# Wrap a datastore in a MetricsDatastore to count its calls and measure their latency, per operation, kind and backend:
+#   ndb_datastore_ops_total: number of calls
+#   ndb_datastore_items_total: number of objects read or written by the calls (e.g. the keys of a get_multi)
+#   ndb_datastore_latency_seconds: histogram of the call latencies (for iterations, the time to read all the objects)
+#   ndb_datastore_bytes_read_total, ndb_datastore_bytes_written_total: size of the values read and written
+#   ndb_datastore_hits_total, ndb_datastore_misses_total: keys found and not found by get and get_multi; the hit rate
+#   is hits / (hits + misses)
+# The metrics are collected in a Metrics registry, read with snapshot() or to_prometheus(), and passed to the hooks
+# of the registry as they are recorded, e.g. a StatsdHook. When the registry is disabled, the wrapper only costs an
+# attribute check per call.
+
+# Registry of counters and latency histograms, identified by a name and a tuple of (label, value) pairs.
+class Metrics:
+  # Upper bounds of the histogram buckets in seconds, from 1 microsecond to about 16 seconds, doubling each time.
+  buckets = [0.000001 * 2 ** i for i in range(25)]
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+    self.hooks = []
+
+  # Registers a function called as hook(type, name, labels, value) for each counter increment (type "counter") and
+  # each latency in seconds (type "timing").
+  def add_hook(self, hook):
+    self.hooks.append(hook)
+
+  def remove_hook(self, hook):
+    self.hooks.remove(hook)
+
+  # Adds value to a counter.
+  def inc(self, name, labels, value=1):
+    self.update([(name, labels, value)], [])
+
+  # Records a latency in seconds in a histogram.
+  def observe(self, name, labels, seconds):
+    self.update([], [(name, labels, seconds)])
+
+  # Applies a list of (name, labels, value) counter increments and a list of (name, labels, seconds) latencies at once.
+  def update(self, counts, timings):
+    with self.lock:
+      for name, labels, value in counts:
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+      for name, labels, seconds in timings:
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+          histogram = Histogram(self.buckets)
+          self.histograms[(name, labels)] = histogram
+        histogram.observe(seconds)
+    for hook in self.hooks:
+      for name, labels, value in counts:
+        hook("counter", name, labels, value)
+      for name, labels, seconds in timings:
+        hook("timing", name, labels, seconds)
+
+  def reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+
+  # Returns a dictionary with the counters ({(name, labels): value}) and the histograms ({(name, labels): dictionary
+  # with count, sum, p50, p90 and p99, in seconds}).
+  def snapshot(self):
+    with self.lock:
+      counters = dict(self.counters)
+      histograms = dict([(k, self.histograms[k].summary()) for k in self.histograms])
+    return {"counters": counters, "histograms": histograms}
+
+  # Returns the metrics in the Prometheus text exposition format.
+  def to_prometheus(self):
+    with self.lock:
+      counters = sorted(self.counters.items())
+      histograms = sorted([(k, self.histograms[k].copy()) for k in self.histograms])
+    lines = []
+    lastName = None
+    for (name, labels), value in counters:
+      if name != lastName:
+        lines.append("# TYPE %s counter" % name)
+        lastName = name
+      lines.append("%s%s %s" % (name, _prometheus_labels(labels), value))
+    for (name, labels), histogram in histograms:
+      if name != lastName:
+        lines.append("# TYPE %s histogram" % name)
+        lastName = name
+      cumulative = 0
+      for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append("%s_bucket%s %d" % (name, _prometheus_labels(labels + (("le", "%g" % bound),)), cumulative))
+      lines.append("%s_bucket%s %d" % (name, _prometheus_labels(labels + (("le", "+Inf"),)), histogram.count))
+      lines.append("%s_sum%s %r" % (name, _prometheus_labels(labels), histogram.sum))
+      lines.append("%s_count%s %d" % (name, _prometheus_labels(labels), histogram.count))
+    return "\n".join(lines) + "\n"
+
+def _prometheus_labels(labels):
+  if not labels:
+    return ""
+  escaped = [(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+  return "{%s}" % ",".join(["%s=\"%s\"" % (k, v) for k, v in escaped])
+
+
+# Histogram with fixed buckets. Values above the last bound are only counted in the total.
+class Histogram:
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * len(bounds)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    i = bisect.bisect_left(self.bounds, value)
+    if i < len(self.counts):
+      self.counts[i] += 1
+    self.count += 1
+    self.sum += value
+
+  def copy(self):
+    histogram = Histogram(self.bounds)
+    histogram.counts = list(self.counts)
+    histogram.count = self.count
+    histogram.sum = self.sum
+    return histogram
+
+  # Returns an upper bound of the q quantile (0 < q <= 1): the bound of the bucket holding it.
+  def quantile(self, q):
+    rank = q * self.count
+    cumulative = 0
+    for bound, count in zip(self.bounds, self.counts):
+      cumulative += count
+      if cumulative >= rank:
+        return bound
+    return float("inf")
+
+  def summary(self):
+    return {"count": self.count, "sum": self.sum, "p50": self.quantile(0.5), "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99)}
+
+
+# Default registry, used by the MetricsDatastore instances created without one.
+metrics = Metrics()
+
+
+# Hook sending the metrics to a StatsD server over UDP, as they are recorded (see Metrics.add_hook). Counters are sent
+# as StatsD counters and latencies as timers in milliseconds, named prefix.name.value1.value2... after the label
+# values. Set sampleRate below 1 to send only that fraction of the latencies. Send errors are ignored.
+class StatsdHook:
+  def __init__(self, host="localhost", port=8125, prefix="ndb", sampleRate=1.0):
+    self.address = (host, port)
+    self.prefix = prefix
+    self.sampleRate = sampleRate
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sampleCount = 0.0
+
+  def __call__(self, type, name, labels, value):
+    path = ".".join([self.prefix, name] + [_statsd_name(v) for _, v in labels])
+    if type == "counter":
+      self._send("%s:%d|c" % (path, value))
+      return
+    self.sampleCount += self.sampleRate
+    if self.sampleCount < 1.0:
+      return
+    self.sampleCount -= 1.0
+    if self.sampleRate < 1.0:
+      self._send("%s:%.3f|ms|@%g" % (path, value * 1000, self.sampleRate))
+    else:
+      self._send("%s:%.3f|ms" % (path, value * 1000))
+
+  def _send(self, data):
+    try:
+      self.socket.sendto(data, self.address)
+    except socket.error:
+      pass
+
+def _statsd_name(value):
+  return re.sub("[^A-Za-z0-9_-]", "_", str(value)) or "_"
+
+
+# Datastore wrapper recording the metrics of the calls to the wrapped datastore in a Metrics registry (the default
+# one if registry is None).
+# backend is the label identifying the datastore in the metrics; it defaults to the class name of the innermost
+# wrapped datastore, e.g. "LevelDBDatastore".
+class MetricsDatastore(ndb_datastore.DatastoreWrapper):
+  def __init__(self, datastore, registry=None, backend=None):
+    ndb_datastore.DatastoreWrapper.__init__(self, datastore)
+    self.metrics = registry if registry is not None else metrics
+    if backend is None:
+      inner = datastore
+      while isinstance(inner, ndb_datastore.DatastoreWrapper):
+        inner = inner.datastore
+      backend = inner.__class__.__name__
+    self.backend = backend
+
+  # Records a call of op on kind started at start (a time.time() value).
+  def _record(self, op, kind, start, items=1, bytesRead=0, bytesWritten=0, hits=0, misses=0):
+    seconds = time.time() - start
+    labels = (("backend", self.backend), ("kind", kind), ("op", op))
+    counts = [("ndb_datastore_ops_total", labels, 1), ("ndb_datastore_items_total", labels, items)]
+    if bytesRead:
+      counts.append(("ndb_datastore_bytes_read_total", labels, bytesRead))
+    if bytesWritten:
+      counts.append(("ndb_datastore_bytes_written_total", labels, bytesWritten))
+    if hits:
+      counts.append(("ndb_datastore_hits_total", labels, hits))
+    if misses:
+      counts.append(("ndb_datastore_misses_total", labels, misses))
+    self.metrics.update(counts, [("ndb_datastore_latency_seconds", labels, seconds)])
+
+  def set(self, kind, key, value):
+    if not self.metrics.enabled:
+      return self.datastore.set(kind, key, value)
+    start = time.time()
+    self.datastore.set(kind, key, value)
+    self._record("set", kind, start, bytesWritten=len(value))
+
+  def get(self, kind, key):
+    if not self.metrics.enabled:
+      return self.datastore.get(kind, key)
+    start = time.time()
+    value = self.datastore.get(kind, key)
+    if value is None:
+      self._record("get", kind, start, misses=1)
+    else:
+      self._record("get", kind, start, bytesRead=len(value), hits=1)
+    return value
+
+  def delete(self, kind, key):
+    if not self.metrics.enabled:
+      return self.datastore.delete(kind, key)
+    start = time.time()
+    self.datastore.delete(kind, key)
+    self._record("delete", kind, start)
+
+  def get_multi(self, kind, keys):
+    if not self.metrics.enabled:
+      return self.datastore.get_multi(kind, keys)
+    start = time.time()
+    values = self.datastore.get_multi(kind, keys)
+    found = [len(value) for value in values if value is not None]
+    self._record("get_multi", kind, start, items=len(keys), bytesRead=sum(found), hits=len(found),
+                 misses=len(keys) - len(found))
+    return values
+
+  # Batches may span several kinds: the latency is recorded under the kind "*", the objects and bytes written under
+  # their kinds.
+  def write_batch(self, ops):
+    if not self.metrics.enabled:
+      return self.datastore.write_batch(ops)
+    start = time.time()
+    self.datastore.write_batch(ops)
+    written = {}
+    for op in ops:
+      items, size = written.get(op[1], (0, 0))
+      written[op[1]] = (items + 1, size + (len(op[3]) if op[0] == "set" else 0))
+    self._record("write_batch", "*", start, items=len(ops))
+    counts = []
+    for kind in written:
+      labels = (("backend", self.backend), ("kind", kind), ("op", "write_batch"))
+      counts.append(("ndb_datastore_items_total", labels, written[kind][0]))
+      if written[kind][1]:
+        counts.append(("ndb_datastore_bytes_written_total", labels, written[kind][1]))
+    self.metrics.update(counts, [])
+
+  def commit(self, checks, ops):
+    if not self.metrics.enabled:
+      return self.datastore.commit(checks, ops)
+    start = time.time()
+    committed = self.datastore.commit(checks, ops)
+    self._record("commit", "*", start, items=len(ops))
+    return committed
+
+  # A hit is an object found, a miss an object inserted.
+  def get_or_insert(self, kind, key, value, ops=[]):
+    if not self.metrics.enabled:
+      return self.datastore.get_or_insert(kind, key, value, ops)
+    start = time.time()
+    old = self.datastore.get_or_insert(kind, key, value, ops)
+    if old is None:
+      self._record("get_or_insert", kind, start, bytesWritten=len(value), misses=1)
+    else:
+      self._record("get_or_insert", kind, start, bytesRead=len(old), hits=1)
+    return old
+
+  def modify(self, kind, key, function):
+    if not self.metrics.enabled:
+      return self.datastore.modify(kind, key, function)
+    start = time.time()
+    value = self.datastore.modify(kind, key, function)
+    if value is None:
+      self._record("modify", kind, start, misses=1)
+    else:
+      self._record("modify", kind, start, bytesWritten=len(value), hits=1)
+    return value
+
+  def bulk_set(self, kind, items):
+    if not self.metrics.enabled:
+      return self.datastore.bulk_set(kind, items)
+    start = time.time()
+    self.datastore.bulk_set(kind, items)
+    self._record("bulk_set", kind, start, items=len(items), bytesWritten=sum([len(value) for _, value in items]))
+
+  # The reads from the snapshot are recorded as well.
+  def snapshot(self):
+    return MetricsDatastore(self.datastore.snapshot(), self.metrics, self.backend)
+
+  def iter(self, kind):
+    if not self.metrics.enabled:
+      return self.datastore.iter(kind)
+    return self._measure_iter("iter", kind, self.datastore.iter(kind), False)
+
+  def iter_items(self, kind, start=None, end=None):
+    if not self.metrics.enabled:
+      return self.datastore.iter_items(kind, start, end)
+    return self._measure_iter("iter_items", kind, self.datastore.iter_items(kind, start, end), True)
+
+  # Returns the items of iterator, recording the iteration once it is complete (or abandoned). Only the time spent
+  # reading from the datastore is measured, not the time spent by the caller between the items. The iterator is closed
+  # if it is abandoned (e.g. to end its read transaction, or stop the threads of a ShardedDatastoreIterator).
+  def _measure_iter(self, op, kind, iterator, hasValues):
+    iterator = iter(iterator)
+    elapsed = 0.0
+    items = 0
+    bytesRead = 0
+    try:
+      while True:
+        start = time.time()
+        try:
+          item = iterator.next()
+        finally:
+          elapsed += time.time() - start
+        items += 1
+        if hasValues:
+          bytesRead += len(item[1])
+        yield item
+    except StopIteration:
+      pass
+    finally:
+      close = getattr(iterator, "close", None)
+      if close is not None:
+        close()
+      self._record(op, kind, time.time() - elapsed, items=items, bytesRead=bytesRead)